@@ -0,0 +1,89 @@
+"""
+Bytes on wire and CPU cost of per-message compression across payload sizes
+
+Run with:
+    python -m benchmarks.compression
+"""
+
+from argparse import ArgumentParser
+import timeit
+import random
+
+from src import compression
+from src import segments
+from src import util
+
+
+def log_payload(size: int) -> bytes:
+    """Pasted log encoded the way components.serialize does"""
+    rng = random.Random(size)
+    levels = ["DEBUG", "INFO", "WARNING", "ERROR"]
+    lines = []
+    length = 0
+
+    while length < size:
+        line = (
+            f"2026-10-19 12:{rng.randrange(60):02}:{rng.randrange(60):02} "
+            f"{rng.choice(levels)} worker-{rng.randrange(16)} "
+            f"request {rng.getrandbits(32):08x} handled in {rng.randrange(900)} ms"
+        )
+        lines.append(line)
+        length += len(line) + 1
+
+    text = "\n".join(lines)[:size]
+    return segments.encode(
+        [
+            segments.Segment(
+                text=text, bold=False, italic=False, underline=False, color=None
+            )
+        ]
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[64, 512, 2048, 16384, 65536]
+    )
+    args = parser.parse_args()
+
+    key, iv = util.symmetric_key(), util.symmetric_iv()
+    codecs = [None, *compression.supported()]
+
+    print(
+        f"{'size':>7} {'codec':<10} {'wire':>7} {'ratio':>6}"
+        f" {'send us':>9} {'receive us':>11}"
+    )
+
+    for size in args.sizes:
+        payload = log_payload(size)
+
+        for codec in codecs:
+            # Threshold 0 shows codec cost even for payloads it would skip
+            packed = compression.pack(codec, payload, threshold=0)
+            wire = util.aes_encrypt(key, iv, packed)
+
+            send = timeit.timeit(
+                lambda: util.aes_encrypt(
+                    key, iv, compression.pack(codec, payload, threshold=0)
+                ),
+                number=args.number,
+            )
+            receive = timeit.timeit(
+                lambda: compression.unpack(
+                    codec, util.aes_decrypt(key, iv, wire)
+                ),
+                number=args.number,
+            )
+
+            print(
+                f"{len(payload):>7} {codec or 'none':<10} {len(wire):>7}"
+                f" {len(wire) / len(payload):>6.2f}"
+                f" {send / args.number * 1e6:>9.1f}"
+                f" {receive / args.number * 1e6:>11.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
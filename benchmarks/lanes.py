@@ -0,0 +1,83 @@
+"""
+Ping latency on control lane, idle and while the same connection
+uploads large messages on bulk lane
+
+Run with:
+    python -m benchmarks.lanes
+"""
+
+from argparse import ArgumentParser
+import statistics
+import threading
+import time
+import os
+
+from src.client import Client
+from src.host import Host
+
+
+def report(name: str, samples: list[float]):
+    p99 = statistics.quantiles(samples, n=100, method="inclusive")[98]
+    print(
+        f"{name:<10}"
+        f"  p50 {statistics.median(samples) * 1e6:9.1f} us"
+        f"  p99 {p99 * 1e6:9.1f} us"
+        f"  max {max(samples) * 1e6:9.1f} us"
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--pings", type=int, default=500)
+    parser.add_argument("--size", type=int, default=60000, help="Bulk message size")
+    parser.add_argument("--batch", type=int, default=32, help="Bulk messages per batch")
+    args = parser.parse_args()
+
+    host = Host("127.0.0.1", 0)
+    port = host._socket.getsockname()[1]
+    threading.Thread(target=host.listen, daemon=True).start()
+    # Let server start listening
+    time.sleep(0.2)
+
+    sink = Client("127.0.0.1", port, b"sink")
+    sink.start()
+    client = Client("127.0.0.1", port, b"uploader")
+    client.start()
+
+    report("idle", [client.ping() for _ in range(args.pings)])
+
+    running = True
+    uploaded = 0
+
+    def drain():
+        while running:
+            sink.receive_all([])
+
+    def upload():
+        nonlocal uploaded
+        # Incompressible payload, so compression doesn't shrink the transfer
+        message = os.urandom(args.size)
+
+        while running:
+            client.send_messages(b"sink", [message] * args.batch)
+            uploaded += args.size * args.batch
+
+    threads = [threading.Thread(target=drain), threading.Thread(target=upload)]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(0.2)
+    start = time.perf_counter()
+    samples = [client.ping() for _ in range(args.pings)]
+    elapsed = time.perf_counter() - start
+
+    running = False
+    for thread in threads:
+        thread.join()
+
+    report("bulk", samples)
+    print(f"bulk throughput {uploaded / elapsed / 2**20:.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Markdown parser speed on regular and pathological input, compared with
+the previous recursive parser. Also checks that both produce identical trees.
+
+Run with:
+    python -m benchmarks.markdown
+"""
+
+from argparse import ArgumentParser
+import random
+import time
+
+from components import Component, Text, Row, Bold, Italic, Underline, Colored
+from md import _parse
+
+
+INPUTS = {
+    "chat": lambda n: "**hey** are you [online](green)? *ping me* " * (n // 40),
+    "stars": lambda n: "*" * n,
+    "star pairs": lambda n: "*a" + "**" * (n // 2),
+    "brackets": lambda n: "[" * n,
+    "open links": lambda n: "[a](" * (n // 4),
+    "nested links": lambda n: "[" * (n // 9) + "a" + "](red)" * (n // 9),
+    "underscores": lambda n: "_a" * (n // 2),
+}
+
+
+# Parser as it was before single-pass rewrite, kept as reference
+def legacy_parse(text: str) -> list[Component]:
+    parts: list[Component] = []
+    buf = ""
+    i = 0
+
+    while i < len(text):
+
+        # Bold: **...**
+        if text[i:i+2] == "**":
+            if buf:
+                parts.append(Text(buf))
+                buf = ""
+            end = text.find("**", i + 2)
+            if end == -1:
+                buf += "**"
+                i += 2
+            else:
+                parts.append(Bold(*legacy_parse(text[i+2:end])))
+                i = end + 2
+
+        # Underline: __...__
+        elif text[i:i+2] == "__":
+            if buf:
+                parts.append(Text(buf))
+                buf = ""
+            end = text.find("__", i + 2)
+            if end == -1:
+                buf += "__"
+                i += 2
+            else:
+                parts.append(Underline(*legacy_parse(text[i+2:end])))
+                i = end + 2
+
+        # Italic: *...* (не **...**)
+        elif text[i] == "*":
+            if buf:
+                parts.append(Text(buf))
+                buf = ""
+            j = i + 1
+            end = -1
+            while j < len(text):
+                if text[j] == "*" and text[j:j+2] != "**":
+                    end = j
+                    break
+                j += 1
+            if end == -1:
+                buf += "*"
+                i += 1
+            else:
+                parts.append(Italic(*legacy_parse(text[i+1:end])))
+                i = end + 1
+
+        # Colored: [text](color)
+        elif text[i] == "[":
+            close_bracket = text.find("](", i + 1)
+            if close_bracket == -1:
+                buf += "["
+                i += 1
+            else:
+                close_paren = text.find(")", close_bracket + 2)
+                if close_paren == -1:
+                    buf += "["
+                    i += 1
+                else:
+                    if buf:
+                        parts.append(Text(buf))
+                        buf = ""
+                    color = text[close_bracket + 2:close_paren]
+                    parts.append(Colored(color, *legacy_parse(text[i+1:close_bracket])))
+                    i = close_paren + 1
+
+        else:
+            buf += text[i]
+            i += 1
+
+    if buf:
+        parts.append(Text(buf))
+
+    return parts
+
+
+def tree(component: Component) -> tuple:
+    if isinstance(component, Text):
+        return ("text", component.text)
+
+    color = (component.color,) if isinstance(component, Colored) else ()
+    return (
+        type(component).__name__,
+        *color,
+        *(tree(child) for child in component.children),
+    )
+
+
+def check(rounds: int) -> None:
+    rng = random.Random(0)
+    alphabet = "*_[]()ab "
+
+    for _ in range(rounds):
+        text = "".join(
+            rng.choice(alphabet) for _ in range(rng.randrange(0, 48))
+        )
+        expected = [tree(part) for part in legacy_parse(text)]
+        actual = [tree(part) for part in _parse(text)]
+
+        if expected != actual:
+            raise AssertionError(f"Parsers disagree on {text!r}")
+
+    print(f"{rounds} random inputs parsed identically")
+
+
+def measure(parser, text: str) -> float:
+    start = time.perf_counter()
+    parser(text)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 4000, 16000]
+    )
+    parser.add_argument("--check", type=int, default=20000)
+    parser.add_argument(
+        "--legacy-limit",
+        type=int,
+        default=16000,
+        help="Skip legacy parser above this input size",
+    )
+    args = parser.parse_args()
+
+    check(args.check)
+
+    print(f"{'input':<13} {'size':>6} {'legacy ms':>10} {'single pass ms':>15}")
+
+    for name, make in INPUTS.items():
+        for size in args.sizes:
+            text = make(size)
+
+            legacy = "skipped"
+            if len(text) <= args.legacy_limit:
+                try:
+                    legacy = f"{measure(legacy_parse, text) * 1e3:.2f}"
+                except RecursionError:
+                    legacy = "recursion"
+
+            print(
+                f"{name:<13} {len(text):>6} {legacy:>10}"
+                f" {measure(_parse, text) * 1e3:>15.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Latency of a quiet session while noisy sessions flood the server,
+with and without rate limits
+
+Run with:
+    python -m benchmarks.noisy
+"""
+
+from argparse import ArgumentParser
+import multiprocessing
+import statistics
+import threading
+import time
+
+from src.ratelimit import RateLimits
+from src.client import Client
+from src.host import Host
+
+
+def serve(port: int, limits: RateLimits, ready):
+    host = Host("127.0.0.1", port, limits=limits)
+    threading.Timer(0.2, ready.set).start()
+    host.listen()
+
+
+def flood(port: int, number: int, stop):
+    client = Client("127.0.0.1", port, f"noisy-{number}".encode())
+    client.start()
+
+    sink = Client("127.0.0.1", port, f"sink-{number}".encode())
+    sink.start()
+
+    while not stop.is_set():
+        try:
+            client.send_messages(sink.name, [b"x" * 200] * 64)
+        except ValueError:
+            # Throttled
+            pass
+
+        if number == 0:
+            sink.receive_all([])
+
+
+def measure(port: int, limits: RateLimits, noisy: int, rounds: int):
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+
+    server = multiprocessing.Process(target=serve, args=(port, limits, ready))
+    server.start()
+    ready.wait()
+
+    quiet = Client("127.0.0.1", port, b"quiet")
+    quiet.start()
+    peer = Client("127.0.0.1", port, b"peer")
+    peer.start()
+
+    floods = [
+        multiprocessing.Process(target=flood, args=(port, number, stop))
+        for number in range(noisy)
+    ]
+    for process in floods:
+        process.start()
+
+    # Let noisy sessions connect and saturate the server
+    time.sleep(1)
+
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        quiet.send_message(b"peer", b"hello")
+        samples.append(time.perf_counter() - start)
+        time.sleep(0.005)
+
+    stop.set()
+    for process in floods:
+        process.join()
+    server.kill()
+    server.join()
+
+    label = "limited" if limits else "unlimited"
+    p99 = statistics.quantiles(samples, n=100, method="inclusive")[98]
+    print(
+        f"{noisy} noisy, {label:<9}"
+        f"  p50 {statistics.median(samples) * 1e3:7.2f} ms"
+        f"  p99 {p99 * 1e3:7.2f} ms"
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=6290)
+    parser.add_argument("--noisy", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=300)
+    parser.add_argument("--commands", type=float, default=500)
+    args = parser.parse_args()
+
+    measure(args.port, RateLimits(), 0, args.rounds)
+    measure(args.port + 1, RateLimits(), args.noisy, args.rounds)
+    measure(
+        args.port + 2,
+        RateLimits(session_commands=args.commands, name_commands=args.commands),
+        args.noisy,
+        args.rounds,
+    )
+
+
+if __name__ == "__main__":
+    main()
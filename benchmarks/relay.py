@@ -0,0 +1,82 @@
+"""
+Server CPU time per MB of message bodies relayed, with bodies sealed
+by the server and with end-to-end encrypted opaque bodies
+
+Run with:
+    python -m benchmarks.relay
+"""
+
+from argparse import ArgumentParser
+import multiprocessing
+import threading
+import time
+import os
+
+from src.client import Client
+from src.host import Host
+
+
+def serve(port: int, ready, stop, cpu):
+    host = Host("127.0.0.1", port)
+    threading.Thread(target=host.listen, daemon=True).start()
+    time.sleep(0.2)
+
+    # Startup isn't counted
+    start = time.process_time()
+    ready.set()
+
+    stop.wait()
+    cpu.put(time.process_time() - start)
+
+
+def measure(port: int, end_to_end: bool, size: int, count: int):
+    ready, stop = multiprocessing.Event(), multiprocessing.Event()
+    cpu = multiprocessing.Queue()
+
+    server = multiprocessing.Process(target=serve, args=(port, ready, stop, cpu))
+    server.start()
+    ready.wait()
+
+    sender = Client("127.0.0.1", port, b"sender", end_to_end=end_to_end)
+    sender.start()
+    receiver = Client("127.0.0.1", port, b"receiver", end_to_end=end_to_end)
+    receiver.start()
+
+    # Incompressible, like encrypted bodies are anyway
+    message = os.urandom(size)
+    received = 0
+
+    for _ in range(count):
+        sender.send_message(b"receiver", message)
+
+        messages, _ = receiver.receive_all([])
+        received += sum(len(message) for _, message in messages)
+
+    stop.set()
+    seconds = cpu.get()
+    server.join()
+
+    megabytes = received / 2**20
+    mode = "end-to-end" if end_to_end else "sealed"
+    print(
+        f"{mode:<10} {size:>6} B bodies"
+        f"  server CPU {seconds * 1e3 / megabytes:7.2f} ms/MB"
+        f"  ({megabytes:.1f} MB relayed)"
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=6310)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 16384, 60000])
+    parser.add_argument("--megabytes", type=float, default=32)
+    args = parser.parse_args()
+
+    for number, size in enumerate(args.sizes):
+        count = int(args.megabytes * 2**20 / size)
+        measure(args.port + 2 * number, False, size, count)
+        measure(args.port + 2 * number + 1, True, size, count)
+
+
+if __name__ == "__main__":
+    main()
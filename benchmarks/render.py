@@ -0,0 +1,58 @@
+"""
+Bytes written to terminal per incoming message: full messages box repaint
+against row-level diff with scroll region
+
+Run with:
+    python -m benchmarks.render
+"""
+
+from argparse import ArgumentParser
+import random
+
+from blessed import Terminal
+
+from components import Colored, Bold
+import terminal
+import window
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--width", type=int, default=120)
+    parser.add_argument("--height", type=int, default=40)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--kind", default="xterm-256color")
+    args = parser.parse_args()
+
+    term = Terminal(kind=args.kind, force_styling=True)
+    # Pin terminal size so results don't depend on where benchmark runs
+    type(term).width = property(lambda _: args.width)
+    type(term).height = property(lambda _: args.height)
+    terminal.use(term)
+
+    win = window.Window("sender")
+    win.open_conversation("receiver")
+    rng = random.Random(0)
+
+    full = diff = 0
+
+    for index in range(args.messages):
+        words = " ".join(
+            "word" * rng.randrange(1, 4) for _ in range(rng.randrange(1, 30))
+        )
+        win.add_message(
+            Colored("orange", "receiver") + ": " + Bold(f"#{index} ") + words
+        )
+
+        rows = win.render_message_rows()
+        full += len(term.move_xy(0, 1) + "".join(rows))
+        diff += len(win.update_rows(rows))
+        win._screen = rows
+
+    print(f"terminal {args.width}x{args.height}, {args.messages} messages")
+    print(f"full repaint {full / args.messages:10.0f} B/message")
+    print(f"row diff     {diff / args.messages:10.0f} B/message")
+
+
+if __name__ == "__main__":
+    main()
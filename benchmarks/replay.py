@@ -0,0 +1,196 @@
+"""
+Replay traffic trace recorded with ``server.py --capture`` against a local
+server, keeping time between commands of every connection, or faster
+
+Every traced connection is a Client in its own thread named after its
+name number, messages are random bytes of recorded size. Commands clients
+send by themselves - negotiation, key publishing and lookup - aren't
+replayed separately. All clients connect before replay starts and, at
+max speed, disconnect after it ends, so replay running ahead of trace
+doesn't find receivers missing
+
+Run with:
+    python -m benchmarks.replay trace.bin --speed 10
+"""
+
+from argparse import ArgumentParser
+import collections
+import statistics
+import threading
+import time
+import os
+
+from src.commands import Commands
+from src.client import Client
+from src.host import Host
+from src import capture
+
+# Sent by Client itself as part of other commands
+AUTOMATIC = (Commands.negotiate, Commands.publish_key, Commands.get_key)
+
+
+def name(number: int) -> bytes:
+    return f"user-{number}".encode()
+
+
+def percentiles(samples: list[float]) -> str:
+    if not samples:
+        return " " * 30
+
+    p99 = (
+        statistics.quantiles(samples, n=100, method="inclusive")[98]
+        if len(samples) > 1
+        else samples[0]
+    )
+    return (
+        f"  p50 {statistics.median(samples) * 1e3:8.2f} ms"
+        f"  p99 {p99 * 1e3:8.2f} ms"
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("trace")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="1 replays in real time, 10 ten times faster, 0 as fast as possible",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="Replay against server already running on this port",
+    )
+    args = parser.parse_args()
+
+    connections: dict[int, list[capture.Record]] = collections.defaultdict(list)
+    for record in capture.read(args.trace):
+        connections[record.connection].append(record)
+
+    port = args.port
+    if port is None:
+        host = Host("127.0.0.1", 0)
+        port = host._socket.getsockname()[1]
+        threading.Thread(target=host.listen, daemon=True).start()
+        # Let server start listening
+        time.sleep(0.2)
+
+    sizes = (record.size for records in connections.values() for record in records)
+    message = os.urandom(max(sizes, default=0))
+
+    latencies: dict[str, list[float]] = collections.defaultdict(list)
+    errors: collections.Counter[str] = collections.Counter()
+    # Seconds commands were sent after their time in trace
+    lag: list[float] = []
+
+    def wait(at: float):
+        if args.speed > 0:
+            late = time.perf_counter() - (start + at / args.speed)
+
+            if late < 0:
+                time.sleep(-late)
+            else:
+                lag.append(late)
+
+    def execute(client: Client, record: capture.Record):
+        peer = name(record.peer)
+
+        match record.command:
+            case Commands.ping:
+                client.ping()
+            case Commands.send_message | Commands.relay:
+                client.send_message(peer, message[: record.size])
+            case Commands.receive_messages:
+                client.receive_messages(peer)
+            case Commands.receive_all:
+                client.receive_all([])
+            case Commands.reset_keys:
+                client.refresh_key()
+            case Commands.search:
+                client.search(peer, "word")
+
+    def replay(client: Client, records: list[capture.Record]):
+        for record in records:
+            if record.kind == capture.DISCONNECT and args.speed > 0:
+                wait(record.time)
+                client.stop()
+
+            if record.kind != capture.COMMAND or record.command in AUTOMATIC:
+                continue
+
+            wait(record.time)
+
+            sent = time.perf_counter()
+            try:
+                execute(client, record)
+            except ValueError:
+                errors[record.command] += 1
+                continue
+
+            latencies[record.command].append(time.perf_counter() - sent)
+
+    clients = []
+    threads = []
+
+    start = time.perf_counter()
+    for records in connections.values():
+        online = next((r for r in records if r.kind == capture.ONLINE), None)
+
+        # Handshake of this connection never completed
+        if online is None:
+            continue
+
+        client = Client(
+            "127.0.0.1",
+            port,
+            name(online.peer),
+            end_to_end=any(r.command == Commands.publish_key for r in records),
+        )
+        client.start()
+        clients.append(client)
+        threads.append(threading.Thread(target=replay, args=(client, records)))
+    print(f"{len(threads)} handshakes in {time.perf_counter() - start:.2f} s")
+
+    # Trace time of the first command is replay start
+    first = min(
+        (
+            record.time
+            for records in connections.values()
+            for record in records
+            if record.kind == capture.COMMAND
+        ),
+        default=0.0,
+    )
+    start = time.perf_counter() - first / args.speed if args.speed > 0 else 0.0
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    for client in clients:
+        client.stop()
+
+    last = max((records[-1].time for records in connections.values()), default=0.0)
+    commands = sum(len(samples) for samples in latencies.values())
+    print(
+        f"{len(connections)} connections, {commands} commands"
+        f"  in {elapsed:.2f} s (traced {last - first:.2f} s)"
+        f"  {commands / elapsed:8.0f} commands/s"
+    )
+    if lag:
+        print(f"behind trace{percentiles(lag)}  max {max(lag) * 1e3:8.2f} ms")
+
+    for command in sorted(latencies.keys() | errors.keys()):
+        samples = latencies[command]
+        print(
+            f"{command:>12} {len(samples):8}"
+            f"{percentiles(samples)}  errors {errors[command]}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Message latency while session keys are rotated in-band
+
+Run with:
+    python -m benchmarks.rotation
+"""
+
+from argparse import ArgumentParser
+import statistics
+import threading
+import time
+
+from src.client import Client
+from src.host import Host
+
+
+def measure(port: int, name: str, rotate_interval: float | None, rounds: int):
+    sender = Client("127.0.0.1", port, name.encode(), rotate_interval)
+    sender.start()
+
+    samples = []
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        sender.send_message(b"sink", b"x" * 64)
+        samples.append(time.perf_counter() - start)
+
+    sender.stop()
+
+    label = "off" if rotate_interval is None else f"{rotate_interval * 1e3:g} ms"
+    p99 = statistics.quantiles(samples, n=100, method="inclusive")[98]
+    print(
+        f"rotation {label:>8}"
+        f"  p50 {statistics.median(samples) * 1e6:8.1f} us"
+        f"  p99 {p99 * 1e6:8.1f} us"
+        f"  max {max(samples) * 1e6:8.1f} us"
+        f"  {rounds / sum(samples):8.0f} msg/s"
+        f"  epoch {sender._epoch}"
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=3000)
+    parser.add_argument(
+        "--intervals",
+        type=float,
+        nargs="+",
+        default=[0.1, 0.01, 0.0],
+        help="Rotation intervals in seconds to measure besides no rotation",
+    )
+    args = parser.parse_args()
+
+    host = Host("127.0.0.1", 0)
+    port = host._socket.getsockname()[1]
+    threading.Thread(target=host.listen, daemon=True).start()
+    # Let server start listening
+    time.sleep(0.2)
+
+    sink = Client("127.0.0.1", port, b"sink")
+    sink.start()
+
+    measure(port, "sender-off", None, args.rounds)
+
+    for number, interval in enumerate(args.intervals):
+        measure(port, f"sender-{number}", interval, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
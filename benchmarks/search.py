@@ -0,0 +1,98 @@
+"""
+History search: indexing throughput and query latency in a large conversation
+
+Run with:
+    python -m benchmarks.search --messages 1000000
+"""
+
+from argparse import ArgumentParser
+import statistics
+import tempfile
+import random
+import time
+import os
+
+from src.search import SearchIndex
+from src import segments
+
+WORDS = [f"word{number}" for number in range(5000)]
+
+QUERIES = {
+    "common": "word1",
+    "rare": "word3000",
+    "two words": "word1 word2",
+    "missing": "nothing",
+}
+
+
+def message(rng: random.Random) -> bytes:
+    # Zipf-like vocabulary - a few words are in most messages
+    words = [
+        WORDS[min(int(rng.paretovariate(1.0)) - 1, len(WORDS) - 1)] for _ in range(12)
+    ]
+    return segments.encode(
+        [
+            segments.Segment(
+                text=" ".join(words),
+                bold=False,
+                italic=False,
+                underline=False,
+                color=None,
+            )
+        ]
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--batch", type=int, default=1000, help="Messages per commit")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = SearchIndex(os.path.join(directory, "search.db"))
+
+        start = time.perf_counter()
+        for number in range(args.messages):
+            index.add(b"alice", b"bob", message(rng), number)
+
+            if index.pending >= args.batch:
+                index.commit()
+        index.commit()
+        elapsed = time.perf_counter() - start
+
+        # Committed pages stay in write-ahead log until checkpoint moves them
+        index._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(os.path.join(directory, "search.db"))
+        print(
+            f"indexed {args.messages} messages  {args.messages / elapsed:8.0f} msg/s"
+            f"  {size / args.messages:6.0f} B/msg on disk"
+        )
+
+        for label, query in QUERIES.items():
+            samples = []
+            before = None
+
+            # Every round fetches next page, so deep pages are measured too
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                hits = index.search(b"bob", b"alice", query, before)
+                samples.append(time.perf_counter() - start)
+
+                before = hits[-1]["id"] if hits else None
+
+            p99 = statistics.quantiles(samples, n=100, method="inclusive")[98]
+            print(
+                f"{label:>10}"
+                f"  p50 {statistics.median(samples) * 1e3:8.2f} ms"
+                f"  p99 {p99 * 1e3:8.2f} ms"
+            )
+
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Encode/decode speed and size of rich-text messages: legacy JSON against binary segments
+
+Run with:
+    python -m benchmarks.segments
+"""
+
+from argparse import ArgumentParser
+import timeit
+
+from components import serialize, deserialize
+from md import parse as parse_md
+from src import segments
+
+
+MESSAGES = {
+    "plain": "ok, see you tomorrow",
+    "styled": "**hey** are you [online](green)? *ping me*",
+    "heavy": " ".join(
+        f"[**word{i}**](red) *it{i}* __u{i}__ plain{i}" for i in range(20)
+    ),
+    "long": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40,
+}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(
+        f"{'message':<8} {'format':<6} {'bytes':>7}"
+        f" {'encode us':>10} {'decode us':>10} {'wire decode us':>15}"
+    )
+
+    for name, source in MESSAGES.items():
+        component = parse_md(source)
+
+        for label, version in (("json", segments.JSON), ("binary", segments.BINARY)):
+            data = serialize(component, version)
+
+            encode = timeit.timeit(
+                lambda: serialize(component, version), number=args.number
+            )
+            decode = timeit.timeit(lambda: deserialize(data), number=args.number)
+            wire = timeit.timeit(lambda: segments.decode(data), number=args.number)
+
+            print(
+                f"{name:<8} {label:<6} {len(data):>7}"
+                f" {encode / args.number * 1e6:>10.2f}"
+                f" {decode / args.number * 1e6:>10.2f}"
+                f" {wire / args.number * 1e6:>15.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Server memory kept per idle online session
+
+Sessions are driven through the real handshake over fake sockets, so only
+state the server allocates is measured - socket objects and kernel buffers
+are left out.
+
+Run with:
+    python -m benchmarks.sessions
+"""
+
+from argparse import ArgumentParser
+import selectors
+import time
+import tracemalloc
+
+from src.host import Host
+from src import util
+
+
+class FakeSocket:
+    """Stands in for accepted connection, swallows everything written"""
+
+    def __init__(self, fd: int):
+        self._fd = fd
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def setblocking(self, flag: bool):
+        pass
+
+    def send(self, data) -> int:
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def measure(count: int):
+    # Fake descriptors can't be registered with epoll
+    host = Host("127.0.0.1", None, selector=selectors.SelectSelector())
+
+    # One client key for all sessions - server side keys still differ
+    private = util.x25519_private_key()
+    public = util.x25519_public_key_to_bytes(private.public_key())
+
+    sockets = [FakeSocket(fd) for fd in range(1_000_000, 1_000_000 + count)]
+    names = [f"idle-{number}".encode() for number in range(count)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+
+    for number, (sock, name) in enumerate(zip(sockets, names)):
+        address = ("127.0.0.1", number)
+        host.connect(sock, address)
+
+        server_key = host.clients[address].private_key.public_key()
+        key, iv = util.derive_symmetric_keys(private.exchange(server_key))
+
+        host.handle_client(address, public)
+        host.handle_client(address, util.aes_encrypt(key, iv, name))
+
+        host.flush(address)
+
+    elapsed = time.perf_counter() - start
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    online = sum(1 for session in host.clients.values() if session.name is not None)
+    assert online == count, f"{online} of {count} sessions went online"
+
+    print(
+        f"{count:>8} sessions"
+        f"  {used / count:8.0f} B/session"
+        f"  {used / 2**20:8.1f} MiB total"
+        f"  handshakes {count / elapsed:8.0f}/s"
+    )
+
+    host.clients.clear()
+    host.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--counts",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000],
+        help="Numbers of idle sessions to measure",
+    )
+    args = parser.parse_args()
+
+    for count in args.counts:
+        measure(count)
+
+
+if __name__ == "__main__":
+    main()
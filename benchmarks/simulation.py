@@ -0,0 +1,67 @@
+"""
+Server logic throughput without sockets: thousands of simulated clients
+in one process over the in-memory transport, same run every time
+
+Run with:
+    python -m benchmarks.simulation --clients 5000
+"""
+
+from argparse import ArgumentParser
+import random
+import time
+
+from src.simulation import Simulation
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument(
+        "--messages", type=int, default=20, help="Messages every client sends"
+    )
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sim = Simulation()
+
+    start = time.perf_counter()
+    peers = [sim.connect(f"client-{number}".encode()) for number in range(args.clients)]
+    sim.run()
+    elapsed = time.perf_counter() - start
+
+    assert all(peer.online for peer in peers)
+    print(f"handshakes    {args.clients / elapsed:10.0f}/s")
+
+    message = b"x" * args.size
+
+    for peer in peers:
+        for _ in range(args.messages):
+            peer.send_message(rng.choice(peers).name, message)
+
+    start = time.perf_counter()
+    sim.run()
+    elapsed = time.perf_counter() - start
+
+    sent = args.clients * args.messages
+    print(f"send_message  {sent / elapsed:10.0f}/s")
+
+    for peer in peers:
+        peer.replies.clear()
+        peer.receive_all([])
+
+    start = time.perf_counter()
+    sim.run()
+    elapsed = time.perf_counter() - start
+
+    delivered = sum(len(peer.replies) - 2 for peer in peers)
+    assert delivered == sent, f"{delivered} of {sent} messages delivered"
+    print(
+        f"receive_all   {args.clients / elapsed:10.0f}/s"
+        f"  {delivered / elapsed:10.0f} msg/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
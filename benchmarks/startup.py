@@ -0,0 +1,120 @@
+"""
+Startup cost: import time of server and chat client modules measured
+with ``-X importtime``, and time until chat client shows its first prompt
+
+Run with:
+    python -m benchmarks.startup --runs 10
+"""
+
+from argparse import ArgumentParser
+import statistics
+import subprocess
+import time
+import sys
+import os
+
+# Chat client should ask for host within this many seconds after start
+TARGET_FIRST_PROMPT = 0.15
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules server must not import
+TUI_MODULES = ("blessed", "components", "window", "terminal")
+
+
+def import_times(statement: str) -> list[tuple[str, int, int, int]]:
+    """:return: (module, depth, self us, cumulative us) of every import"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        own, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), depth, int(own), int(cumulative)))
+
+    return times
+
+
+def first_prompt() -> float:
+    """Seconds from chat client start until it asks for host"""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "client.py"],
+        cwd=ROOT,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+    output = b""
+    while b"Host" not in output:
+        chunk = process.stdout.read1(1024)
+
+        if not chunk:
+            raise RuntimeError("Chat client exited before asking for host")
+
+        output += chunk
+
+    elapsed = time.perf_counter() - start
+    process.kill()
+    process.wait()
+    return elapsed
+
+
+def report(label: str, statement: str, runs: int, top: int):
+    samples = []
+
+    for _ in range(runs):
+        times = import_times(statement)
+        samples.append(sum(total for _, depth, _, total in times if not depth))
+
+    print(f"{label:<8} imports  p50 {statistics.median(samples) / 1e3:8.1f} ms")
+
+    # Self time of every package, summed over its modules
+    packages: dict[str, int] = {}
+    for name, _, own, _ in times:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + own
+
+    for package, own in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"    {package:<24} {own / 1e3:8.1f} ms")
+
+    return {name for name, *_ in times}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="Slowest packages shown")
+    args = parser.parse_args()
+
+    server = report("server", "import src.host", args.runs, args.top)
+    tui = sorted(name for name in server if name.split(".")[0] in TUI_MODULES)
+    print(f"    TUI modules imported by server: {', '.join(tui) or 'none'}")
+
+    report(
+        "client",
+        "import terminal, window, md, src.client",
+        args.runs,
+        args.top,
+    )
+
+    prompt = statistics.median(first_prompt() for _ in range(args.runs))
+    print(
+        f"first prompt  {prompt * 1e3:8.1f} ms"
+        f"  (target {TARGET_FIRST_PROMPT * 1e3:.0f} ms"
+        f"{', over' if prompt > TARGET_FIRST_PROMPT else ''})"
+    )
+
+
+if __name__ == "__main__":
+    main()
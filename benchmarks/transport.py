@@ -0,0 +1,90 @@
+"""
+Round-trip latency and throughput of KMessenger framing over TCP loopback and unix domain socket
+
+Run with:
+    python -m benchmarks.transport
+"""
+
+from argparse import ArgumentParser
+import statistics
+import threading
+import tempfile
+import time
+import os
+
+from src import transport
+from src import util
+
+
+def echo(listener):
+    sock, _ = listener.accept()
+
+    while (event := util.wait_event(sock)).data:
+        util.send_message(sock, event.data)
+
+    sock.close()
+
+
+def measure(name: str, listener, connect, rounds: int, sizes: list[int]):
+    listener.listen(1)
+    thread = threading.Thread(target=echo, args=(listener,), daemon=True)
+    thread.start()
+
+    sock = connect()
+
+    for size in sizes:
+        payload = os.urandom(size)
+        samples = []
+
+        for _ in range(rounds):
+            start = time.perf_counter()
+            util.send_message(sock, payload)
+            util.wait_event(sock)
+            samples.append(time.perf_counter() - start)
+
+        total = sum(samples)
+        p99 = statistics.quantiles(samples, n=100, method="inclusive")[98]
+        print(
+            f"{name:<4} {size:>7} B"
+            f"  p50 {statistics.median(samples) * 1e6:8.1f} us"
+            f"  p99 {p99 * 1e6:8.1f} us"
+            f"  {rounds / total:10.0f} msg/s"
+            f"  {size * rounds * 2 / total / 2**20:8.1f} MiB/s"
+        )
+
+    sock.close()
+    thread.join()
+    listener.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5000)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[16, 256, 4096, 65536]
+    )
+    args = parser.parse_args()
+
+    tcp = transport.tcp_listener("127.0.0.1", 0)
+    port = tcp.getsockname()[1]
+    measure(
+        "tcp",
+        tcp,
+        lambda: transport.tcp_connection("127.0.0.1", port),
+        args.rounds,
+        args.sizes,
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kmessenger.sock")
+        measure(
+            "uds",
+            transport.unix_listener(path),
+            lambda: transport.unix_connection(path),
+            args.rounds,
+            args.sizes,
+        )
+
+
+if __name__ == "__main__":
+    main()
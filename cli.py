@@ -0,0 +1,152 @@
+"""
+Headless KMessenger client for scripts and pipelines.
+
+Send every line of stdin as a message:
+    some-command | python cli.py send --name bot --receiver alice
+
+Print incoming messages as JSON lines:
+    python cli.py receive --name bot
+
+Doesn't import terminal UI, messages are sent as plain text.
+"""
+
+from argparse import ArgumentParser
+import json
+import time
+import sys
+import os
+
+from src.client import Client
+from src import segments
+
+
+# Most messages sent in one batch
+BATCH_SIZE = 256
+# Longest message that fits into send_message command
+MAX_MESSAGE = 0xFFFF
+
+
+def encode(text: str) -> bytes:
+    return segments.encode(
+        [
+            segments.Segment(
+                text=text, bold=False, italic=False, underline=False, color=None
+            )
+        ]
+    )
+
+
+def read_batches(fd: int, batch_size: int):
+    """
+    Yield lists of stdin lines. Every read returns what is available
+    at the moment, so bulk input is batched and slow input is sent at once
+    """
+    buffer = b""
+
+    while chunk := os.read(fd, 65536):
+        *lines, buffer = (buffer + chunk).split(b"\n")
+
+        for start in range(0, len(lines), batch_size):
+            yield [
+                line.decode(errors="replace")
+                for line in lines[start : start + batch_size]
+            ]
+
+    if buffer:
+        yield [buffer.decode(errors="replace")]
+
+
+def send(client: Client, receiver: bytes, batch_size: int, ttl: float | None):
+    for lines in read_batches(sys.stdin.fileno(), batch_size):
+        messages = []
+
+        for line in lines:
+            message = encode(line)
+
+            if len(message) > MAX_MESSAGE:
+                print(
+                    f"Skipped line longer than {MAX_MESSAGE} bytes", file=sys.stderr
+                )
+                continue
+
+            messages.append(message)
+
+        if messages:
+            client.send_messages(receiver, messages, ttl)
+
+
+def receive(client: Client, peers: list[bytes], interval: float):
+    while True:
+        messages, presence = client.receive_all(peers)
+
+        for sender, message in messages:
+            parts = segments.decode(message)
+            print(
+                json.dumps(
+                    {
+                        "from": sender.decode(errors="replace"),
+                        "text": "".join(part["text"] for part in parts),
+                        "segments": parts,
+                    },
+                    ensure_ascii=False,
+                ),
+                flush=True,
+            )
+
+        if not messages:
+            time.sleep(interval)
+
+
+def main():
+    parser = ArgumentParser(description="Headless KMessenger client")
+    parser.add_argument("mode", choices=["send", "receive"])
+    parser.add_argument(
+        "--host",
+        default="localhost",
+        help="Server host, or unix:<path> for unix domain socket",
+    )
+    parser.add_argument("--port", type=int, default=6074)
+    parser.add_argument("--name", required=True)
+    parser.add_argument(
+        "--receiver",
+        action="append",
+        default=[],
+        help="Receiver of sent messages. In receive mode - peers to report",
+    )
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=None,
+        help="Seconds sent messages are kept for if receiver doesn't read them",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.1,
+        help="Delay between polls when there are no new messages",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "send" and len(args.receiver) != 1:
+        parser.error("send mode requires exactly one --receiver")
+
+    client = Client(args.host, args.port, args.name.encode())
+    client.start()
+
+    try:
+        if args.mode == "send":
+            send(client, args.receiver[0].encode(), args.batch, args.ttl)
+        else:
+            receive(client, [peer.encode() for peer in args.receiver], args.interval)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,14 @@ from threading import Lock
 import threading
 import time
 
-import blessed
-
 from src.client import Client
 
 from window import Window, fill_message
 from components import Colored, Bold, Italic, Underline, Text, serialize, deserialize
 from md import parse as parse_md
+from terminal import t
 import util
 
-t = blessed.Terminal()
-
 messages_box_height = t.height - 1
 
 if messages_box_height < 8:
@@ -33,13 +30,22 @@ user_name = util.prompt_name(t.cyan("Name") + ": " + t.yellow)
 
 user = user_name.encode()
 
-receiver_name = util.prompt_name(t.violet("Receiver") + ": " + t.yellow)
-
-receiver = receiver_name.encode()
+receiver_names = [
+    name.strip()
+    for name in util.prompt_name(
+        t.violet("Receivers") + " (comma separated): " + t.yellow
+    ).split(",")
+    if name.strip()
+]
 
 print(t.reset, end="")
 
-client = Client(host, port, user)
+# Keys are rotated in-band every 15 minutes, message bodies are encrypted
+# end-to-end to peers that support it. Lost connection is restored
+# in background, messages typed meanwhile are sent once it is back
+client = Client(
+    host, port, user, rotate_interval=15 * 60, end_to_end=True, reconnect=True
+)
 
 y, x = t.get_location()
 with t.location(x, y):
@@ -49,29 +55,52 @@ client.start()
 
 print(t.green("Started"), t.move_right)
 
-window = Window(t.cyan(user_name), t.orange(receiver_name), False)
+window = Window(t.cyan(user_name))
+
+for name in receiver_names:
+    window.open_conversation(name)
 
 lock = Lock()
 
 
 def messages_lookup():
+    """
+    Single receive loop for all conversations: one request fetches
+    pending messages from everyone and online status of open conversations
+    """
     while threading.main_thread().is_alive():
         time.sleep(0.1)
 
-        try:
-            recv = client.receive_messages(receiver)
+        peers = list(window.conversations)
 
-            if not window.receiver_online:
-                window.receiver_online = True
+        try:
+            recv, presence = client.receive_all([peer.encode() for peer in peers])
+        except ValueError:
+            continue
+        except ConnectionError:
+            # Client was stopped while waiting for connection to come back
+            break
+
+        for peer, online in presence.items():
+            window.set_online(peer.decode(), online)
+
+        for sender, message in recv:
+            sender_name = sender.decode()
+            window.add_message(
+                Colored("orange", sender_name) + ": " + deserialize(message),
+                sender_name,
+            )
 
-            for message in recv:
-                window.messages.append(
-                    Colored("orange", receiver_name) + ": " + deserialize(message)
-                )
-        except ValueError as e:
-            if e.args[0] == "No sender":
-                window.receiver_online = False
-                continue
+        # Messages typed while offline that server refused once sent
+        while client.undelivered:
+            receiver, message = client.undelivered.popleft()
+            receiver_name = receiver.decode()
+            window.add_message(
+                Colored("darkred", "Not delivered")
+                + ": "
+                + deserialize(message),
+                receiver_name,
+            )
 
     client.stop()
 
@@ -83,28 +112,79 @@ window.non_blocking_draw()
 
 
 COMMANDS = {
+    "open <name>": "Open conversation with user and switch to it",
+    "switch <name>": "Switch to open conversation (Tab cycles conversations)",
+    "close [name]": "Close conversation, current one by default",
     "refreshkey": "Refresh encryption keys with the server",
+    "search <words>": "Search history of current conversation on the server",
     "help": "Show available commands",
 }
 
 
 def handle_command(command: str):
+    command, _, argument = command.partition(" ")
+    argument = argument.strip()
+
     match command:
+        case "open" | "switch" if argument:
+            if command == "open":
+                window.open_conversation(argument)
+
+            if argument not in window.conversations:
+                window.add_message(
+                    Colored("darkred", "No open conversation with ")
+                    + Colored("red", argument)
+                )
+                return
+
+            window.switch_conversation(argument)
+
+        case "close":
+            if len(window.conversations) == 1:
+                window.add_message(
+                    Colored("darkred", "Cannot close the last conversation")
+                )
+                return
+
+            window.close_conversation(argument or window.active.name)
+
         case "refreshkey":
             try:
                 client.refresh_key()
-                window.messages.append(Colored("cyan", "Keys refreshed successfully"))
+                window.add_message(Colored("cyan", "Keys refreshed successfully"))
+            except ValueError as e:
+                window.add_message(Colored("darkred", "Error") + ": " + Colored("red", str(e)))
+
+        case "search" if argument:
+            try:
+                hits = client.search(window.active.name.encode(), argument)
             except ValueError as e:
-                window.messages.append(Colored("darkred", "Error") + ": " + Colored("red", str(e)))
+                window.add_message(
+                    Colored("darkred", "Error") + ": " + Colored("red", str(e))
+                )
+                return
+
+            if not hits:
+                window.add_message(Colored("yellow", "Nothing found"))
+
+            for hit in reversed(hits):
+                sent = time.strftime("%d.%m %H:%M", time.localtime(hit["time"]))
+                window.add_message(
+                    Colored("cyan", sent)
+                    + " "
+                    + Colored("orange", hit["sender"].decode())
+                    + ": "
+                    + Italic(Text(hit["snippet"]))
+                )
 
         case "help":
             for name, description in COMMANDS.items():
-                window.messages.append(
+                window.add_message(
                     Colored("cyan", f"/{name}") + " — " + Colored("yellow", description)
                 )
 
         case _:
-            window.messages.append(
+            window.add_message(
                 Colored("darkred", "Unknown command: ")
                 + Colored("red", f"/{command}")
                 + Colored("darkred", ". Type /help to see available commands.")
@@ -116,6 +196,7 @@ while True:
         message = window.input()
     except KeyboardInterrupt:
         window.stop()
+        client.stop()
         util.print(t.move_xy(0, t.height) + t.green(fill_message("Goodbye!")))
         time.sleep(0.5)
         exit()
@@ -124,11 +205,22 @@ while True:
         handle_command(message[1:].strip())
         continue
 
+    receiver_name = window.active.name
+
     try:
         parsed = parse_md(message)
-        client.send_message(receiver, serialize(parsed))
-        window.messages.append(Colored("green", "You") + ": " + parsed)
+
+        if client.send_message(receiver_name.encode(), serialize(parsed)):
+            window.add_message(Colored("green", "You") + ": " + parsed, receiver_name)
+        else:
+            window.add_message(
+                Colored("yellow", "You (offline, queued)") + ": " + parsed,
+                receiver_name,
+            )
     except ValueError as e:
-        window.messages.append(Colored("darkred", "Error") + ": " + Colored("red", e.args[0]))
+        window.add_message(
+            Colored("darkred", "Error") + ": " + Colored("red", e.args[0]),
+            receiver_name,
+        )
         if e.args[0] == "No receiver":
-            window.receiver_online = False
+            window.set_online(receiver_name, False)
@@ -1,7 +1,37 @@
-import json
-from blessed import Terminal
+from __future__ import annotations
 
-t = Terminal()
+import typing
+
+from src import segments as wire
+from terminal import t
+
+
+class Span(typing.NamedTuple):
+    text: str
+    bold: bool = False
+    italic: bool = False
+    underline: bool = False
+    color: str | None = None
+
+
+# Escape sequence that turns on style, by (bold, italic, underline, color)
+_style_sequences: dict[tuple[bool, bool, bool, str | None], str] = {}
+
+
+def _style_sequence(bold: bool, italic: bool, underline: bool, color: str | None) -> str:
+    key = (bold, italic, underline, color)
+    sequence = _style_sequences.get(key)
+
+    if sequence is None:
+        sequence = (
+            (str(t.bold) if bold else "")
+            + (str(t.italic) if italic else "")
+            + (str(t.underline) if underline else "")
+            + (str(getattr(t, color)) if color else "")
+        )
+        _style_sequences[key] = sequence
+
+    return sequence
 
 
 def _wrap(value: str | Component) -> Component:
@@ -9,9 +39,58 @@ def _wrap(value: str | Component) -> Component:
 
 
 class Component:
-    def render(self) -> str:
+    """
+    Immutable rich-text node.
+
+    Tree is flattened once into styled spans, rendered string and its
+    printable length are computed from spans on first use and cached.
+    """
+
+    __slots__ = ("_spans", "_rendered", "_length")
+
+    def __init__(self):
+        object.__setattr__(self, "_spans", None)
+        object.__setattr__(self, "_rendered", None)
+        object.__setattr__(self, "_length", None)
+
+    def __setattr__(self, name: str, value: typing.Any):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def _flatten(self) -> tuple[Span, ...]:
         raise NotImplementedError
 
+    @property
+    def spans(self) -> tuple[Span, ...]:
+        if self._spans is None:
+            object.__setattr__(self, "_spans", self._flatten())
+
+        return self._spans
+
+    @property
+    def plain(self) -> str:
+        return "".join(span.text for span in self.spans)
+
+    @property
+    def length(self) -> int:
+        """Printable length of rendered component"""
+        if self._length is None:
+            object.__setattr__(self, "_length", t.length(self.plain))
+
+        return self._length
+
+    def render(self) -> str:
+        if self._rendered is None:
+            normal = str(t.normal)
+            rendered = []
+
+            for text, bold, italic, underline, color in self.spans:
+                sequence = _style_sequence(bold, italic, underline, color)
+                rendered.append(sequence + text + normal if sequence else text)
+
+            object.__setattr__(self, "_rendered", "".join(rendered))
+
+        return self._rendered
+
     def __str__(self) -> str:
         return self.render()
 
@@ -23,101 +102,111 @@ class Component:
 
 
 class Text(Component):
+    __slots__ = ("text",)
+
     def __init__(self, text: str):
-        self.text = text
+        super().__init__()
+        object.__setattr__(self, "text", text)
 
-    def render(self) -> str:
-        return self.text
+    def _flatten(self) -> tuple[Span, ...]:
+        return (Span(self.text),)
 
 
 class Row(Component):
+    __slots__ = ("children",)
+
     def __init__(self, *children: Component | str):
-        self.children = [_wrap(c) for c in children]
+        super().__init__()
+        object.__setattr__(self, "children", tuple(_wrap(c) for c in children))
 
     def __add__(self, other: Component | str) -> Row:
         return Row(*self.children, _wrap(other))
 
-    def render(self) -> str:
-        return "".join(c.render() for c in self.children)
+    def __radd__(self, other: Component | str) -> Row:
+        return Row(_wrap(other), *self.children)
+
+    def _flatten(self) -> tuple[Span, ...]:
+        return tuple(span for child in self.children for span in child.spans)
 
 
 class Bold(Component):
+    __slots__ = ("children",)
+
     def __init__(self, *children: Component | str):
-        self.children = [_wrap(c) for c in children]
+        super().__init__()
+        object.__setattr__(self, "children", tuple(_wrap(c) for c in children))
 
-    def render(self) -> str:
-        return t.bold("".join(c.render() for c in self.children))
+    def _flatten(self) -> tuple[Span, ...]:
+        return tuple(
+            span._replace(bold=True)
+            for child in self.children
+            for span in child.spans
+        )
 
 
 class Italic(Component):
+    __slots__ = ("children",)
+
     def __init__(self, *children: Component | str):
-        self.children = [_wrap(c) for c in children]
+        super().__init__()
+        object.__setattr__(self, "children", tuple(_wrap(c) for c in children))
 
-    def render(self) -> str:
-        return t.italic("".join(c.render() for c in self.children))
+    def _flatten(self) -> tuple[Span, ...]:
+        return tuple(
+            span._replace(italic=True)
+            for child in self.children
+            for span in child.spans
+        )
 
 
 class Underline(Component):
+    __slots__ = ("children",)
+
     def __init__(self, *children: Component | str):
-        self.children = [_wrap(c) for c in children]
+        super().__init__()
+        object.__setattr__(self, "children", tuple(_wrap(c) for c in children))
 
-    def render(self) -> str:
-        return t.underline("".join(c.render() for c in self.children))
+    def _flatten(self) -> tuple[Span, ...]:
+        return tuple(
+            span._replace(underline=True)
+            for child in self.children
+            for span in child.spans
+        )
 
 
 class Colored(Component):
+    __slots__ = ("color", "children")
+
     def __init__(self, color: str, *children: Component | str):
-        self.color = color
-        self.children = [_wrap(c) for c in children]
+        super().__init__()
+        object.__setattr__(self, "color", color)
+        object.__setattr__(self, "children", tuple(_wrap(c) for c in children))
 
-    def render(self) -> str:
-        formatter = getattr(t, self.color)
-        return formatter("".join(c.render() for c in self.children))
-
-
-def _collect(component: Component, segments: list[dict], bold: bool, italic: bool, underline: bool, color: str | None):
-    if isinstance(component, Text):
-        segments.append({
-            "text": component.text,
-            "bold": bold,
-            "italic": italic,
-            "underline": underline,
-            "color": color,
-        })
-    elif isinstance(component, Row):
-        for child in component.children:
-            _collect(child, segments, bold, italic, underline, color)
-    elif isinstance(component, Bold):
-        for child in component.children:
-            _collect(child, segments, True, italic, underline, color)
-    elif isinstance(component, Italic):
-        for child in component.children:
-            _collect(child, segments, bold, True, underline, color)
-    elif isinstance(component, Underline):
-        for child in component.children:
-            _collect(child, segments, bold, italic, True, color)
-    elif isinstance(component, Colored):
-        for child in component.children:
-            _collect(child, segments, bold, italic, underline, component.color)
-
-
-def serialize(component: Component | str) -> bytes:
+    def _flatten(self) -> tuple[Span, ...]:
+        # Innermost color wins
+        return tuple(
+            span if span.color else span._replace(color=self.color)
+            for child in self.children
+            for span in child.spans
+        )
+
+
+def serialize(component: Component | str, version: int = wire.VERSION) -> bytes:
     if isinstance(component, str):
         component = Text(component)
-    segments: list[dict] = []
-    _collect(component, segments, bold=False, italic=False, underline=False, color=None)
-    return json.dumps(segments, ensure_ascii=False).encode()
+    segments = [wire.Segment(**span._asdict()) for span in component.spans]
+    return wire.encode(segments, version)
 
 
 def deserialize(data: bytes) -> Component:
-    segments: list[dict] = json.loads(data.decode())
+    segments = wire.decode(data)
     if not segments:
         return Text("")
     children = [_segment_to_component(s) for s in segments]
     return children[0] if len(children) == 1 else Row(*children)
 
 
-def _segment_to_component(segment: dict) -> Component:
+def _segment_to_component(segment: wire.Segment) -> Component:
     result: Component = Text(segment["text"])
     if segment.get("bold"):
         result = Bold(result)
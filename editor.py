@@ -0,0 +1,82 @@
+class GapBuffer:
+    """
+    Editable line of text with a gap at cursor position.
+
+    Inserting or deleting at cursor is O(1) amortized no matter how long
+    the line is, moving cursor costs only the distance moved.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self._buffer: list[str] = [""] * capacity
+        self._gap_start = 0
+        self._gap_end = capacity
+
+    def __len__(self) -> int:
+        return len(self._buffer) - (self._gap_end - self._gap_start)
+
+    def __str__(self) -> str:
+        return "".join(self._buffer[: self._gap_start]) + "".join(
+            self._buffer[self._gap_end :]
+        )
+
+    @property
+    def cursor(self) -> int:
+        return self._gap_start
+
+    def move(self, position: int):
+        position = max(0, min(position, len(self)))
+
+        if position < self._gap_start:
+            count = self._gap_start - position
+            self._buffer[self._gap_end - count : self._gap_end] = self._buffer[
+                position : self._gap_start
+            ]
+            self._gap_start -= count
+            self._gap_end -= count
+
+        elif position > self._gap_start:
+            count = position - self._gap_start
+            self._buffer[self._gap_start : position] = self._buffer[
+                self._gap_end : self._gap_end + count
+            ]
+            self._gap_start += count
+            self._gap_end += count
+
+    def insert(self, text: str):
+        if len(text) > self._gap_end - self._gap_start:
+            self._grow(len(text))
+
+        self._buffer[self._gap_start : self._gap_start + len(text)] = text
+        self._gap_start += len(text)
+
+    def delete_before(self, count: int = 1):
+        self._gap_start = max(0, self._gap_start - count)
+
+    def delete_after(self, count: int = 1):
+        self._gap_end = min(len(self._buffer), self._gap_end + count)
+
+    def slice(self, start: int, stop: int) -> str:
+        """Text between logical positions, without materializing whole line"""
+        gap = self._gap_end - self._gap_start
+
+        if stop <= self._gap_start:
+            return "".join(self._buffer[start:stop])
+
+        if start >= self._gap_start:
+            return "".join(self._buffer[start + gap : stop + gap])
+
+        return "".join(self._buffer[start : self._gap_start]) + "".join(
+            self._buffer[self._gap_end : stop + gap]
+        )
+
+    def clear(self):
+        self._gap_start = 0
+        self._gap_end = len(self._buffer)
+
+    def _grow(self, needed: int):
+        new_size = max(len(self._buffer) * 2, len(self) + needed + 64)
+        head = self._buffer[: self._gap_start]
+        tail = self._buffer[self._gap_end :]
+
+        self._buffer = head + [""] * (new_size - len(head) - len(tail)) + tail
+        self._gap_end = new_size - len(tail)
@@ -1,6 +1,15 @@
+import functools
+import typing
+import re
+
 from components import Component, Text, Row, Bold, Italic, Underline, Colored
 
 
+# Italic closes on "*" that is not followed by another "*"
+_ITALIC = re.compile(r"\*(?!\*)")
+_SPECIAL = re.compile(r"[*_\[]")
+
+
 def parse(text: str) -> Component:
     parts = _parse(text)
     if not parts:
@@ -10,82 +19,143 @@ def parse(text: str) -> Component:
     return Row(*parts)
 
 
+class _Marker:
+    """
+    Finds next occurrence of a marker at or after index.
+
+    Parser asks for markers at increasing indexes, so the last answer stays
+    valid until index passes it - text between is scanned only once.
+    Missing marker is reported as index past any slice end, so bound checks fail.
+    """
+
+    __slots__ = ("_find", "_start", "_found", "_missing")
+
+    def __init__(self, find: typing.Callable[[int], int], length: int):
+        self._find = find
+        self._missing = length + 2
+        self._start = 0
+        self._found = -1
+
+    def next(self, index: int) -> int:
+        if self._start <= index <= self._found:
+            return self._found
+
+        found = self._find(index)
+
+        self._start = index
+        self._found = self._missing if found == -1 else found
+        return self._found
+
+
+def _search(pattern: re.Pattern, text: str) -> typing.Callable[[int], int]:
+    def find(index: int) -> int:
+        match = pattern.search(text, index)
+        return -1 if match is None else match.start()
+
+    return find
+
+
 def _parse(text: str) -> list[Component]:
+    """
+    Single pass over text with explicit stack of open constructs.
+
+    Every construct is matched exactly like nested parsing of its inner slice
+    would do, but slice boundaries are tracked as indexes (``stop``) and
+    marker lookups never rescan text, so parsing is O(n) and deeply
+    nested input doesn't hit recursion limit.
+    """
+    length = len(text)
+    bold = _Marker(functools.partial(text.find, "**"), length)
+    underline = _Marker(functools.partial(text.find, "__"), length)
+    italic = _Marker(_search(_ITALIC, text), length)
+    link = _Marker(functools.partial(text.find, "]("), length)
+    paren = _Marker(functools.partial(text.find, ")"), length)
+
+    # Stack of (parent parts, parent stop, component factory, resume index)
+    stack: list[tuple[list[Component], int, typing.Callable, int]] = []
+
     parts: list[Component] = []
-    buf = ""
+    stop = length
     i = 0
+    # Pending plain text is always text[buf_start:i]
+    buf_start = 0
 
-    while i < len(text):
+    while True:
+        if i >= stop:
+            if buf_start < stop:
+                parts.append(Text(text[buf_start:stop]))
 
-        # Bold: **...**
-        if text[i:i+2] == "**":
-            if buf:
-                parts.append(Text(buf))
-                buf = ""
-            end = text.find("**", i + 2)
-            if end == -1:
-                buf += "**"
-                i += 2
-            else:
-                parts.append(Bold(*_parse(text[i+2:end])))
-                i = end + 2
-
-        # Underline: __...__
-        elif text[i:i+2] == "__":
-            if buf:
-                parts.append(Text(buf))
-                buf = ""
-            end = text.find("__", i + 2)
-            if end == -1:
-                buf += "__"
+            if not stack:
+                return parts
+
+            children = parts
+            parts, stop, factory, i = stack.pop()
+            parts.append(factory(*children))
+            buf_start = i
+            continue
+
+        char = text[i]
+
+        # Bold: **...**, Underline: __...__
+        if (char == "*" or char == "_") and i + 1 < stop and text[i + 1] == char:
+            if buf_start < i:
+                parts.append(Text(text[buf_start:i]))
+            buf_start = i
+
+            end = (bold if char == "*" else underline).next(i + 2)
+            if end + 2 > stop:
                 i += 2
-            else:
-                parts.append(Underline(*_parse(text[i+2:end])))
-                i = end + 2
-
-        # Italic: *...* (не **...**)
-        elif text[i] == "*":
-            if buf:
-                parts.append(Text(buf))
-                buf = ""
-            j = i + 1
-            end = -1
-            while j < len(text):
-                if text[j] == "*" and text[j:j+2] != "**":
-                    end = j
-                    break
-                j += 1
+                continue
+
+            factory = Bold if char == "*" else Underline
+            stack.append((parts, stop, factory, end + 2))
+            parts, stop, i, buf_start = [], end, i + 2, i + 2
+
+        # Italic: *...* (not **...**)
+        elif char == "*":
+            if buf_start < i:
+                parts.append(Text(text[buf_start:i]))
+            buf_start = i
+
+            end = italic.next(i + 1)
+            if end >= stop:
+                # Closing "*" right before slice end can't be followed by "*"
+                last = stop - 1
+                end = last if last > i and text[last] == "*" else -1
+
             if end == -1:
-                buf += "*"
                 i += 1
-            else:
-                parts.append(Italic(*_parse(text[i+1:end])))
-                i = end + 1
+                continue
+
+            stack.append((parts, stop, Italic, end + 1))
+            parts, stop, i, buf_start = [], end, i + 1, i + 1
 
         # Colored: [text](color)
-        elif text[i] == "[":
-            close_bracket = text.find("](", i + 1)
-            if close_bracket == -1:
-                buf += "["
+        elif char == "[":
+            close_bracket = link.next(i + 1)
+            close_paren = (
+                paren.next(close_bracket + 2) if close_bracket + 2 <= stop else stop
+            )
+
+            if close_paren >= stop:
                 i += 1
-            else:
-                close_paren = text.find(")", close_bracket + 2)
-                if close_paren == -1:
-                    buf += "["
-                    i += 1
-                else:
-                    if buf:
-                        parts.append(Text(buf))
-                        buf = ""
-                    color = text[close_bracket + 2:close_paren]
-                    parts.append(Colored(color, *_parse(text[i+1:close_bracket])))
-                    i = close_paren + 1
+                continue
 
-        else:
-            buf += text[i]
-            i += 1
+            if buf_start < i:
+                parts.append(Text(text[buf_start:i]))
 
-    if buf:
-        parts.append(Text(buf))
+            color = text[close_bracket + 2 : close_paren]
+            stack.append(
+                (
+                    parts,
+                    stop,
+                    lambda *children, color=color: Colored(color, *children),
+                    close_paren + 1,
+                )
+            )
+            parts, stop, i, buf_start = [], close_bracket, i + 1, i + 1
 
-    return parts
+        else:
+            # Skip plain text up to next possible marker
+            match = _SPECIAL.search(text, i + 1, stop)
+            i = stop if match is None else match.start()
@@ -0,0 +1,81 @@
+import collections
+import threading
+import tempfile
+
+from components import Component, serialize, deserialize
+
+
+class Scrollback:
+    """
+    Messages history with fixed memory footprint.
+
+    Newest ``capacity`` messages are kept in memory, older ones are spilled
+    to a temporary file in compact serialized form and read back by index
+    only when history is paged to them.
+    """
+
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+
+        self._recent: collections.deque[Component] = collections.deque()
+        self._spilled = 0
+
+        # Records are 4-byte length prefixed serialized messages,
+        # index holds 8-byte offset of every record
+        self._data = None
+        self._index = None
+        self._data_size = 0
+
+        # Messages are appended by receiving thread and read by draw thread
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._spilled + len(self._recent)
+
+    def append(self, message: Component):
+        with self._lock:
+            self._recent.append(message)
+
+            if len(self._recent) > self.capacity:
+                self._spill(self._recent.popleft())
+
+    def __getitem__(self, index: int) -> Component:
+        with self._lock:
+            if index < 0:
+                index += len(self)
+
+            if not 0 <= index < len(self):
+                raise IndexError("Scrollback index out of range")
+
+            if index >= self._spilled:
+                return self._recent[index - self._spilled]
+
+            self._index.seek(index * 8)
+            offset = int.from_bytes(self._index.read(8), byteorder="big")
+
+            self._data.seek(offset)
+            length = int.from_bytes(self._data.read(4), byteorder="big")
+            record = self._data.read(length)
+
+        return deserialize(record)
+
+    def _spill(self, message: Component):
+        if self._data is None:
+            self._data = tempfile.TemporaryFile()
+            self._index = tempfile.TemporaryFile()
+
+        record = serialize(message)
+
+        self._data.seek(self._data_size)
+        self._data.write(len(record).to_bytes(4, byteorder="big") + record)
+
+        self._index.seek(self._spilled * 8)
+        self._index.write(self._data_size.to_bytes(8, byteorder="big"))
+
+        self._data_size += 4 + len(record)
+        self._spilled += 1
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
@@ -1,5 +1,6 @@
 from argparse import ArgumentParser
 
+from src.ratelimit import RateLimits
 from src.host import Host
 
 
@@ -13,11 +14,81 @@ parser.add_argument(
     type=int,
     default=6074,
 )
+parser.add_argument(
+    "--unix",
+    default=None,
+    help="Also listen on unix domain socket at this path",
+)
+
+parser.add_argument(
+    "--session-commands",
+    type=float,
+    default=None,
+    help="Commands per second allowed for every session",
+)
+parser.add_argument(
+    "--session-bytes",
+    type=float,
+    default=None,
+    help="Bytes per second allowed for every session",
+)
+parser.add_argument(
+    "--name-commands",
+    type=float,
+    default=None,
+    help="Commands per second allowed for all sessions of a name",
+)
+parser.add_argument(
+    "--name-bytes",
+    type=float,
+    default=None,
+    help="Bytes per second allowed for all sessions of a name",
+)
+
+parser.add_argument(
+    "--message-ttl",
+    type=float,
+    default=None,
+    help="Seconds unread messages are kept for, longest TTL clients can ask for",
+)
+
+parser.add_argument(
+    "--search-db",
+    default=None,
+    help="Index plain messages for history search in this SQLite file",
+)
+
+parser.add_argument(
+    "--capture",
+    default=None,
+    help="Record trace of received commands, without their content, to this file",
+)
+
+parser.add_argument(
+    "--handoff",
+    default=None,
+    help="Take over listeners and sessions from server handing them off at this "
+    "unix socket path, if there is one, and hand them off there to the next one",
+)
 
 args = parser.parse_args()
 
 
-host = Host(args.host, args.port)
+host = Host(
+    args.host,
+    args.port,
+    args.unix,
+    RateLimits(
+        session_commands=args.session_commands,
+        session_bytes=args.session_bytes,
+        name_commands=args.name_commands,
+        name_bytes=args.name_bytes,
+    ),
+    args.message_ttl,
+    args.search_db,
+    capture_path=args.capture,
+    handoff_path=args.handoff,
+)
 
 if __name__ == "__main__":
     host.listen()
@@ -0,0 +1,137 @@
+"""
+Traffic capture: per-connection trace of commands server received.
+
+Trace is a binary file - ``MAGIC`` followed by fixed-size records of
+time since capture started, connection number, event kind, lane, command,
+size and peer. Message bodies and keys are never written, names are
+replaced by numbers assigned in order of appearance, so trace keeps who
+talks to whom and how much, but not what or who.
+"""
+
+import itertools
+import typing
+import struct
+
+try:
+    import fcntl
+except ImportError:  # No file locks on Windows, there's no handoff there either
+    fcntl = None
+
+MAGIC = b"KMTRACE1"
+
+CONNECT = 0
+ONLINE = 1
+COMMAND = 2
+DISCONNECT = 3
+
+# Peer of events that have none
+NO_PEER = 0xFFFFFFFF
+
+# time, connection, kind, lane, command, size, peer
+RECORD = struct.Struct("<dIBB2sII")
+
+
+class Record(typing.NamedTuple):
+    time: float
+    connection: int
+    kind: int
+    lane: int
+    command: str
+    # Message length for messages, whole payload length for other commands
+    size: int
+    # Own name number for ONLINE, the other party for commands addressing one
+    peer: int
+
+
+class Recorder:
+    def __init__(self, path: str, clock: typing.Callable[[], float]):
+        # Not truncated before the lock is taken - server this one takes
+        # over from may still be writing to it
+        self._file = open(path, "ab")
+
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._file.close()
+                raise RuntimeError(f"{path} is recorded by another server") from None
+
+        self._file.truncate(0)
+        self._file.write(MAGIC)
+
+        self._clock = clock
+        self._start = clock()
+
+        # Numbers of open connections by address, addresses may be reused
+        self._connections: dict[tuple[str, int], int] = {}
+        self._numbers = itertools.count()
+        self._names: dict[bytes, int] = {}
+
+    def _write(
+        self,
+        address: tuple[str, int],
+        kind: int,
+        lane: int = 0,
+        command: str = "",
+        size: int = 0,
+        peer: int = NO_PEER,
+    ):
+        self._file.write(
+            RECORD.pack(
+                self._clock() - self._start,
+                self._connections[address],
+                kind,
+                lane,
+                command.encode(),
+                size,
+                peer,
+            )
+        )
+
+    def name(self, name: bytes) -> int:
+        return self._names.setdefault(name, len(self._names))
+
+    def connect(self, address: tuple[str, int]):
+        self._connections[address] = next(self._numbers)
+        self._write(address, CONNECT)
+
+    def online(self, address: tuple[str, int], name: bytes):
+        self._write(address, ONLINE, peer=self.name(name))
+
+    def command(
+        self,
+        address: tuple[str, int],
+        lane: int,
+        command: str,
+        size: int,
+        peer: bytes | None = None,
+    ):
+        self._write(
+            address,
+            COMMAND,
+            lane,
+            command,
+            min(size, 0xFFFFFFFF),
+            NO_PEER if peer is None else self.name(peer),
+        )
+
+    def disconnect(self, address: tuple[str, int]):
+        self._write(address, DISCONNECT)
+        del self._connections[address]
+
+    def close(self):
+        self._file.close()
+
+
+def read(path: str) -> typing.Iterator[Record]:
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+
+        while chunk := file.read(RECORD.size * 1024):
+            # Trace of a server that crashed may end with a partial record
+            chunk = chunk[: len(chunk) - len(chunk) % RECORD.size]
+
+            for fields in RECORD.iter_unpack(chunk):
+                record = Record(*fields)
+                yield record._replace(command=record.command.rstrip(b"\0").decode())
@@ -1,31 +1,167 @@
+import collections
+import functools
+import itertools
 import threading
+import random
+import typing
+import time
+import os
 
 from src.commands import Commands
 from src.codes import Codes
+from src import compression
+from src import transport
+from src import lanes
 from src import util
+from src.search import Hit
 
 import socket
 
+if typing.TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+
+# Most bytes of bulk commands sent without response
+BULK_WINDOW = 64 * 1024
+
+# Reconnect attempts wait a random time up to this many seconds, doubled
+# after every failed attempt up to RECONNECT_MAX_DELAY, so clients dropped
+# together don't come back all at once
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+
+class Outgoing(typing.NamedTuple):
+    """Message waiting in outbox until connection is back"""
+
+    receiver: bytes
+    message: bytes
+    ttl: float | None
+    report_expired: bool
+    # Server drops message it already stored with the same id
+    id: bytes
+
+
+def _reconnecting(method):
+    """
+    Request waits while connection is down and runs again once
+    it is back, if it broke during the request
+    """
+
+    @functools.wraps(method)
+    def wrapper(self: "Client", *args, **kwargs):
+        while True:
+            self._enter()
+
+            try:
+                return method(self, *args, **kwargs)
+            except OSError:
+                if not self.reconnect:
+                    raise
+
+                self._lost()
+            finally:
+                self._leave()
+
+    return wrapper
+
 
 class Client:
-    def __init__(self, host: str, port: int, name: bytes):
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        name: bytes,
+        rotate_interval: float | None = None,
+        end_to_end: bool = False,
+        reconnect: bool = False,
+    ):
+        """
+        :param host: Server host, or ``unix:<path>`` to connect over unix domain socket
+        :param port: Server port, ignored for unix domain socket
+        :param name: Name to register on server
+        :param rotate_interval: Seconds between automatic key rotations, None to disable
+        :param end_to_end: Encrypt message bodies to receivers that published their keys,
+                           server relays them without decrypting
+        :param reconnect: Connect again when connection breaks, requests wait
+                          for it meanwhile and sent messages are kept in outbox
+        """
+        self._socket: socket.socket | None = None
 
         self.host = host
         self.port = port
         self.name = name
 
-        self._key = None
-        self._iv = None
-
-        self.lock = threading.Lock()
+        # Keys by epoch: current one and the one it replaced
+        self._keys: dict[int, tuple[bytes, bytes]] = {}
+        self._epoch = 0
+        self._compression: str | None = None
+
+        self.rotate_interval = rotate_interval
+        self.clock: typing.Callable[[], float] = time.monotonic
+        self._rotated_at = 0.0
+        # Private key of rekey request waiting for server reply
+        self._rekey: X25519PrivateKey | None = None
+
+        # One request at a time per lane, requests on different lanes
+        # run concurrently from different threads
+        self._lanes = {lane: threading.Lock() for lane in lanes.LANES}
+        self._write_lock = threading.Lock()
+
+        # Responses are read by whichever waiting thread gets there first
+        # and put to inbox of their lane
+        self._inbox: dict[int, collections.deque[bytes]] = {
+            lane: collections.deque() for lane in lanes.LANES
+        }
+        self._assembler = lanes.Assembler()
+        self._arrived = threading.Condition()
+        self._reading = False
+
+        # Key pair message bodies are encrypted end-to-end with
+        self._identity = util.x25519_private_key() if end_to_end else None
+        # Published keys of every session of receivers by name
+        self._peer_keys: dict[bytes, list[bytes]] = {}
+        # Body encryption keys by peer public key
+        self._body_keys: dict[bytes, bytes] = {}
+
+        # Receivers messages sent with report_expired expired before they read,
+        # filled by receive_all
+        self.expired: collections.deque[bytes] = collections.deque()
+
+        self.reconnect = reconnect
+        # Messages sent while connection was down, oldest first
+        self.outbox: collections.deque[Outgoing] = collections.deque()
+        # (receiver, message) of outbox messages server refused once sent
+        self.undelivered: collections.deque[tuple[bytes, bytes]] = collections.deque()
+
+        # Guards connection state below, notified when it changes
+        self._state = threading.Condition()
+        self._connected = False
+        self._stopped = False
+        # Requests running on current connection
+        self._active = 0
 
     def start(self):
-        self._socket.connect((self.host, self.port))
+        self._connect()
+
+        with self._state:
+            self._connected = True
+
+    def _connect(self):
+        """Connect and go through handshake, dropping state of previous connection"""
+        self._socket = transport.connection(self.host, self.port)
 
-        server_pub_bytes = util.wait_event(self._socket).data
+        for inbox in self._inbox.values():
+            inbox.clear()
+        self._assembler = lanes.Assembler()
+        self._compression = None
+        self._rekey = None
+        # Peers may have other sessions by now
+        self._peer_keys.clear()
 
-        code = Codes.decode(util.wait_event(self._socket).data)
+        server_pub_bytes = self._handshake_frame()
+
+        code = Codes.decode(self._handshake_frame())
 
         if code != Codes.ok:
             raise ValueError(
@@ -35,14 +171,16 @@ class Client:
         private = util.x25519_private_key()
         server_pub = util.x25519_public_key_from_bytes(server_pub_bytes)
         shared_secret = private.exchange(server_pub)
-        self._key, self._iv = util.derive_symmetric_keys(shared_secret)
-        key, iv = self._key, self._iv
+        key, iv = util.derive_symmetric_keys(shared_secret)
+        self._keys = {0: (key, iv)}
+        self._epoch = 0
+        self._rotated_at = self.clock()
 
         util.send_message(
             self._socket, util.x25519_public_key_to_bytes(private.public_key())
         )
 
-        data = util.wait_event(self._socket).data
+        data = self._handshake_frame()
 
         code = Codes.decode(data)
 
@@ -53,7 +191,7 @@ class Client:
 
         util.send_message(self._socket, util.aes_encrypt(key, iv, self.name))
 
-        data = util.aes_decrypt(key, iv, util.wait_event(self._socket).data)
+        data = util.aes_decrypt(key, iv, self._handshake_frame())
 
         code = Codes.decode(data)
 
@@ -62,47 +200,501 @@ class Client:
                 f"Cannot set name: Server respond with non-ok code: {code} // {data}"
             )
 
-    def send_message(self, receiver: bytes, message: bytes):
-        with self.lock:
-            command = util.pack_command(
-                Commands.send_message, (receiver, 1), (message, 2)
-            )
+        self._negotiate()
+
+        if self._identity is not None:
+            self._publish_key()
+
+    def _handshake_frame(self) -> bytes:
+        event = util.wait_event(self._socket)
 
-            util.send_message(
-                self._socket, util.aes_encrypt(self._key, self._iv, command)
+        if event.close_connection:
+            raise ConnectionError("Connection closed by server")
+
+        return event.data
+
+    def _negotiate(self):
+        command = util.pack_command(
+            Commands.negotiate,
+            *((codec.encode(), 1) for codec in compression.supported()),
+        )
+
+        with self._lanes[lanes.CONTROL]:
+            self._send(lanes.CONTROL, command)
+
+            # Reply is uncompressed - codec is enabled only after it
+            command = util.parse_command(self._receive(lanes.CONTROL))
+
+        if command["command"] != Commands.negotiate:
+            raise ValueError(
+                f"Cannot negotiate compression: Server respond with wrong command: {command}"
             )
-            data = util.aes_decrypt(
-                self._key, self._iv, util.wait_event(self._socket).data
+
+        codec, _ = util.parse_part(1, command["args"])
+        self._compression = codec.decode() or None
+
+    def _publish_key(self):
+        command = util.pack_command(
+            Commands.publish_key,
+            (util.x25519_public_key_to_bytes(self._identity.public_key()), 1),
+        )
+
+        with self._lanes[lanes.CONTROL]:
+            self._send(lanes.CONTROL, command)
+            data = self._receive(lanes.CONTROL)
+
+        code = Codes.decode(data)
+
+        if code != Codes.ok:
+            raise ValueError(
+                f"Cannot publish key: Server respond with non-ok code {code} // {data}"
             )
 
+    def _peer_key(self, name: bytes) -> list[bytes] | None:
+        """Keys of every session of peer, one per device"""
+        if name not in self._peer_keys:
+            with self._lanes[lanes.CONTROL]:
+                self._send(
+                    lanes.CONTROL, util.pack_command(Commands.get_key, (name, 1))
+                )
+                data = self._receive(lanes.CONTROL)
+
             code = Codes.decode(data)
 
+            # Receiver is offline or doesn't use end-to-end encryption. Any
+            # other failure must not send the message readable by server
             if code == Codes.no_receiver:
-                raise ValueError("No receiver")
+                return None
+
+            if code == Codes.throttled:
+                raise ValueError("Throttled")
+
+            command = util.parse_command(data)
+
+            if command["command"] != Commands.get_key:
+                raise ValueError(
+                    f"Cannot get key: Server respond with non-ok code {code} // {data}"
+                )
+
+            keys = []
+            args = command["args"]
+            while args:
+                key, args = util.parse_part(1, args)
+                keys.append(key)
+
+            self._peer_keys[name] = keys
+
+        return self._peer_keys[name]
+
+    def _body_key(self, peer_key: bytes) -> bytes:
+        if peer_key not in self._body_keys:
+            shared_secret = self._identity.exchange(
+                util.x25519_public_key_from_bytes(peer_key)
+            )
+            self._body_keys[peer_key], _ = util.derive_symmetric_keys(shared_secret)
+
+        return self._body_keys[peer_key]
+
+    def _encrypt_body(self, peer_key: bytes, message: bytes) -> bytes:
+        """Sender's public key, random IV and message encrypted to peer"""
+        iv = os.urandom(16)
+        return (
+            util.x25519_public_key_to_bytes(self._identity.public_key())
+            + iv
+            + util.aes_encrypt(self._body_key(peer_key), iv, message)
+        )
+
+    def _decrypt_body(self, body: bytes) -> bytes:
+        if self._identity is None:
+            raise ValueError("Received end-to-end encrypted message")
+
+        sender_key, iv, data = body[:32], body[32:48], body[48:]
+        return util.aes_decrypt(self._body_key(bytes(sender_key)), iv, data)
+
+    def _seal(self, data: bytes) -> bytes:
+        """Seal with current keys, caller must hold the write lock"""
+        epoch = self._epoch
+        key, iv = self._keys[epoch]
+        return epoch.to_bytes(1, byteorder="big") + util.aes_encrypt(
+            key, iv, compression.pack(self._compression, data)
+        )
+
+    def _open(self, data: bytes) -> bytes:
+        epoch, data = data[0], data[1:]
+
+        if epoch not in self._keys:
+            raise ValueError(f"Server sealed frame with unknown key epoch {epoch}")
+
+        key, iv = self._keys[epoch]
+        return compression.unpack(self._compression, util.aes_decrypt(key, iv, data))
+
+    def _send(self, lane: int, *commands: bytes, body: bytes | None = None):
+        """
+        Seal and send commands on lane. With body, the only command is sealed
+        as header of opaque payload and body is sent after it as is.
+        Rekey request is put in front of them when rotation is due
+        """
+        frames = []
+
+        with self._write_lock:
+            if (
+                self._rekey is None
+                and self.rotate_interval is not None
+                and self.clock() - self._rotated_at >= self.rotate_interval
+            ):
+                frames.extend(lanes.frames(lanes.CONTROL, self._rekey_request()))
+
+            if body is not None:
+                (command,) = commands
+                frames.extend(
+                    lanes.frames(
+                        lane,
+                        lanes.pack_opaque(self._seal(command), body),
+                        opaque=True,
+                    )
+                )
+            else:
+                for command in commands:
+                    frames.extend(lanes.frames(lane, self._seal(command)))
+
+        # Write lock is released between chunks, so other lanes' requests
+        # get on the wire during a large transfer
+        write: list[bytes] = []
+        size = 0
+
+        for frame in frames:
+            write.append(frame)
+            size += len(frame)
+
+            if size >= lanes.CHUNK_SIZE:
+                with self._write_lock:
+                    self._socket.sendall(b"".join(write))
+                write, size = [], 0
+
+        if write:
+            with self._write_lock:
+                self._socket.sendall(b"".join(write))
+
+    def _receive(self, lane: int) -> bytes | tuple[bytes, memoryview]:
+        """
+        Next response on lane, caller must hold the lane lock.
+        Opaque payloads are returned as opened header and body
+        """
+        self._wait(lambda: self._inbox[lane])
+        return self._inbox[lane].popleft()
+
+    def _wait(self, ready: typing.Callable[[], typing.Any]):
+        """Read frames until ready() is true, or wait while other thread reads them"""
+        while True:
+            with self._arrived:
+                while not ready() and self._reading:
+                    self._arrived.wait()
+
+                if ready():
+                    return
+
+                self._reading = True
+
+            try:
+                self._read_frame()
+            finally:
+                with self._arrived:
+                    self._reading = False
+                    self._arrived.notify_all()
+
+    def _read_frame(self):
+        event = util.wait_event(self._socket)
+
+        if event.close_connection:
+            raise ConnectionError("Connection closed by server")
+
+        lane, opaque, payload = self._assembler.feed(event.data)
+
+        if payload is None:
+            return
+
+        if opaque:
+            header, body = lanes.split_opaque(payload)
+            self._inbox[lane].append((self._open(header), body))
+            return
+
+        data = self._open(payload)
+
+        # Rekey replies are handled right away, no matter who waits for them
+        if (
+            lane == lanes.CONTROL
+            and self._rekey is not None
+            and util.parse_command(data)["command"] == Commands.reset_keys
+        ):
+            self._complete_rekey(data)
+            return
+
+        self._inbox[lane].append(data)
+
+    def _rekey_request(self) -> bytes:
+        self._rekey = util.x25519_private_key()
+
+        return self._seal(
+            util.pack_command(
+                Commands.reset_keys,
+                (util.x25519_public_key_to_bytes(self._rekey.public_key()), 1),
+            )
+        )
+
+    def _complete_rekey(self, data: bytes):
+        command = util.parse_command(data)
+        server_pub, _ = util.parse_part(1, command["args"])
+
+        shared_secret = self._rekey.exchange(
+            util.x25519_public_key_from_bytes(server_pub)
+        )
+
+        keys = util.derive_symmetric_keys(shared_secret)
+
+        # Runs on whichever thread reads, senders seal under the write lock,
+        # so none of them sees keys of one epoch and number of the other
+        with self._write_lock:
+            # Replies sealed with previous epoch may still be in flight
+            epoch = (self._epoch + 1) % 256
+            self._keys = {self._epoch: self._keys[self._epoch], epoch: keys}
+            self._epoch = epoch
+
+            self._rekey = None
+            self._rotated_at = self.clock()
+
+    @_reconnecting
+    def ping(self) -> float:
+        """
+        Check connection on control lane
+        :return: Round trip time in seconds
+        """
+        with self._lanes[lanes.CONTROL]:
+            start = time.perf_counter()
+            self._send(lanes.CONTROL, util.pack_command(Commands.ping))
+            data = self._receive(lanes.CONTROL)
+
+            code = Codes.decode(data)
+
+            if code == Codes.throttled:
+                raise ValueError("Throttled")
+
+            if code != Codes.ok:
+                raise ValueError(
+                    f"Cannot ping: Server respond with non-ok code {code} // {data}"
+                )
+
+            return time.perf_counter() - start
+
+    @staticmethod
+    def _trailer(
+        ttl: float | None, report_expired: bool, message_id: bytes
+    ) -> tuple[tuple[bytes, int], ...]:
+        """Optional trailing blocks of send_message and relay commands"""
+        ttl_bytes = (
+            b""
+            if ttl is None
+            else min(int(ttl * 1000), 0xFFFFFFFF).to_bytes(4, byteorder="big")
+        )
+        return (
+            (ttl_bytes, 1),
+            (b"\x01" if report_expired else b"", 1),
+            (message_id, 1),
+        )
+
+    def send_message(
+        self,
+        receiver: bytes,
+        message: bytes,
+        ttl: float | None = None,
+        report_expired: bool = False,
+    ) -> bool:
+        """
+        :param ttl: Seconds message is kept for if receiver doesn't read it,
+                    server default applies if it isn't set
+        :param report_expired: Add receiver to ``expired`` if message expires
+        :return: False if connection is down and message waits in outbox
+        """
+        outgoing = Outgoing(receiver, message, ttl, report_expired, os.urandom(8))
+        return self._send_or_queue([outgoing], lambda: self._send_message(*outgoing))
+
+    def _send_message(
+        self,
+        receiver: bytes,
+        message: bytes,
+        ttl: float | None,
+        report_expired: bool,
+        message_id: bytes,
+    ):
+        trailer = self._trailer(ttl, report_expired, message_id)
+
+        # Large messages are sent in chunks, not to hold up chat messages
+        lane = lanes.BULK if len(message) > lanes.CHUNK_SIZE else lanes.INTERACTIVE
+
+        # Keys message was already relayed to
+        delivered: set[bytes] = set()
+
+        for _ in range(2):
+            if self._identity is not None and self._peer_key(receiver) is not None:
+                data = self._relay(lane, receiver, message, delivered, trailer)
+            else:
+                with self._lanes[lane]:
+                    command = util.pack_command(
+                        Commands.send_message, (receiver, 1), (message, 2), *trailer
+                    )
+
+                    self._send(lane, command)
+                    data = self._receive(lane)
+
+            # Sessions of receiver changed - fetch their keys and retry once
+            if Codes.decode(data) != Codes.key_changed:
+                break
+
+            del self._peer_keys[receiver]
+
+        code = Codes.decode(data)
+
+        if code == Codes.no_receiver:
+            raise ValueError("No receiver")
 
+        if code == Codes.throttled:
+            raise ValueError("Throttled")
+
+        if code != Codes.ok:
+            raise ValueError(
+                f"Cannot send message: Server respond with non-ok code {code} // {data}"
+            )
+
+    def _relay(
+        self,
+        lane: int,
+        receiver: bytes,
+        message: bytes,
+        delivered: set[bytes],
+        trailer: tuple[tuple[bytes, int], ...] = (),
+    ) -> bytes:
+        """
+        Send message encrypted end-to-end to every session of receiver
+        not in delivered, server decrypts only the routing headers
+        """
+        peer_keys = self._peer_key(receiver)
+
+        if peer_keys is None:
+            return Codes.no_receiver.encode()
+
+        pending = [key for key in peer_keys if key not in delivered]
+        devices = len(peer_keys).to_bytes(1, byteorder="big")
+
+        with self._lanes[lane]:
+            for peer_key in pending:
+                self._send(
+                    lane,
+                    util.pack_command(
+                        Commands.relay,
+                        (receiver, 1),
+                        (peer_key, 1),
+                        (devices, 1),
+                        *trailer,
+                    ),
+                    body=self._encrypt_body(peer_key, message),
+                )
+
+            replies = [self._receive(lane) for _ in pending]
+
+        for peer_key, data in zip(pending, replies):
+            if Codes.decode(data) == Codes.ok:
+                delivered.add(peer_key)
+
+        for data in replies:
+            if Codes.decode(data) != Codes.ok:
+                return data
+
+        return Codes.ok.encode()
+
+    def send_messages(
+        self, receiver: bytes, messages: list[bytes], ttl: float | None = None
+    ) -> bool:
+        """
+        Send messages in one batch on bulk lane. Commands are pipelined:
+        responses are read while later commands are sent, and at most
+        BULK_WINDOW bytes are unacknowledged, so that bulk data doesn't
+        fill socket buffers ahead of control and interactive frames
+        :param ttl: Seconds messages are kept for if receiver doesn't read them
+        :return: False if connection is down and messages wait in outbox
+        """
+        ids = [os.urandom(8) for _ in messages]
+
+        return self._send_or_queue(
+            [
+                Outgoing(receiver, message, ttl, False, message_id)
+                for message, message_id in zip(messages, ids)
+            ],
+            lambda: self._send_messages(receiver, messages, ttl, ids),
+        )
+
+    def _send_messages(
+        self,
+        receiver: bytes,
+        messages: list[bytes],
+        ttl: float | None,
+        ids: list[bytes],
+    ):
+        codes = []
+
+        with self._lanes[lanes.BULK]:
+            in_flight: collections.deque[int] = collections.deque()
+            window = 0
+
+            for message, message_id in zip(messages, ids):
+                command = util.pack_command(
+                    Commands.send_message,
+                    (receiver, 1),
+                    (message, 2),
+                    *self._trailer(ttl, False, message_id),
+                )
+
+                while in_flight and window + len(command) > BULK_WINDOW:
+                    codes.append(Codes.decode(self._receive(lanes.BULK)))
+                    window -= in_flight.popleft()
+
+                self._send(lanes.BULK, command)
+                in_flight.append(len(command))
+                window += len(command)
+
+            for _ in in_flight:
+                codes.append(Codes.decode(self._receive(lanes.BULK)))
+
+        if Codes.no_receiver in codes:
+            raise ValueError("No receiver")
+
+        if Codes.throttled in codes:
+            raise ValueError("Throttled")
+
+        for code in codes:
             if code != Codes.ok:
                 raise ValueError(
-                    f"Cannot send message: Server respond with non-ok code {code} // {data}"
+                    f"Cannot send message: Server respond with non-ok code {code}"
                 )
 
+    @_reconnecting
     def receive_messages(self, sender: bytes) -> list[bytes]:
-        with self.lock:
+        lane = lanes.INTERACTIVE
+
+        with self._lanes[lane]:
             command = util.pack_command(
                 Commands.receive_messages,
                 (sender, 1),
             )
-            util.send_message(
-                self._socket, util.aes_encrypt(self._key, self._iv, command)
-            )
-            data = util.aes_decrypt(
-                self._key, self._iv, util.wait_event(self._socket).data
-            )
+            self._send(lane, command)
+            data = self._receive(lane)
 
             code = Codes.decode(data)
 
             if code == Codes.no_sender:
                 raise ValueError("No sender")
 
+            if code == Codes.throttled:
+                raise ValueError("Throttled")
+
             command = util.parse_command(data)
             command, args = command["command"], command["args"]
 
@@ -118,15 +710,14 @@ class Client:
             messages = []
 
             for i in range(messages_count):
-                messages.append(
-                    util.aes_decrypt(
-                        self._key, self._iv, util.wait_event(self._socket).data
-                    )
-                )
+                message = self._receive(lane)
 
-            data = util.aes_decrypt(
-                self._key, self._iv, util.wait_event(self._socket).data
-            )
+                if isinstance(message, tuple):
+                    message = self._decrypt_body(message[1])
+
+                messages.append(message)
+
+            data = self._receive(lane)
 
             code = Codes.decode(data)
 
@@ -137,34 +728,289 @@ class Client:
 
             return messages
 
-    def refresh_key(self):
-        with self.lock:
-            command = util.pack_command(Commands.reset_keys)
-            util.send_message(
-                self._socket, util.aes_encrypt(self._key, self._iv, command)
+    @_reconnecting
+    def receive_all(
+        self, peers: list[bytes]
+    ) -> tuple[list[tuple[bytes, bytes]], dict[bytes, bool]]:
+        """
+        Fetch pending messages from everyone in one request
+        :param peers: Names to report online status for
+        :return: (sender, message) pairs and online status of every peer
+        """
+        lane = lanes.INTERACTIVE
+
+        with self._lanes[lane]:
+            command = util.pack_command(
+                Commands.receive_all,
+                *((peer, 1) for peer in peers),
             )
+            self._send(lane, command)
+            data = self._receive(lane)
 
-            server_pub_bytes = util.wait_event(self._socket).data
-            private = util.x25519_private_key()
-            shared_secret = private.exchange(
-                util.x25519_public_key_from_bytes(server_pub_bytes)
-            )
-            new_key, new_iv = util.derive_symmetric_keys(shared_secret)
+            if Codes.decode(data) == Codes.throttled:
+                raise ValueError("Throttled")
 
-            util.send_message(
-                self._socket, util.x25519_public_key_to_bytes(private.public_key())
-            )
+            command = util.parse_command(data)
+            command, args = command["command"], command["args"]
+
+            if command != Commands.receive_all:
+                raise ValueError(
+                    f"Cannot receive messages: Server respond with wrong command: {command} // {data}"
+                )
+
+            messages_count, args = util.parse_part(1, args)
+            presence, args = util.parse_part(2, args)
+            expired_count, _ = util.parse_part(1, args)
+
+            messages_count = int.from_bytes(messages_count, byteorder="big")
+
+            messages = []
+
+            for i in range(messages_count):
+                data = self._receive(lane)
+
+                if isinstance(data, tuple):
+                    header, body = data
+                    sender, _ = util.parse_part(1, header)
+                    message = self._decrypt_body(body)
+                else:
+                    sender, message = util.parse_part(1, data)
+
+                messages.append((sender, message))
+
+            for _ in range(int.from_bytes(expired_count, byteorder="big")):
+                data = self._receive(lane)
+
+                if Codes.decode(data[:1]) == Codes.message_expired:
+                    self.expired.append(data[1:])
+
+            data = self._receive(lane)
 
-            data = util.wait_event(self._socket).data
             code = Codes.decode(data)
 
             if code != Codes.ok:
                 raise ValueError(
-                    f"Cannot refresh keys: Server respond with non-ok code: {code}"
+                    f"Cannot receive messages: Server respond with non-ok code {code} // {data}"
+                )
+
+            return messages, {
+                peer: bool(online) for peer, online in zip(peers, presence)
+            }
+
+    @_reconnecting
+    def search(
+        self, peer: bytes, query: str, before: int | None = None, limit: int = 20
+    ) -> list[Hit]:
+        """
+        Search history of conversation with peer on server, newest hits first
+        :param before: Id of the last hit of previous page
+        """
+        lane = lanes.INTERACTIVE
+
+        with self._lanes[lane]:
+            command = util.pack_command(
+                Commands.search,
+                (peer, 1),
+                (query.encode(), 2),
+                (b"" if before is None else before.to_bytes(8, byteorder="big"), 1),
+                (min(limit, 0xFF).to_bytes(1, byteorder="big"), 1),
+            )
+            self._send(lane, command)
+            data = self._receive(lane)
+
+        code = Codes.decode(data)
+
+        if code == Codes.throttled:
+            raise ValueError("Throttled")
+
+        if code == Codes.not_supported:
+            raise ValueError("Search is disabled on server")
+
+        command = util.parse_command(data)
+        command, args = command["command"], command["args"]
+
+        if command != Commands.search:
+            raise ValueError(
+                f"Cannot search: Server respond with wrong command: {command} // {data}"
+            )
+
+        hits = []
+        while args:
+            id, args = util.parse_part(1, args)
+            sender, args = util.parse_part(1, args)
+            sent, args = util.parse_part(1, args)
+            snippet, args = util.parse_part(2, args)
+
+            hits.append(
+                Hit(
+                    id=int.from_bytes(id, byteorder="big"),
+                    sender=sender,
+                    time=int.from_bytes(sent, byteorder="big") / 1000,
+                    snippet=snippet.decode(),
+                )
+            )
+
+        return hits
+
+    @_reconnecting
+    def refresh_key(self):
+        """
+        Rotate keys in-band on control lane: requests on other lanes keep
+        flowing, server accepts frames of previous epoch meanwhile
+        """
+        with self._lanes[lanes.CONTROL]:
+            with self._write_lock:
+                if self._rekey is None:
+                    self._socket.sendall(
+                        b"".join(lanes.frames(lanes.CONTROL, self._rekey_request()))
+                    )
+
+            self._wait(lambda: self._rekey is None)
+
+    def _enter(self):
+        with self._state:
+            while not self._connected and not self._stopped:
+                self._state.wait()
+
+            if self._stopped:
+                raise ConnectionError("Client is stopped")
+
+            self._active += 1
+
+    def _leave(self):
+        with self._state:
+            self._active -= 1
+
+            if not self._active:
+                self._state.notify_all()
+
+    def _lost(self):
+        """Start reconnecting, once per broken connection"""
+        with self._state:
+            if not self._connected or self._stopped:
+                return
+
+            self._connected = False
+
+        # Wakes threads blocked reading from it
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        threading.Thread(target=self._reconnect, daemon=True).start()
+
+    def _reconnect(self):
+        for attempt in itertools.count():
+            delay = random.uniform(
+                0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2**attempt)
+            )
+            deadline = time.monotonic() + delay
+
+            with self._state:
+                # Requests on broken connection fail before it is replaced
+                while self._active and not self._stopped:
+                    self._state.wait()
+
+                while not self._stopped and (left := deadline - time.monotonic()) > 0:
+                    self._state.wait(left)
+
+                if self._stopped:
+                    return
+
+            try:
+                self._socket.close()
+                self._connect()
+                self._flush()
+                return
+            except (OSError, ValueError):
+                continue
+
+    def _flush(self):
+        """
+        Send outbox in batches of messages to the same receiver, then let
+        requests in. Messages sent meanwhile are queued behind
+        """
+        while True:
+            with self._state:
+                if not self.outbox:
+                    self._connected = True
+                    self._state.notify_all()
+                    return
+
+                first = self.outbox[0]
+                batch = list(
+                    itertools.takewhile(
+                        lambda outgoing: outgoing.receiver == first.receiver
+                        and outgoing.ttl == first.ttl
+                        and not outgoing.report_expired,
+                        self.outbox,
+                    )
                 )
 
-            self._key, self._iv = new_key, new_iv
+            try:
+                # End-to-end encrypted messages are relayed one by one
+                if batch and (
+                    self._identity is None or self._peer_key(first.receiver) is None
+                ):
+                    self._send_messages(
+                        first.receiver,
+                        [outgoing.message for outgoing in batch],
+                        first.ttl,
+                        [outgoing.id for outgoing in batch],
+                    )
+                else:
+                    batch = [first]
+                    self._send_message(*first)
+            except ValueError:
+                self.undelivered.extend(
+                    (outgoing.receiver, outgoing.message) for outgoing in batch
+                )
+
+            with self._state:
+                for _ in batch:
+                    self.outbox.popleft()
+
+    def _send_or_queue(
+        self, messages: list[Outgoing], send: typing.Callable[[], None]
+    ) -> bool:
+        """
+        Send messages, or put them to outbox while connection is down
+        :return: Whether they were sent
+        """
+        if not self.reconnect:
+            send()
+            return True
+
+        with self._state:
+            if self._stopped:
+                raise ConnectionError("Client is stopped")
+
+            if not self._connected:
+                self.outbox.extend(messages)
+                return False
+
+            self._active += 1
+
+        try:
+            send()
+        except OSError:
+            # Server may have stored some of them - they are sent again
+            # with the same ids, and dropped by server if so
+            with self._state:
+                self.outbox.extend(messages)
+
+            self._lost()
+            return False
+        finally:
+            self._leave()
+
+        return True
 
     def stop(self):
-        with self.lock:
+        with self._state:
+            self._stopped = True
+            self._state.notify_all()
+
+        with self._write_lock:
             self._socket.close()
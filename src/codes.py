@@ -6,6 +6,10 @@ class Codes(int, Enum):
     name_too_long = 1
     no_receiver = 2
     no_sender = 3
+    throttled = 4
+    key_changed = 5
+    message_expired = 6
+    not_supported = 7
 
     def encode(self):
         return self.to_bytes(byteorder="big")
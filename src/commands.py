@@ -6,4 +6,10 @@ class Commands(str, Enum):
     ping = "p"
     send_message = "sm"
     receive_messages = "rm"
+    receive_all = "ra"
     reset_keys = "rk"
+    negotiate = "ng"
+    publish_key = "pk"
+    get_key = "gk"
+    relay = "rl"
+    search = "sr"
@@ -0,0 +1,135 @@
+"""
+Per-message compression negotiated during handshake.
+
+After negotiation every encrypted payload starts with a flag byte:
+``RAW`` - payload follows as is, ``COMPRESSED`` - payload is compressed
+with negotiated codec. Only payloads longer than ``THRESHOLD`` are compressed.
+Compression always happens before encryption - ciphertext doesn't compress.
+"""
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional
+    zstandard = None
+
+
+ZSTD = "zstd"
+ZLIB_DICT = "zlib-dict"
+ZLIB = "zlib"
+
+RAW = 0
+COMPRESSED = 1
+
+# Payloads shorter than this are sent raw - compression overhead outweighs gain
+THRESHOLD = 512
+
+# Refuse to inflate payloads beyond this size (decompression bombs)
+MAX_SIZE = 16 * 1024 * 1024
+
+# Preset dictionary for components.serialize output: color names used by
+# client and markdown plus frequent words of chats and pasted logs.
+# Most frequent strings go last - zlib prefers closer matches.
+DICTIONARY = (
+    b"Traceback (most recent call last):\n  File \"\", line , in \n"
+    b"DEBUG INFO WARNING ERROR CRITICAL Exception Error: None True False "
+    b"https://www. http:// .com .org /api/v1/ localhost 127.0.0.1 "
+    b"darkred darkgreen violet magenta blue gold gray white snow "
+    b"yellow orange green cyan red "
+    b"the and you that have for not with this but what are was "
+    b"the of to and a in is it you that "
+)
+
+
+def supported() -> list[str]:
+    """Codecs available in this process, most preferred first"""
+    codecs = [ZLIB_DICT, ZLIB]
+
+    if zstandard is not None:
+        codecs.insert(0, ZSTD)
+
+    return codecs
+
+
+def choose(offered: list[str]) -> str | None:
+    """Pick first codec from peer's preference list that is supported here"""
+    available = supported()
+
+    for codec in offered:
+        if codec in available:
+            return codec
+
+    return None
+
+
+def compress(codec: str, data: bytes) -> bytes:
+    if codec == ZLIB:
+        return zlib.compress(data)
+
+    if codec == ZLIB_DICT:
+        compressor = zlib.compressobj(zdict=DICTIONARY)
+        return compressor.compress(data) + compressor.flush()
+
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    """:raise ValueError: Data is corrupt or inflates beyond MAX_SIZE"""
+    if codec == ZSTD:
+        try:
+            return zstandard.ZstdDecompressor().decompress(
+                data, max_output_size=MAX_SIZE
+            )
+        except zstandard.ZstdError as error:
+            raise ValueError(f"Corrupt compressed payload: {error}") from error
+
+    if codec == ZLIB:
+        decompressor = zlib.decompressobj()
+    elif codec == ZLIB_DICT:
+        decompressor = zlib.decompressobj(zdict=DICTIONARY)
+    else:
+        raise ValueError(f"Unknown compression codec: {codec}")
+
+    try:
+        result = decompressor.decompress(data, MAX_SIZE)
+    except zlib.error as error:
+        raise ValueError(f"Corrupt compressed payload: {error}") from error
+
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed payload too large")
+
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed payload")
+
+    return result
+
+
+def pack(codec: str | None, data: bytes, threshold: int = THRESHOLD) -> bytes:
+    """Prepend compression flag, compressing data if worth it"""
+    if codec is None:
+        return data
+
+    if len(data) > threshold:
+        compressed = compress(codec, data)
+
+        if len(compressed) < len(data):
+            return COMPRESSED.to_bytes(1, byteorder="big") + compressed
+
+    return RAW.to_bytes(1, byteorder="big") + data
+
+
+def unpack(codec: str | None, data: bytes) -> bytes:
+    if codec is None:
+        return data
+
+    if not data:
+        raise ValueError("Payload has no compression flag")
+
+    if data[0] == COMPRESSED:
+        return decompress(codec, data[1:])
+
+    return data[1:]
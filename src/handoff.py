@@ -0,0 +1,109 @@
+"""
+Handoff of a running server to a freshly started one over unix domain socket.
+
+Running server listens on handoff socket. New process connects to it and
+receives serialized state - sessions, names, pending messages - followed
+by file descriptors of listening sockets and of every connection, passed
+with SCM_RIGHTS. Connections stay open in the kernel the whole time, so
+clients notice nothing but a pause. Deadlines in state are times of
+monotonic clock, which is the same for every process on the machine.
+
+Switch is confirmed both ways: new process replies READY once state is
+restored, old one stops serving and replies DONE, and only then the new
+one starts. If anything fails before that, old process keeps serving
+and new one gives up.
+"""
+
+import collections
+import socket
+import typing
+
+from src.timing_wheel import TimingWheel
+from src.session import Session
+from src.mailbox import Mailbox
+
+# Handoff between different versions of this format is refused
+VERSION = 3
+
+READY = b"\x01"
+DONE = b"\x02"
+
+# Descriptors passed in one message, kernel allows at most 253
+MAX_FDS = 250
+
+# Seconds either side waits for the other one
+TIMEOUT = 10.0
+
+
+class State(typing.TypedDict):
+    version: int
+    # Sessions by address, file descriptors follow in the same order
+    clients: dict[tuple[str, int], Session]
+    names: dict[bytes, list[tuple[str, int]]]
+    mailboxes: dict[bytes, dict[bytes, Mailbox]]
+    expiry: TimingWheel[tuple[bytes, bytes, Mailbox, int, bool]]
+    expired: dict[bytes, list[bytes]]
+    seen: dict[bytes, dict[bytes, None]]
+    left: dict[bytes, float]
+    forget: TimingWheel[tuple[bytes, float]]
+    metrics: collections.Counter[str]
+    # Whether tcp and unix listeners are passed, they go before connections
+    listeners: tuple[bool, bool]
+    unix_path: str | None
+    # Next number for unix domain socket clients
+    unix_id: int
+
+
+def _read_exactly(sock: socket.socket, size: int) -> bytes:
+    """
+    Read exactly size bytes - reading past them would drop descriptors
+    sent with the following bytes
+    """
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+
+        if not chunk:
+            raise ConnectionError("Handoff connection closed")
+
+        data += chunk
+
+    return bytes(data)
+
+
+def send(sock: socket.socket, state: bytes, fds: list[int]):
+    sock.sendall(
+        len(fds).to_bytes(4, byteorder="big")
+        + len(state).to_bytes(4, byteorder="big")
+        + state
+    )
+
+    for start in range(0, len(fds), MAX_FDS):
+        socket.send_fds(sock, [b"\0"], fds[start : start + MAX_FDS])
+
+
+def receive(sock: socket.socket) -> tuple[bytes, list[int]]:
+    """:return: Serialized state and received file descriptors"""
+    count = int.from_bytes(_read_exactly(sock, 4), byteorder="big")
+    size = int.from_bytes(_read_exactly(sock, 4), byteorder="big")
+    state = _read_exactly(sock, size)
+
+    fds: list[int] = []
+
+    try:
+        while len(fds) < count:
+            data, received, flags, _ = socket.recv_fds(sock, 1, MAX_FDS)
+            fds += received
+
+            if not data:
+                raise ConnectionError("Handoff connection closed")
+
+            if flags & socket.MSG_CTRUNC:
+                raise ConnectionError("Handoff descriptors were truncated")
+    except BaseException:
+        for fd in fds:
+            socket.close(fd)
+        raise
+
+    return state, fds
@@ -1,168 +1,823 @@
-import threading
+import collections
+import itertools
+import pickle
+import heapq
+import selectors
 import socket
 import typing
+import time
+import os
 
 
 from src.commands import Commands
 from src.codes import Codes
 from src.stage import Stage
+from src import compression
+from src import transport
+from src import ratelimit
+from src import lanes
+from src import capture
+from src import handoff
+from src import search
 from src import util
+from src.session import Session
+from src.mailbox import Mailbox
+from src.timing_wheel import TimingWheel
 
-from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 
+# Most messages returned by single receive_all request
+MAX_BATCH = 0xFFFF
 
-class ClientCredentials(typing.TypedDict):
-    private_key: X25519PrivateKey | None
+# Seconds frames sealed with previous key epoch are still accepted after rekey
+KEY_GRACE = 5.0
 
-    symmetric_key: bytes | None
-    symmetric_iv: bytes | None
+# Longest wait for socket events, bounds how long close() waits for the loop
+POLL_INTERVAL = 0.5
 
+READ_SIZE = 64 * 1024
 
-class Client(typing.TypedDict):
-    creds: ClientCredentials
-    stage: Stage
+# Most frames of one session handled before other sessions get their turn
+FRAMES_PER_TURN = 32
+# Session's socket isn't read while this many received bytes wait for handling,
+# TCP flow control then slows the sender down
+MAX_INBOUND = 256 * 1024
+# Longer frame could never be received whole, its sender is disconnected
+MAX_FRAME = MAX_INBOUND - 4
 
-    socket: socket.socket
+# Resolution of message expiry, TTLs are rounded up to it
+EXPIRY_TICK = 1.0
 
-    name: bytes | None
+# Message ids remembered per sender to drop messages sent again after
+# an ambiguous failure - more than one bulk window of small messages
+DEDUP_WINDOW = 4096
+# Seconds ids are remembered for after the last session of sender is gone,
+# long enough for its client to reconnect and send again
+DEDUP_KEEP = 300.0
 
-    messages: dict[bytes, list[bytes]]
+# Commands whose first argument is name of the other party
+ADDRESSED_COMMANDS = (
+    Commands.send_message,
+    Commands.relay,
+    Commands.receive_messages,
+    Commands.get_key,
+    Commands.search,
+)
+
+# Commands allowed regardless of rate limits - session breaks without them,
+# and end-to-end messages would fall back to plaintext without key lookups
+UNLIMITED_COMMANDS = (
+    Commands.reset_keys,
+    Commands.negotiate,
+    Commands.publish_key,
+    Commands.get_key,
+)
 
 
 class Host:
-    def __init__(self, address: str, port: int):
-        self._closed = False
-        self._threads: list[threading.Thread] = []
-        self.clients: dict[tuple[str, int], Client] = {}
+    """
+    Single-threaded server: every socket is non-blocking and served
+    from one selector loop
+    """
+
+    def __init__(
+        self,
+        address: str,
+        port: int | None,
+        unix_path: str | None = None,
+        limits: ratelimit.RateLimits | None = None,
+        message_ttl: float | None = None,
+        search_path: str | None = None,
+        selector: selectors.BaseSelector | None = None,
+        capture_path: str | None = None,
+        handoff_path: str | None = None,
+    ):
+        """
+        :param port: TCP port to listen on, None to take only connections
+                     given to ``connect``
+        :param selector: Selector sockets are watched with, system default
+                         one if not set
+        :param capture_path: File to record trace of received commands to
+        :param handoff_path: Unix domain socket to take over listeners and
+                             sessions from server running there, if there is
+                             one, and to hand them off to the next server at
+        """
+        # Host that failed to start has nothing __del__ could close
+        self._closed = True
+        self._listening = False
+        # Listeners and sessions were handed off to another process
+        self._handed_off = False
+        self.clients: dict[tuple[str, int], Session] = {}
+        # Addresses of online sessions by name, one per device
+        self._names: dict[bytes, list[tuple[str, int]]] = {}
+        # Messages pending for every session of a name, by receiver and sender
+        self._mailboxes: dict[bytes, dict[bytes, Mailbox]] = {}
+
+        # Seconds messages are kept for at most, unless they are read
+        self.message_ttl = message_ttl
+        # (receiver, sender, mailbox, position, report) of messages with TTL
+        self._expiry: TimingWheel[
+            tuple[bytes, bytes, Mailbox, int, bool]
+        ] = TimingWheel(EXPIRY_TICK)
+        # Receivers of expired messages to report to sender, by sender name
+        self._expired: dict[bytes, list[bytes]] = {}
+
+        # Ids of recently stored messages by sender, oldest first. Id is
+        # followed by key of the session end-to-end encrypted copy is for
+        self._seen: dict[bytes, dict[bytes, None]] = {}
+        # When the last session of sender disconnected, its ids are
+        # forgotten DEDUP_KEEP later unless it comes back
+        self._left: dict[bytes, float] = {}
+        self._forget: TimingWheel[tuple[bytes, float]] = TimingWheel(EXPIRY_TICK)
+
+        self.metrics: collections.Counter[str] = collections.Counter()
+
+        # History search index of plain messages, only if enabled
+        self._search = None if search_path is None else search.SearchIndex(search_path)
+
+        # Sessions with received frames not handled yet, served round-robin
+        self._ready: collections.deque[tuple[str, int]] = collections.deque()
+        # (throttled_until, address) heap of throttled sessions
+        self._throttled: list[tuple[float, tuple[str, int]]] = []
+
+        self.limits: ratelimit.RateLimits = limits or {}
+        # Rate limits shared by all sessions of a name
+        self._name_limiters: dict[bytes, ratelimit.Limiter] = {}
+
+        self._selector = selector or selectors.DefaultSelector()
+
+        self.clock: typing.Callable[[], float] = time.monotonic
+
+        self._capture = (
+            None
+            if capture_path is None
+            else capture.Recorder(capture_path, lambda: self.clock())
+        )
+
+        self._socket = None
+
+        # Unix domain socket clients have no address - number them instead
+        self._unix_path = unix_path
+        self._unix_socket = None
+        self._unix_ids = itertools.count()
+
+        # Listeners of server taken over replace ones of arguments
+        if handoff_path is None or not self._take_over(handoff_path):
+            if port is not None:
+                self._socket = transport.tcp_listener(address, port)
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.bind((address, port))
+            if unix_path is not None:
+                self._unix_socket = transport.unix_listener(unix_path)
+
+        self._handoff_path = handoff_path
+        self._handoff_socket = None
+
+        if handoff_path is not None:
+            self._handoff_socket = transport.unix_listener(handoff_path)
+            # Whoever connects gets keys of every session. Nobody can connect
+            # before listen(), so permissions are in place by then
+            os.chmod(handoff_path, 0o600)
+
+        self._closed = False
 
     def listen(self):
-        self._socket.listen(4)
-
-        while True:
-            sock, address = self._socket.accept()
-            self.clients[address] = Client(
-                creds=ClientCredentials(
-                    private_key=None,
-                    symmetric_key=None,
-                    symmetric_iv=None,
-                ),
-                stage=Stage.connection,
-                socket=sock,
-                name=None,
-                messages={},
-            )
+        for listener in (self._socket, self._unix_socket, self._handoff_socket):
+            if listener is None:
+                continue
 
-            thread = threading.Thread(
-                target=util.loop,
-                args=(
-                    self.handle_client,
-                    (sock, address),
-                ),
-            )
-            self._threads.append(thread)
-            thread.start()
+            listener.listen(4)
+            listener.setblocking(False)
+            self._selector.register(listener, selectors.EVENT_READ)
 
-    def handle_client(self, client: socket.socket, address: tuple[str, int]):
-        client_info = self.clients[address]
-        creds = client_info["creds"]
+        self._listening = True
 
-        if client_info["stage"] == Stage.connection:
-            # print(f"{address_format} connected")
-            private = util.x25519_private_key()
+        try:
+            while not self._closed and not self._handed_off:
+                self.poll()
+        finally:
+            self._listening = False
 
-            creds["private_key"] = private
+    def poll(self, timeout: float | None = None) -> bool:
+        """
+        One iteration of server loop: wait for socket events, handle them
+        and serve ready sessions
+        :param timeout: Longest wait, by default until the next scheduled work
+                        but at most POLL_INTERVAL
+        :return: Whether there was anything to do
+        """
+        if timeout is None:
+            if self._ready:
+                timeout = 0
+            elif self._throttled:
+                timeout = min(
+                    POLL_INTERVAL, max(0, self._throttled[0][0] - self.clock())
+                )
+            else:
+                timeout = POLL_INTERVAL
 
-            util.send_message(
-                client, util.x25519_public_key_to_bytes(private.public_key())
-            )
+        events = self._selector.select(timeout)
+
+        for key, mask in events:
+            if key.data is None:
+                if key.fileobj is self._handoff_socket:
+                    if self.hand_off():
+                        # Everything else is served by the new process now
+                        return True
+                    continue
+
+                self.accept(key.fileobj)
+                continue
+
+            if mask & selectors.EVENT_WRITE and key.data in self.clients:
+                self.flush(key.data)
 
-            client_info["stage"] = Stage.x25519
+            if mask & selectors.EVENT_READ and key.data in self.clients:
+                self.read(key.data)
 
-            util.send_message(client, Codes.ok.encode())
+        self.release_throttled()
+        self.expire()
+
+        busy = bool(events or self._ready)
+        self.serve()
+
+        # Messages indexed during this iteration are committed together
+        if self._search is not None:
+            self._search.commit()
+
+        return busy
+
+    def accept(self, listener: socket.socket):
+        try:
+            sock, address = listener.accept()
+        except BlockingIOError:
             return
 
-        if client_info["stage"] == Stage.x25519:
-            # print(f"{address_format} x25519 key exchanged")
+        if listener is self._unix_socket:
+            address = (self._unix_path, next(self._unix_ids))
+        else:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.connect(sock, address)
+
+    def connect(self, sock: socket.socket, address: tuple[str, int]):
+        """Start handshake of accepted connection"""
+        sock.setblocking(False)
+
+        if self._capture is not None:
+            self._capture.connect(address)
+
+        private = util.x25519_private_key()
+
+        self.clients[address] = session = Session(
+            sock,
+            private,
+            self._limiter(
+                self.limits.get("session_commands"),
+                self.limits.get("session_bytes"),
+            ),
+        )
+
+        # print(f"{address_format} connected")
+        self._send_raw(session, util.x25519_public_key_to_bytes(private.public_key()))
+        self._send_raw(session, Codes.ok.encode())
+        self.flush(address)
+
+    def _limiter(
+        self, commands: float | None, size: float | None
+    ) -> ratelimit.Limiter | None:
+        """Limiter for given limits, None if there are none"""
+        if commands is None and size is None:
+            return None
+
+        return ratelimit.Limiter(commands, size, self.clock)
+
+    def _add_name_limiter(self, name: bytes):
+        limiter = self._limiter(
+            self.limits.get("name_commands"),
+            self.limits.get("name_bytes"),
+        )
+
+        if limiter is not None:
+            self._name_limiters[name] = limiter
+
+    def hand_off(self) -> bool:
+        """
+        Pass listeners, connections and state to process connecting
+        to handoff socket
+        :return: Whether it took them over and this host stopped serving
+        """
+        try:
+            sock, _ = self._handoff_socket.accept()
+        except BlockingIOError:
+            return False
+
+        listeners = [
+            listener
+            for listener in (self._socket, self._unix_socket)
+            if listener is not None
+        ]
+        state = handoff.State(
+            version=handoff.VERSION,
+            clients=self.clients,
+            names=self._names,
+            mailboxes=self._mailboxes,
+            expiry=self._expiry,
+            expired=self._expired,
+            seen=self._seen,
+            left=self._left,
+            forget=self._forget,
+            metrics=self.metrics,
+            listeners=(self._socket is not None, self._unix_socket is not None),
+            unix_path=self._unix_path,
+            unix_id=next(self._unix_ids),
+        )
+
+        with sock:
+            sock.setblocking(True)
+            sock.settimeout(handoff.TIMEOUT)
+
+            try:
+                handoff.send(
+                    sock,
+                    pickle.dumps(state),
+                    [listener.fileno() for listener in listeners]
+                    + [session.socket.fileno() for session in self.clients.values()],
+                )
+
+                # New process failed to restore state - keep serving
+                if sock.recv(1) != handoff.READY:
+                    return False
+
+                sock.sendall(handoff.DONE)
+            except OSError:
+                return False
+
+        self._handed_off = True
+        return True
+
+    def _take_over(self, path: str) -> bool:
+        """
+        Take listeners, connections and state over from server handing
+        them off at path
+        :return: Whether there was a server to take them from
+        """
+        try:
+            sock = transport.unix_connection(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+
+        with sock:
+            sock.settimeout(handoff.TIMEOUT)
+            data, fds = handoff.receive(sock)
+            sockets = [socket.socket(fileno=fd) for fd in fds]
+
+            try:
+                state: handoff.State = pickle.loads(data)
+
+                if state["version"] != handoff.VERSION:
+                    raise RuntimeError(
+                        f"Can't take over from handoff version {state['version']}"
+                    )
+
+                sock.sendall(handoff.READY)
+
+                # Old server keeps serving unless it confirms it stopped
+                if sock.recv(1) != handoff.DONE:
+                    raise RuntimeError(f"Server at {path} didn't hand off")
+            except BaseException:
+                # Connections stay open in the process that keeps them
+                for other in sockets:
+                    other.close()
+                raise
+
+        self._restore(state, sockets)
+        return True
 
-            client_pub = util.x25519_public_key_from_bytes(
-                util.wait_event(client).data
+    def _restore(self, state: handoff.State, sockets: list[socket.socket]):
+        tcp, unix = state["listeners"]
+
+        if tcp:
+            self._socket = sockets.pop(0)
+        if unix:
+            self._unix_socket = sockets.pop(0)
+            self._unix_path = state["unix_path"]
+        self._unix_ids = itertools.count(state["unix_id"])
+
+        self._names = state["names"]
+        self._mailboxes = state["mailboxes"]
+        self._expiry = state["expiry"]
+        self._expired = state["expired"]
+        self._seen = state["seen"]
+        self._left = state["left"]
+        self._forget = state["forget"]
+        self.metrics = state["metrics"]
+
+        for (address, session), sock in zip(state["clients"].items(), sockets):
+            sock.setblocking(False)
+            session.socket = sock
+            session.limiter = self._limiter(
+                self.limits.get("session_commands"),
+                self.limits.get("session_bytes"),
             )
+            self.clients[address] = session
 
-            shared_secret = creds["private_key"].exchange(client_pub)
-            key, iv = util.derive_symmetric_keys(shared_secret)
+            if self._capture is not None:
+                self._capture.connect(address)
+
+                if session.name is not None:
+                    self._capture.online(address, session.name)
+
+            if session.throttled_until:
+                heapq.heappush(self._throttled, (session.throttled_until, address))
+            elif session.inbound:
+                session.ready = True
+                self._ready.append(address)
+
+            self._watch(address)
+
+        for name in self._names:
+            self._add_name_limiter(name)
+
+    def read(self, address: tuple[str, int]):
+        session = self.clients[address]
+
+        try:
+            data = session.socket.recv(READ_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            data = b""
+
+        if not data:
+            # print(f"{address_format} disconnected")
+            self.disconnect(address)
+            return
+
+        if session.inbound is None:
+            session.inbound = bytearray(data)
+        else:
+            session.inbound += data
+
+        if not session.ready:
+            session.ready = True
+            self._ready.append(address)
 
-            creds["symmetric_key"] = key
-            creds["symmetric_iv"] = iv
-            util.send_message(client, Codes.ok.encode())
+        self._watch(address)
 
-            # If user is already authorized, but requested key-flash
-            if client_info["name"] is None:
-                client_info["stage"] = Stage.aes
+    def serve(self):
+        """
+        Handle up to FRAMES_PER_TURN frames of every ready session,
+        sessions with more frames left wait for the next turn
+        """
+        for _ in range(len(self._ready)):
+            address = self._ready.popleft()
+            session = self.clients.get(address)
+
+            if session is None:
+                continue
+
+            try:
+                frames = util.take_frames(session.inbound, FRAMES_PER_TURN, MAX_FRAME)
+            except ValueError:
+                self.disconnect(address)
+                continue
+
+            for number, frame in enumerate(frames):
+                try:
+                    self.handle_client(address, frame)
+                except Exception:
+                    # Malformed frame, bad key, or frame sealed with unknown
+                    # or expired key epoch - only this client is dropped,
+                    # the loop goes on serving everyone else
+                    if address in self.clients:
+                        self.disconnect(address)
+                    break
+
+                if address not in self.clients:
+                    break
+
+                if session.throttled_until:
+                    # Rest of frames waits until session is released
+                    session.inbound[:0] = b"".join(
+                        util.frame(rest) for rest in frames[number + 1 :]
+                    )
+                    session.ready = False
+                    heapq.heappush(
+                        self._throttled, (session.throttled_until, address)
+                    )
+                    self.flush(address)
+                    break
             else:
-                client_info["stage"] = Stage.online
+                if len(frames) == FRAMES_PER_TURN and session.inbound:
+                    self._ready.append(address)
+                else:
+                    session.ready = False
+
+                self.flush(address)
+
+            # Buffer is dropped once emptied, idle sessions don't keep one
+            if not session.inbound:
+                session.inbound = None
+
+    def release_throttled(self):
+        """Return sessions whose throttling time passed to service"""
+        now = self.clock()
 
+        while self._throttled and self._throttled[0][0] <= now:
+            _, address = heapq.heappop(self._throttled)
+            session = self.clients.get(address)
+
+            if session is None:
+                continue
+
+            session.throttled_until = 0.0
+
+            if session.inbound and not session.ready:
+                session.ready = True
+                self._ready.append(address)
+
+            self._watch(address)
+
+    def flush(self, address: tuple[str, int]):
+        session = self.clients[address]
+
+        if session.outbound is not None:
+            try:
+                written = session.outbound.write(session.socket)
+            except ConnectionError:
+                self.disconnect(address)
+                return
+
+            if written:
+                session.outbound = None
+
+        self._watch(address)
+
+    def _watch(self, address: tuple[str, int]):
+        """
+        Register socket for events session can take now: reads unless it is
+        throttled or has too much unhandled input, writes while output is left
+        """
+        session = self.clients[address]
+        sock = session.socket
+
+        events = 0
+
+        if not session.throttled_until and (
+            session.inbound is None or len(session.inbound) < MAX_INBOUND
+        ):
+            events |= selectors.EVENT_READ
+
+        if session.outbound:
+            events |= selectors.EVENT_WRITE
+
+        if events == session.events:
+            return
+
+        if not session.events:
+            self._selector.register(sock, events, address)
+        elif not events:
+            self._selector.unregister(sock)
+        else:
+            self._selector.modify(sock, events, address)
+
+        session.events = events
+
+    def disconnect(self, address: tuple[str, int]):
+        session = self.clients.pop(address)
+
+        if self._capture is not None:
+            self._capture.disconnect(address)
+
+        if session.events:
+            self._selector.unregister(session.socket)
+        session.socket.close()
+
+        name = session.name
+        if name is None:
+            return
+
+        addresses = self._names[name]
+        addresses.remove(address)
+
+        if addresses:
+            for mailbox in self._mailboxes.get(name, {}).values():
+                mailbox.leave(address)
             return
 
-        if client_info["stage"] == Stage.aes:
+        # Pending messages are kept only while some session of the name is online
+        del self._names[name]
+        # Messages are freed now, not when their expiry comes
+        for mailbox in self._mailboxes.pop(name, {}).values():
+            mailbox.clear()
+        self._expired.pop(name, None)
+        self._name_limiters.pop(name, None)
+
+        if name in self._seen:
+            now = self.clock()
+            self._left[name] = now
+
+            if not self._forget:
+                self._forget.advance(now)
+            self._forget.schedule(now + DEDUP_KEEP, (name, now))
+
+    def handle_client(self, address: tuple[str, int], frame: bytes):
+        """Handle one frame of a client, raises on malformed input"""
+        session = self.clients[address]
+
+        if session.stage == Stage.x25519:
+            # print(f"{address_format} x25519 key exchanged")
+
+            client_pub = util.x25519_public_key_from_bytes(frame)
+
+            shared_secret = session.private_key.exchange(client_pub)
+            key, iv = util.derive_symmetric_keys(shared_secret)
+
+            session.key = key
+            session.iv = iv
+            self._send_raw(session, Codes.ok.encode())
+
+            session.stage = Stage.aes
+            return
+
+        if session.stage == Stage.aes:
             # print(f"{address_format} aes key acquired")
 
-            key, iv = creds["symmetric_key"], creds["symmetric_iv"]
+            key, iv = session.key, session.iv
 
-            data = util.aes_decrypt(key, iv, util.wait_event(client).data)
+            data = util.aes_decrypt(key, iv, frame)
 
             if len(data) > 255:
-                util.send_message(
-                    client,
-                    util.aes_encrypt(
-                        key,
-                        iv,
-                        Codes.name_too_long.encode(),
-                    ),
+                self._send_raw(
+                    session,
+                    util.aes_encrypt(key, iv, Codes.name_too_long.encode()),
                 )
                 return
 
-            client_info["name"] = data
-            client_info["stage"] = Stage.online
+            session.go_online(data)
+
+            if self._capture is not None:
+                self._capture.online(address, data)
 
-            util.send_message(
-                client, util.aes_encrypt(key, iv, Codes.ok.encode())
+            self._names.setdefault(data, []).append(address)
+            # Ids sent before reconnecting are remembered until it leaves again
+            self._left.pop(data, None)
+            for mailbox in self._mailboxes.get(data, {}).values():
+                mailbox.join(address)
+
+            if data not in self._name_limiters:
+                self._add_name_limiter(data)
+
+            self._send_raw(
+                session, util.aes_encrypt(key, iv, Codes.ok.encode())
             )
 
             # print(f"{address_format} registered")
             return
 
-        event = util.read_event(client)
-
-        if event.close_connection:
-            # print(f"{address_format} disconnected")
-            del self.clients[address]
-            raise StopIteration
+        # Client is online and ready to send and receive messages
+        lane, opaque, payload = session.assembler.feed(frame)
 
-        if event.no_message:
+        if payload is None:
             return
 
-        # Client is online and ready to send and receive messages
-        key, iv = creds["symmetric_key"], creds["symmetric_iv"]
-        data = util.aes_decrypt(key, iv, event.data)
+        # Only header of opaque payload is sealed with session keys
+        body = None
+        if opaque:
+            header, body = lanes.split_opaque(payload)
+            data = self._open(session, header)
+        else:
+            data = self._open(session, payload)
 
         command = util.parse_command(data)
         command, args = command["command"], command["args"]
 
+        if self._capture is not None:
+            self._record(address, lane, command, args, payload, body)
+
+        if command not in UNLIMITED_COMMANDS:
+            limiters = [
+                limiter
+                for limiter in (session.limiter, self._name_limiters.get(session.name))
+                if limiter is not None
+            ]
+
+            # Refused command is charged to neither limiter
+            delay = max(
+                (limiter.delay(len(payload)) for limiter in limiters), default=0
+            )
+
+            if delay:
+                # Session isn't read nor served until limits allow its next command
+                session.throttled_until = self.clock() + delay
+                self._reply(session, lane, Codes.throttled.encode())
+                return
+
+            for limiter in limiters:
+                limiter.take(len(payload))
+
         if command == Commands.ping:
             # print(f"{address_format} pong")
-            util.send_message(client, Codes.ok.encode())
+            self._reply(session, lane, Codes.ok.encode())
             return
 
         if command == Commands.reset_keys:
+            # In-band rekey: session stays online, frames of the previous
+            # epoch are still accepted during grace window
+            client_pub, _ = util.parse_part(1, args)
+
             private = util.x25519_private_key()
-            creds["private_key"] = private
-            util.send_message(
-                client, util.x25519_public_key_to_bytes(private.public_key())
+            key, iv = util.derive_symmetric_keys(
+                private.exchange(util.x25519_public_key_from_bytes(client_pub))
             )
-            client_info["stage"] = Stage.x25519
+
+            # Reply is sealed with current epoch - new one is used right after it
+            self._reply(
+                session,
+                lane,
+                util.pack_command(
+                    Commands.reset_keys,
+                    (util.x25519_public_key_to_bytes(private.public_key()), 1),
+                ),
+            )
+
+            session.previous = (
+                session.epoch,
+                session.key,
+                session.iv,
+            )
+            session.previous_expires = self.clock() + KEY_GRACE
+            session.epoch = (session.epoch + 1) % 256
+            session.key, session.iv = key, iv
+            return
+
+        if command == Commands.negotiate:
+            offered = []
+            while args:
+                codec, args = util.parse_part(1, args)
+                offered.append(codec.decode())
+
+            codec = compression.choose(offered)
+
+            # Reply is sent uncompressed - codec is enabled right after it
+            self._reply(
+                session,
+                lane,
+                util.pack_command(Commands.negotiate, ((codec or "").encode(), 1)),
+            )
+            session.compression = codec
+            return
+
+        if command == Commands.publish_key:
+            key, _ = util.parse_part(1, args)
+            session.e2e_key = key
+
+            self._reply(session, lane, Codes.ok.encode())
+            return
+
+        if command == Commands.get_key:
+            peer_name, _ = util.parse_part(1, args)
+            keys = [peer.e2e_key for peer in self.sessions(peer_name)]
+
+            # Sessions without a key couldn't read relayed messages,
+            # so peer is reachable end-to-end only if every session has one
+            if not keys or None in keys:
+                self._reply(session, lane, Codes.no_receiver.encode())
+                return
+
+            self._reply(
+                session,
+                lane,
+                util.pack_command(Commands.get_key, *((key, 1) for key in keys)),
+            )
+            return
+
+        if command == Commands.relay:
+            receiver_name, args = util.parse_part(1, args)
+            receiver_key, args = util.parse_part(1, args)
+            # Number of sessions sender encrypts message to, if it is sent
+            devices, args = util.parse_part(1, args)
+
+            if body is None:
+                self.disconnect(address)
+                return
+
+            keys = [receiver.e2e_key for receiver in self.sessions(receiver_name)]
+
+            if not keys:
+                self._reply(session, lane, Codes.no_receiver.encode())
+                return
+
+            # Body was encrypted to a key receiver doesn't have anymore,
+            # or sender doesn't know about some session of receiver
+            if receiver_key not in keys or (
+                devices and int.from_bytes(devices, byteorder="big") != len(keys)
+            ):
+                self._reply(session, lane, Codes.key_changed.encode())
+                return
+
+            self._store(receiver_name, session.name, body, receiver_key, args)
+
+            self._reply(session, lane, Codes.ok.encode())
             return
 
         if command == Commands.send_message:
@@ -170,80 +825,366 @@ class Host:
 
             # print(f"{address_format} send message to {receiver_name}")
 
-            receiver = self.find_client(receiver_name)
-
-            if receiver is None:
-                util.send_message(
-                    client,
-                    util.aes_encrypt(key, iv, Codes.no_receiver.encode()),
-                )
+            if receiver_name not in self._names:
+                self._reply(session, lane, Codes.no_receiver.encode())
                 return
 
-            message, _ = util.parse_part(2, args)
+            message, args = util.parse_part(2, args)
+
+            # Stored once, read by every session of receiver
+            stored = self._store(receiver_name, session.name, message, None, args)
+
+            if stored and self._search is not None:
+                self._search.add(session.name, receiver_name, message, time.time())
+
+            self._reply(session, lane, Codes.ok.encode())
+            return
 
-            messages = client_info["messages"].setdefault(receiver_name, [])
+        if command == Commands.search:
+            if self._search is None:
+                self._reply(session, lane, Codes.not_supported.encode())
+                return
 
-            messages.append(message)
+            peer_name, args = util.parse_part(1, args)
+            query, args = util.parse_part(2, args)
+            before, args = util.parse_part(1, args)
+            limit, _ = util.parse_part(1, args)
 
-            util.send_message(
-                client, util.aes_encrypt(key, iv, Codes.ok.encode())
+            hits = self._search.search(
+                session.name,
+                peer_name,
+                query.decode(errors="replace"),
+                int.from_bytes(before, byteorder="big") or None,
+                int.from_bytes(limit, byteorder="big") or 20,
             )
 
+            blocks = []
+            for hit in hits:
+                blocks += [
+                    (hit["id"].to_bytes(8, byteorder="big"), 1),
+                    (hit["sender"], 1),
+                    (int(hit["time"] * 1000).to_bytes(8, byteorder="big"), 1),
+                    (hit["snippet"].encode(), 2),
+                ]
+
+            self._reply(session, lane, util.pack_command(Commands.search, *blocks))
+            return
+
         if command == Commands.receive_messages:
             sender_name, args = util.parse_part(1, args)
 
-            sender = self.find_client(sender_name)
+            messages_copy = self._take(address, sender_name, 0xFF)
 
-            if sender is None:
-                util.send_message(
-                    client,
-                    util.aes_encrypt(key, iv, Codes.no_sender.encode()),
-                )
+            # Messages sent before sender went offline are still delivered
+            if not messages_copy and sender_name not in self._names:
+                self._reply(session, lane, Codes.no_sender.encode())
                 return
 
             # print(f"{address_format} receive messages from {sender_name}")
 
-            messages = sender["messages"].setdefault(client_info["name"], [])
-
-            # Messages list copy is required to list only messages
-            # that exists when client requested
-            messages_copy = messages.copy()
-
-            util.send_message(
-                client,
-                util.aes_encrypt(
-                    key,
-                    iv,
-                    util.pack_command(
-                        Commands.receive_messages,
-                        (len(messages_copy).to_bytes(1, byteorder="big"), 1),
-                    ),
+            self._reply(
+                session,
+                lane,
+                util.pack_command(
+                    Commands.receive_messages,
+                    (len(messages_copy).to_bytes(1, byteorder="big"), 1),
                 ),
             )
 
             for message in messages_copy:
-                messages.pop(0)
-                util.send_message(
-                    client,
-                    util.aes_encrypt(key, iv, message),
+                self._deliver(session, lane, b"", message)
+
+            self._reply(session, lane, Codes.ok.encode())
+            return
+
+        if command == Commands.receive_all:
+            peers = []
+            while args:
+                peer, args = util.parse_part(1, args)
+                peers.append(peer)
+
+            presence = bytes(peer in self._names for peer in peers)
+
+            # Receivers of expired messages sender asked to be told about
+            expired = self._expired.pop(session.name, [])
+
+            batch: list[tuple[bytes, bytes | memoryview]] = []
+            for sender_name in list(self._mailboxes.get(session.name, {})):
+                messages = self._take(address, sender_name, MAX_BATCH - len(batch))
+
+                batch.extend((sender_name, message) for message in messages)
+
+                if len(batch) == MAX_BATCH:
+                    break
+
+            self._reply(
+                session,
+                lane,
+                util.pack_command(
+                    Commands.receive_all,
+                    (len(batch).to_bytes(2, byteorder="big"), 1),
+                    (presence, 2),
+                    (len(expired).to_bytes(4, byteorder="big"), 1),
+                ),
+            )
+
+            for sender_name, message in batch:
+                self._deliver(
+                    session,
+                    lane,
+                    len(sender_name).to_bytes(1, byteorder="big") + sender_name,
+                    message,
                 )
 
-            util.send_message(
-                client,
-                util.aes_encrypt(key, iv, Codes.ok.encode()),
+            for receiver_name in expired:
+                self._reply(
+                    session, lane, Codes.message_expired.encode() + receiver_name
+                )
+
+            self._reply(session, lane, Codes.ok.encode())
+            return
+
+    @staticmethod
+    def _send_raw(session: Session, data: bytes):
+        """Queue handshake frame - sent before lanes are in use"""
+        session.push(lanes.CONTROL, [util.frame(data)])
+
+    def _reply(self, session: Session, lane: int, data: bytes):
+        """Queue sealed payload on lane, chunked if it is large"""
+        session.push(
+            lane, lanes.frames(lane, self._seal(session, data))
+        )
+
+    def _deliver(
+        self,
+        session: Session,
+        lane: int,
+        prefix: bytes,
+        message: bytes | memoryview,
+    ):
+        """
+        Queue stored message, prefix is sealed together with message body,
+        or alone as header of end-to-end encrypted one
+        """
+        if isinstance(message, memoryview):
+            session.push(
+                lane,
+                lanes.frames(
+                    lane,
+                    lanes.pack_opaque(self._seal(session, prefix), message),
+                    opaque=True,
+                ),
             )
             return
 
-    def find_client(self, name: bytes) -> Client | None:
-        for client in self.clients.values():
-            if client["name"] == name:
-                return client
+        self._reply(session, lane, prefix + message)
+
+    @staticmethod
+    def _seal(session: Session, data: bytes) -> bytes:
+        return session.epoch.to_bytes(1, byteorder="big") + util.aes_encrypt(
+            session.key,
+            session.iv,
+            compression.pack(session.compression, data),
+        )
+
+    def _open(self, session: Session, data: bytes) -> bytes:
+        epoch, data = data[0], data[1:]
+
+        # Replaced keys are dropped once grace window is over
+        if session.previous is not None and self.clock() >= session.previous_expires:
+            session.previous = None
+
+        if epoch == session.epoch:
+            key, iv = session.key, session.iv
+        elif session.previous is not None and session.previous[0] == epoch:
+            _, key, iv = session.previous
+        else:
+            raise ValueError(f"Unknown key epoch {epoch}")
+
+        return compression.unpack(
+            session.compression, util.aes_decrypt(key, iv, data)
+        )
+
+    def _record(
+        self,
+        address: tuple[str, int],
+        lane: int,
+        command: str,
+        args: bytes,
+        payload: bytes,
+        body: memoryview | None,
+    ):
+        peer = None
+        size = len(payload)
+
+        if command in ADDRESSED_COMMANDS:
+            peer, rest = util.parse_part(1, args)
+
+            # Size of message itself, as replay sends it
+            if body is not None:
+                size = len(body)
+            elif command == Commands.send_message:
+                size = len(util.parse_part(2, rest)[0])
+
+        self._capture.command(address, lane, command, size, peer)
+
+    def _mailbox(self, receiver: bytes, sender: bytes) -> Mailbox:
+        mailboxes = self._mailboxes.setdefault(receiver, {})
+
+        if sender not in mailboxes:
+            mailboxes[sender] = Mailbox(self._names[receiver])
+
+        return mailboxes[sender]
+
+    def _take(
+        self, address: tuple[str, int], sender: bytes, limit: int
+    ) -> list[bytes | memoryview]:
+        """Messages from sender session at address hasn't read yet"""
+        session = self.clients[address]
+        mailboxes = self._mailboxes.get(session.name)
+
+        if mailboxes is None or sender not in mailboxes:
+            return []
+
+        messages = mailboxes[sender].take(address, session.e2e_key, limit)
+        self._drop_empty(session.name, sender)
+
+        return messages
+
+    def _drop_empty(self, receiver: bytes, sender: bytes):
+        """Drop mailbox once every message in it was read or expired"""
+        mailboxes = self._mailboxes.get(receiver)
+
+        if mailboxes is None or sender not in mailboxes or mailboxes[sender]:
+            return
+
+        del mailboxes[sender]
+        if not mailboxes:
+            del self._mailboxes[receiver]
+
+    def _store(
+        self,
+        receiver: bytes,
+        sender: bytes,
+        message: bytes | memoryview,
+        key: bytes | None,
+        args: bytes,
+    ) -> bool:
+        """
+        Put message to receiver's mailbox. Optional args are TTL
+        in milliseconds, whether sender wants to know if it expires
+        and message id
+        :return: False if message with the same id was stored already
+        """
+        ttl_bytes, args = util.parse_part(1, args)
+        report, args = util.parse_part(1, args)
+        message_id, _ = util.parse_part(1, args)
+
+        if message_id:
+            seen = self._seen.setdefault(sender, {})
+            entry = message_id + (key or b"")
+
+            # Sent again after its reply was lost, it is acknowledged as usual
+            if entry in seen:
+                self.metrics["duplicates_dropped"] += 1
+                return False
+
+            seen[entry] = None
+            if len(seen) > DEDUP_WINDOW:
+                del seen[next(iter(seen))]
+
+        mailbox = self._mailbox(receiver, sender)
+        position = mailbox.append(message, key)
+
+        ttl = int.from_bytes(ttl_bytes, byteorder="big") / 1000 if ttl_bytes else None
+
+        # Server default is also the longest TTL sender can ask for
+        if self.message_ttl is not None:
+            ttl = self.message_ttl if ttl is None else min(ttl, self.message_ttl)
+
+        if ttl is None:
+            return True
+
+        if not self._expiry:
+            # Empty wheel catches up with clock before it is used again
+            self.expire()
+
+        self._expiry.schedule(
+            self.clock() + ttl,
+            (receiver, sender, mailbox, position, report == b"\x01"),
+        )
+        return True
+
+    def expire(self):
+        """
+        Drop messages whose TTL passed, and message ids of senders gone
+        long enough, in batches of EXPIRY_TICK
+        """
+        for receiver, sender, mailbox, position, report in self._expiry.advance(
+            self.clock()
+        ):
+            # Message was read by every session already,
+            # or went away with the last session of receiver
+            if not mailbox.expire(position):
+                continue
+
+            self.metrics["messages_expired"] += 1
+
+            if report and sender in self._names:
+                self._expired.setdefault(sender, []).append(receiver)
+                self.metrics["expiry_reports"] += 1
+
+            self._drop_empty(receiver, sender)
+
+        for name, left in self._forget.advance(self.clock()):
+            # Sender came back since, maybe left again later
+            if self._left.get(name) == left:
+                del self._left[name]
+                self._seen.pop(name, None)
+
+    def sessions(self, name: bytes) -> list[Session]:
+        """Online sessions of name, one per device"""
+        return [self.clients[address] for address in self._names.get(name, ())]
+
+    def find_client(self, name: bytes) -> Session | None:
+        """Any online session of name"""
+        addresses = self._names.get(name)
+
+        if addresses:
+            return self.clients[addresses[0]]
 
     def close(self):
         self._closed = True
-        self._socket.close()
-        for thread in self._threads:
-            thread.join()
+
+        # Loop notices closing within POLL_INTERVAL
+        while self._listening:
+            time.sleep(0.01)
+
+        if self._search is not None:
+            self._search.close()
+
+        if self._capture is not None:
+            self._capture.close()
+
+        for session in self.clients.values():
+            session.socket.close()
+        self.clients.clear()
+
+        self._selector.close()
+
+        if self._socket is not None:
+            self._socket.close()
+
+        # Socket files belong to the server that took over
+        if self._unix_socket is not None:
+            self._unix_socket.close()
+            if not self._handed_off and os.path.exists(self._unix_path):
+                os.unlink(self._unix_path)
+
+        if self._handoff_socket is not None:
+            self._handoff_socket.close()
+            if not self._handed_off and os.path.exists(self._handoff_path):
+                os.unlink(self._handoff_path)
 
     def __del__(self):
         if not self._closed:
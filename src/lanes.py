@@ -0,0 +1,161 @@
+"""
+Priority lanes multiplexed over one connection.
+
+Every frame of an online session starts with a flags byte: lane of the
+frame, whether more chunks of the same payload follow and whether payload
+is opaque. Payloads longer than ``CHUNK_SIZE`` are split into chunks,
+so frames of higher priority lanes can be written between chunks
+of a large transfer.
+
+Opaque payload is a sealed header, prefixed with its 2-byte length,
+followed by body that is end-to-end encrypted between peers and relayed
+by server as is.
+"""
+
+import collections
+import socket
+
+from src import compression
+
+CONTROL = 0
+INTERACTIVE = 1
+BULK = 2
+
+# Lanes in order they are written
+LANES = (CONTROL, INTERACTIVE, BULK)
+
+LANE_MASK = 0x03
+OPAQUE = 0x40
+MORE = 0x80
+
+CHUNK_SIZE = 16 * 1024
+
+# Server refuses payloads reassembled beyond this size
+MAX_PAYLOAD = compression.MAX_SIZE
+
+
+def frames(
+    lane: int, data: bytes, opaque: bool = False, chunk_size: int = CHUNK_SIZE
+) -> list[bytes]:
+    """Split payload into length prefixed frames tagged with lane"""
+    result = []
+    lane |= OPAQUE if opaque else 0
+
+    for start in range(0, max(len(data), 1), chunk_size):
+        chunk = data[start : start + chunk_size]
+        flags = lane | (MORE if start + chunk_size < len(data) else 0)
+
+        result.append(
+            (len(chunk) + 1).to_bytes(4, byteorder="big")
+            + flags.to_bytes(1, byteorder="big")
+            + chunk
+        )
+
+    return result
+
+
+class Assembler:
+    """Joins chunks of payloads back, separately for every lane"""
+
+    __slots__ = ("_chunks", "_max_size")
+
+    def __init__(self, max_size: int | None = None):
+        """:param max_size: Longest payload accepted, unlimited by default"""
+        # Payloads still being received, by lane
+        self._chunks: dict[int, bytearray] | None = None
+        self._max_size = max_size
+
+    def feed(self, frame: bytes) -> tuple[int, bool, bytes | None]:
+        """
+        :param frame: Frame body - flags byte and chunk
+        :return: Lane of the frame, whether payload is opaque
+                 and payload once its last chunk arrived
+        """
+        flags = frame[0]
+        lane = flags & LANE_MASK
+
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane {lane}")
+
+        pending = self._chunks is not None and lane in self._chunks
+
+        if not flags & MORE and not pending:
+            return lane, bool(flags & OPAQUE), frame[1:]
+
+        if self._chunks is None:
+            self._chunks = {}
+
+        chunks = self._chunks.setdefault(lane, bytearray())
+        chunks += memoryview(frame)[1:]
+
+        if self._max_size is not None and len(chunks) > self._max_size:
+            raise ValueError("Payload too large")
+
+        if flags & MORE:
+            return lane, False, None
+
+        del self._chunks[lane]
+        if not self._chunks:
+            self._chunks = None
+
+        return lane, bool(flags & OPAQUE), bytes(chunks)
+
+
+def pack_opaque(header: bytes, body: bytes | memoryview) -> bytes:
+    return b"".join((len(header).to_bytes(2, byteorder="big"), header, body))
+
+
+def split_opaque(payload: bytes) -> tuple[bytes, memoryview]:
+    """Header and body of opaque payload, body isn't copied"""
+    length = int.from_bytes(payload[:2], byteorder="big")
+    view = memoryview(payload)
+    return bytes(view[2 : 2 + length]), view[2 + length :]
+
+
+class Outbound:
+    """
+    Frames waiting to be written to non-blocking socket.
+    Next frame is always taken from the highest priority non-empty lane
+    """
+
+    def __init__(self):
+        self._queues: dict[int, collections.deque[bytes]] = {
+            lane: collections.deque() for lane in LANES
+        }
+        self._current = memoryview(b"")
+
+    def __bool__(self) -> bool:
+        return bool(self._current) or any(self._queues.values())
+
+    def __getstate__(self) -> tuple:
+        return self._queues, bytes(self._current)
+
+    def __setstate__(self, state: tuple):
+        self._queues, current = state
+        self._current = memoryview(current)
+
+    def push(self, lane: int, frames: list[bytes]):
+        self._queues[lane].extend(frames)
+
+    def _next(self) -> bool:
+        for lane in LANES:
+            if self._queues[lane]:
+                self._current = memoryview(self._queues[lane].popleft())
+                return True
+
+        return False
+
+    def write(self, sock: socket.socket) -> bool:
+        """
+        Write as much as socket accepts without blocking
+        :return: Whether everything was written
+        """
+        while self._current or self._next():
+            try:
+                sent = sock.send(self._current)
+            except BlockingIOError:
+                return False
+
+            self._current = self._current[sent:]
+
+        return True
@@ -0,0 +1,117 @@
+import typing
+
+Message = bytes | memoryview
+
+
+class Mailbox:
+    """
+    Messages from one sender to every session of one name.
+
+    Every message is stored once and read by each session at its own
+    cursor; messages all sessions have read are dropped. End-to-end
+    encrypted bodies carry the key of the session they were encrypted to
+    and are read only by it. Expired messages and read end-to-end encrypted
+    ones are left as None in place until they can be dropped.
+    """
+
+    __slots__ = ("_entries", "_base", "_cursors")
+
+    def __init__(self, readers: typing.Iterable[tuple[str, int]]):
+        # (key of the only session that reads it or None, message)
+        self._entries: list[tuple[bytes | None, Message] | None] = []
+        # Position of the first kept message since mailbox was created
+        self._base = 0
+        self._cursors: dict[tuple[str, int], int] = {
+            reader: 0 for reader in readers
+        }
+
+    def __bool__(self) -> bool:
+        return bool(self._entries)
+
+    def __getstate__(self) -> tuple:
+        # Bodies of end-to-end encrypted messages are views of received payloads
+        entries = [
+            entry if entry is None else (entry[0], bytes(entry[1]))
+            for entry in self._entries
+        ]
+        return entries, self._base, self._cursors
+
+    def __setstate__(self, state: tuple):
+        entries, self._base, self._cursors = state
+        # Only end-to-end encrypted messages carry a key, and they are relayed opaque
+        self._entries = [
+            (entry[0], memoryview(entry[1]))
+            if entry is not None and entry[0] is not None
+            else entry
+            for entry in entries
+        ]
+
+    def append(self, message: Message, key: bytes | None = None) -> int:
+        """:return: Position of message, to expire it by"""
+        self._entries.append((key, message))
+        return self._base + len(self._entries) - 1
+
+    def expire(self, position: int) -> bool:
+        """:return: Whether message was still unread by some session"""
+        index = position - self._base
+
+        if index < 0 or self._entries[index] is None:
+            return False
+
+        self._entries[index] = None
+        self._trim()
+        return True
+
+    def clear(self):
+        self._base += len(self._entries)
+        self._entries.clear()
+
+    def join(self, reader: tuple[str, int]):
+        """Session joining later reads only messages that arrive after it"""
+        self._cursors[reader] = self._base + len(self._entries)
+
+    def leave(self, reader: tuple[str, int]):
+        del self._cursors[reader]
+        self._trim()
+
+    def take(
+        self, reader: tuple[str, int], key: bytes | None, limit: int
+    ) -> list[Message]:
+        """
+        Up to limit messages reader hasn't read yet, skipping ones
+        encrypted to other sessions
+        """
+        messages = []
+        position = max(self._cursors[reader] - self._base, 0)
+
+        while position < len(self._entries) and len(messages) < limit:
+            entry = self._entries[position]
+            position += 1
+
+            if entry is None or entry[0] not in (None, key):
+                continue
+
+            messages.append(entry[1])
+
+            # Only its session reads end-to-end encrypted body - drop it right away
+            if entry[0] is not None:
+                self._entries[position - 1] = None
+
+        self._cursors[reader] = self._base + position
+        self._trim()
+
+        return messages
+
+    def _trim(self):
+        low = min(self._cursors.values(), default=self._base + len(self._entries))
+        low = max(low, self._base)
+
+        # Expired messages at the front are dropped even if not everyone read past them
+        while (
+            low - self._base < len(self._entries)
+            and self._entries[low - self._base] is None
+        ):
+            low += 1
+
+        del self._entries[: low - self._base]
+        self._base = low
@@ -0,0 +1,112 @@
+import typing
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` units per second on average and bursts of up to ``burst`` units
+    """
+
+    __slots__ = ("rate", "burst", "_clock", "_tokens", "_updated")
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float | None,
+        clock: typing.Callable[[], float],
+    ):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._clock = clock
+
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def delay(self, amount: float = 1) -> float:
+        """
+        Check tokens without taking them
+        :return: 0 if there is enough of them, otherwise seconds until there will be
+        """
+        self._refill()
+
+        if self._tokens < amount:
+            return (amount - self._tokens) / self.rate
+
+        return 0
+
+    def take(self, amount: float = 1) -> float:
+        """
+        Take tokens if there is enough of them
+        :return: 0 if tokens were taken, otherwise seconds until there will be enough
+        """
+        if delay := self.delay(amount):
+            return delay
+
+        self._tokens -= amount
+        return 0
+
+
+class RateLimits(typing.TypedDict, total=False):
+    """Limits per second, missing or None means unlimited"""
+
+    session_commands: float | None
+    session_bytes: float | None
+    name_commands: float | None
+    name_bytes: float | None
+
+
+class Limiter:
+    """Commands and bytes buckets of one session or name"""
+
+    __slots__ = ("_commands", "_bytes")
+
+    def __init__(
+        self,
+        commands: float | None,
+        size: float | None,
+        clock: typing.Callable[[], float],
+    ):
+        self._commands = (
+            None if commands is None else TokenBucket(commands, None, clock)
+        )
+        self._bytes = None if size is None else TokenBucket(size, None, clock)
+
+    def _costs(self, size: int) -> list[tuple[TokenBucket, float]]:
+        costs = []
+
+        if self._commands is not None:
+            costs.append((self._commands, 1))
+
+        # Payloads larger than the whole burst can still pass once bucket is full
+        if self._bytes is not None:
+            costs.append((self._bytes, min(size, self._bytes.burst)))
+
+        return costs
+
+    def delay(self, size: int) -> float:
+        """
+        Check command of size bytes without accounting it
+        :return: 0 if it is allowed, otherwise seconds until it would be
+        """
+        return max(
+            (bucket.delay(amount) for bucket, amount in self._costs(size)), default=0
+        )
+
+    def take(self, size: int) -> float:
+        """
+        Account command of size bytes. Nothing is taken unless every bucket allows it
+        :return: 0 if it is allowed, otherwise seconds until it would be
+        """
+        if delay := self.delay(size):
+            return delay
+
+        for bucket, amount in self._costs(size):
+            bucket.take(amount)
+
+        return 0
@@ -0,0 +1,190 @@
+"""
+Opt-in server-side history search.
+
+Plain-text spans of messages are split into terms and kept in an on-disk
+inverted index. Postings are keyed by conversation, term and message id,
+so a query reads only postings of its own terms in one conversation,
+newest first, and pages continue from the last id seen. Index is updated
+as messages arrive and committed in batches by the server loop.
+
+End-to-end encrypted messages can't be read by server and aren't indexed.
+"""
+
+import typing
+import re
+
+from src import segments
+
+# Longer words are cut to this many characters
+MAX_TERM = 64
+# Characters of message text around the first match returned with a hit
+SNIPPET = 80
+# Most hits returned by one query
+MAX_HITS = 100
+
+WORD = re.compile(r"\w+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation BLOB NOT NULL,
+    sender BLOB NOT NULL,
+    time REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    conversation BLOB NOT NULL,
+    term TEXT NOT NULL,
+    message INTEGER NOT NULL,
+    PRIMARY KEY (conversation, term, message)
+) WITHOUT ROWID;
+"""
+
+
+class Hit(typing.TypedDict):
+    id: int
+    sender: bytes
+    time: float
+    snippet: str
+
+
+def conversation(first: bytes, second: bytes) -> bytes:
+    """Same key for both directions of conversation"""
+    return b"".join(
+        len(name).to_bytes(1, byteorder="big") + name
+        for name in sorted((first, second))
+    )
+
+
+def terms(text: str) -> list[str]:
+    """Distinct words of text, lowercased, in order of appearance"""
+    words = (word[:MAX_TERM] for word in WORD.findall(text.lower()))
+    return list(dict.fromkeys(words))
+
+
+def text_of(message: bytes) -> str | None:
+    """Plain text of rich-text message, None if it isn't one"""
+    try:
+        return "".join(segment["text"] for segment in segments.decode(message))
+    except (ValueError, IndexError, KeyError, TypeError):
+        return None
+
+
+def snippet(text: str, words: list[str]) -> str:
+    lowered = text.lower()
+    start = min(
+        (index for word in words if (index := lowered.find(word)) != -1),
+        default=0,
+    )
+
+    match = start
+    start = max(0, start - SNIPPET // 4)
+
+    # Don't start in the middle of a word
+    if start > 0 and (space := text.find(" ", start, match)) != -1:
+        start = space + 1
+
+    result = text[start : start + SNIPPET]
+
+    if start > 0:
+        result = "…" + result
+    if start + SNIPPET < len(text):
+        result += "…"
+
+    return result
+
+
+class SearchIndex:
+    def __init__(self, path: str):
+        # Imported here - servers without search and clients using Hit don't need it
+        import sqlite3
+
+        # Used only from the server loop, which may run in another thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+        # Messages added since last commit
+        self.pending = 0
+
+    def add(self, sender: bytes, receiver: bytes, message: bytes, time: float):
+        text = text_of(message)
+
+        if not text:
+            return
+
+        key = conversation(sender, receiver)
+        cursor = self._db.execute(
+            "INSERT INTO messages (conversation, sender, time, text)"
+            " VALUES (?, ?, ?, ?)",
+            (key, sender, time, text),
+        )
+        self._db.executemany(
+            "INSERT OR IGNORE INTO postings VALUES (?, ?, ?)",
+            ((key, term, cursor.lastrowid) for term in terms(text)),
+        )
+
+        self.pending += 1
+
+    def commit(self):
+        if self.pending:
+            self._db.commit()
+            self.pending = 0
+
+    def search(
+        self,
+        user: bytes,
+        peer: bytes,
+        query: str,
+        before: int | None = None,
+        limit: int = 20,
+    ) -> list[Hit]:
+        """
+        Messages of conversation containing every word of query, newest first
+        :param before: Id of the last hit of previous page
+        """
+        # Longer words are usually rarer - their postings drive the scan
+        words = sorted(terms(query), key=len, reverse=True)
+
+        if not words:
+            return []
+
+        key = conversation(user, peer)
+        sql = (
+            "SELECT p.message FROM postings p"
+            " WHERE p.conversation = ? AND p.term = ? AND p.message < ?"
+        )
+        params: list[typing.Any] = [key, words[0], before or 2**63 - 1]
+
+        for word in words[1:]:
+            sql += (
+                " AND EXISTS (SELECT 1 FROM postings"
+                " WHERE conversation = p.conversation AND term = ?"
+                " AND message = p.message)"
+            )
+            params.append(word)
+
+        sql += " ORDER BY p.message DESC LIMIT ?"
+        params.append(min(limit, MAX_HITS))
+
+        ids = [row[0] for row in self._db.execute(sql, params)]
+
+        if not ids:
+            return []
+
+        rows = self._db.execute(
+            "SELECT id, sender, time, text FROM messages"
+            f" WHERE id IN ({', '.join('?' * len(ids))}) ORDER BY id DESC",
+            ids,
+        )
+
+        return [
+            Hit(id=id, sender=sender, time=time, snippet=snippet(text, words))
+            for id, sender, time, text in rows
+        ]
+
+    def close(self):
+        self.commit()
+        self._db.close()
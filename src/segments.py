@@ -0,0 +1,155 @@
+"""
+Wire format of rich-text messages.
+
+Message is a flat list of styled text segments. Two encodings are supported:
+
+* version 0 - legacy JSON list of segment dicts (payload starts with ``[``)
+* version 1 - binary: version byte, interned color table, then per segment
+  a style bitfield, optional color index and length-prefixed UTF-8 text.
+  All integers are unsigned LEB128 varints.
+"""
+
+import typing
+import json
+
+
+JSON = 0
+BINARY = 1
+
+VERSION = BINARY
+
+BOLD = 0b0001
+ITALIC = 0b0010
+UNDERLINE = 0b0100
+COLORED = 0b1000
+
+
+class Segment(typing.TypedDict):
+    text: str
+    bold: bool
+    italic: bool
+    underline: bool
+    color: str | None
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+
+        if byte < 0x80:
+            return value, offset
+
+        shift += 7
+
+
+def encode(segments: list[Segment], version: int = VERSION) -> bytes:
+    if version == JSON:
+        return json.dumps(segments, ensure_ascii=False).encode()
+
+    if version != BINARY:
+        raise ValueError(f"Unknown segments format version: {version}")
+
+    colors: dict[str, int] = {}
+    body = bytearray()
+
+    _write_varint(body, len(segments))
+
+    for segment in segments:
+        flags = (
+            (BOLD if segment["bold"] else 0)
+            | (ITALIC if segment["italic"] else 0)
+            | (UNDERLINE if segment["underline"] else 0)
+        )
+
+        color = segment["color"]
+        if color:
+            flags |= COLORED
+
+        body.append(flags)
+
+        if color:
+            _write_varint(body, colors.setdefault(color, len(colors)))
+
+        text = segment["text"].encode()
+        _write_varint(body, len(text))
+        body += text
+
+    header = bytearray((BINARY,))
+    _write_varint(header, len(colors))
+
+    for color in colors:
+        color = color.encode()
+        _write_varint(header, len(color))
+        header += color
+
+    return bytes(header + body)
+
+
+def decode(data: bytes) -> list[Segment]:
+    if not data:
+        raise ValueError("Empty segments payload")
+
+    version = data[0]
+
+    # JSON payload always starts with "[" which is far above known versions
+    if version == ord("["):
+        return json.loads(data.decode())
+
+    if version != BINARY:
+        raise ValueError(f"Unknown segments format version: {version}")
+
+    offset = 1
+    colors_count, offset = _read_varint(data, offset)
+    colors = []
+
+    for _ in range(colors_count):
+        length, offset = _read_varint(data, offset)
+        colors.append(data[offset : offset + length].decode())
+        offset += length
+
+    count, offset = _read_varint(data, offset)
+    segments: list[Segment] = []
+    append = segments.append
+
+    for _ in range(count):
+        flags = data[offset]
+        offset += 1
+
+        color = None
+        if flags & COLORED:
+            index, offset = _read_varint(data, offset)
+            color = colors[index]
+
+        # Short segments dominate - skip varint call for one-byte lengths
+        length = data[offset]
+        if length < 0x80:
+            offset += 1
+        else:
+            length, offset = _read_varint(data, offset)
+
+        end = offset + length
+        append(
+            {
+                "text": data[offset:end].decode(),
+                "bold": bool(flags & BOLD),
+                "italic": bool(flags & ITALIC),
+                "underline": bool(flags & UNDERLINE),
+                "color": color,
+            }
+        )
+        offset = end
+
+    return segments
@@ -0,0 +1,122 @@
+import socket
+import typing
+
+from src.stage import Stage
+from src import ratelimit
+from src import lanes
+from src import util
+
+if typing.TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+
+class Session:
+    """
+    State of one connection.
+
+    Handshake material is dropped once session is online, input and output
+    buffers exist only while they hold something, so idle online session
+    keeps just its keys and name. Pending messages are kept by host
+    per name, shared by all sessions of the name.
+    """
+
+    __slots__ = (
+        "socket",
+        "stage",
+        "name",
+        # Server's x25519 key, only until handshake completes
+        "private_key",
+        "key",
+        "iv",
+        # Key epoch every sealed frame is prefixed with, wraps at 256
+        "epoch",
+        # (epoch, key, iv) replaced by the last rekey, accepted until previous_expires
+        "previous",
+        "previous_expires",
+        # Negotiated compression codec, None until negotiated
+        "compression",
+        # Public x25519 key peers encrypt end-to-end message bodies with
+        "e2e_key",
+        # Received bytes not yet handled
+        "inbound",
+        # Chunks of payloads being received, per lane
+        "assembler",
+        # Frames waiting to be written, per lane
+        "outbound",
+        # Events socket is registered for in selector, 0 if it isn't
+        "events",
+        # Whether session waits in ready queue for its turn
+        "ready",
+        # Rate limits of this session, None if unlimited
+        "limiter",
+        # Throttled session isn't read nor served until this time
+        "throttled_until",
+    )
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        private_key: "X25519PrivateKey",
+        limiter: ratelimit.Limiter | None,
+    ):
+        self.socket = sock
+        self.stage = Stage.x25519
+        self.name: bytes | None = None
+
+        self.private_key: X25519PrivateKey | None = private_key
+        self.key: bytes | None = None
+        self.iv: bytes | None = None
+        self.epoch = 0
+        self.previous: tuple[int, bytes, bytes] | None = None
+        self.previous_expires = 0.0
+
+        self.compression: str | None = None
+        self.e2e_key: bytes | None = None
+
+        self.inbound: bytearray | None = None
+        self.assembler = lanes.Assembler(lanes.MAX_PAYLOAD)
+        self.outbound: lanes.Outbound | None = None
+        self.events = 0
+        self.ready = False
+
+        self.limiter = limiter
+        self.throttled_until = 0.0
+
+    # Not handed off - socket is passed separately, the rest belongs to host
+    # that serves the session and is set up again by it
+    _LOCAL = ("socket", "events", "ready", "limiter")
+
+    def __getstate__(self) -> dict:
+        state = {
+            slot: getattr(self, slot)
+            for slot in self.__slots__
+            if slot not in self._LOCAL
+        }
+
+        if self.private_key is not None:
+            state["private_key"] = util.x25519_private_key_to_bytes(self.private_key)
+
+        return state
+
+    def __setstate__(self, state: dict):
+        self.socket = None
+        self.events = 0
+        self.ready = False
+        self.limiter = None
+
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+        if self.private_key is not None:
+            self.private_key = util.x25519_private_key_from_bytes(self.private_key)
+
+    def go_online(self, name: bytes):
+        self.name = name
+        self.stage = Stage.online
+        self.private_key = None
+
+    def push(self, lane: int, frames: list[bytes]):
+        if self.outbound is None:
+            self.outbound = lanes.Outbound()
+
+        self.outbound.push(lane, frames)
@@ -0,0 +1,344 @@
+"""
+Deterministic in-memory network for driving Host without sockets.
+
+Connections are pairs of ``MemorySocket``, ``MemorySelector`` reports which
+of them are ready and virtual time passes only when nothing is. Simulated
+clients go through the real handshake and commands without threads, so a
+run with thousands of them is repeatable and measures server logic alone,
+without kernel networking or sleeps.
+"""
+
+import collections
+import itertools
+import selectors
+import typing
+
+from src.commands import Commands
+from src.codes import Codes
+from src.host import Host, POLL_INTERVAL
+from src import lanes
+from src import util
+
+
+class VirtualClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class MemorySocket:
+    """
+    One end of in-memory stream connection. Sends fail with BlockingIOError
+    while peer holds ``capacity`` unread bytes, like a full socket buffer
+    """
+
+    def __init__(self, fd: int, capacity: int):
+        self._fd = fd
+        self.capacity = capacity
+        self.peer: MemorySocket | None = None
+        # Received bytes not read yet
+        self.buffer = bytearray()
+        self.closed = False
+        # Selector watching this socket, told about every change of its state
+        self.selector: MemorySelector | None = None
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def setblocking(self, flag: bool):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def readable(self) -> bool:
+        return bool(self.buffer) or self.peer.closed
+
+    def writable(self) -> bool:
+        return self.peer.closed or len(self.peer.buffer) < self.capacity
+
+    def send(self, data: bytes) -> int:
+        if self.closed or self.peer.closed:
+            raise BrokenPipeError("Connection closed")
+
+        space = self.capacity - len(self.peer.buffer)
+
+        if space <= 0:
+            raise BlockingIOError("Peer buffer is full")
+
+        self.peer.buffer += data[:space]
+        self.peer._changed()
+        return min(len(data), space)
+
+    def sendall(self, data: bytes):
+        """Client side sends never block - capacity only limits the server side"""
+        if self.closed or self.peer.closed:
+            raise BrokenPipeError("Connection closed")
+
+        self.peer.buffer += data
+        self.peer._changed()
+
+    def recv(self, size: int) -> bytes:
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            # Peer may be able to write again
+            self.peer._changed()
+            return data
+
+        if self.peer.closed:
+            return b""
+
+        raise BlockingIOError("Nothing received")
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.peer._changed()
+
+    def _changed(self):
+        if self.selector is not None:
+            self.selector.touch(self)
+
+
+def pair(
+    fds: typing.Iterator[int], capacity: int
+) -> tuple[MemorySocket, MemorySocket]:
+    first = MemorySocket(next(fds), capacity)
+    second = MemorySocket(next(fds), capacity)
+    first.peer, second.peer = second, first
+    return first, second
+
+
+class MemorySelector(selectors.BaseSelector):
+    """
+    Selector of MemorySockets. Only sockets whose state changed since
+    the last select, or were ready then, are checked. Select with nothing
+    ready advances virtual clock by timeout instead of waiting
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self._keys: dict[int, selectors.SelectorKey] = {}
+        self._candidates: set[int] = set()
+
+    def register(self, fileobj, events, data=None) -> selectors.SelectorKey:
+        fd = fileobj.fileno()
+
+        if fd in self._keys:
+            raise KeyError(f"{fileobj!r} is already registered")
+
+        self._keys[fd] = key = selectors.SelectorKey(fileobj, fd, events, data)
+        fileobj.selector = self
+        self._candidates.add(fd)
+        return key
+
+    def unregister(self, fileobj) -> selectors.SelectorKey:
+        key = self._keys.pop(fileobj.fileno())
+        fileobj.selector = None
+        self._candidates.discard(key.fd)
+        return key
+
+    def touch(self, sock: MemorySocket):
+        self._candidates.add(sock.fileno())
+
+    def ready(self) -> list[tuple[selectors.SelectorKey, int]]:
+        ready = []
+
+        for fd in sorted(self._candidates):
+            key = self._keys.get(fd)
+
+            if key is None:
+                continue
+
+            events = 0
+            if key.events & selectors.EVENT_READ and key.fileobj.readable():
+                events |= selectors.EVENT_READ
+            if key.events & selectors.EVENT_WRITE and key.fileobj.writable():
+                events |= selectors.EVENT_WRITE
+
+            if events:
+                ready.append((key, events))
+
+        # Ready sockets stay candidates until they are handled
+        self._candidates = {key.fd for key, _ in ready}
+        return ready
+
+    def select(self, timeout: float | None = None):
+        ready = self.ready()
+
+        if not ready and timeout:
+            self.clock.advance(timeout)
+
+        return ready
+
+    def get_map(self) -> typing.Mapping:
+        return {key.fileobj: key for key in self._keys.values()}
+
+
+class Peer:
+    """
+    Client side of simulated connection. Completes handshake and sends
+    commands without blocking, opened replies are collected as they arrive
+    """
+
+    def __init__(self, name: bytes, sock: MemorySocket):
+        self.name = name
+        self.socket = sock
+        self.online = False
+
+        # Online replies, opaque ones as (opened header, body)
+        self.replies: collections.deque[bytes | tuple[bytes, memoryview]] = (
+            collections.deque()
+        )
+
+        self._private = util.x25519_private_key()
+        self._key: bytes | None = None
+        self._iv: bytes | None = None
+        # Handshake frames received so far
+        self._handshake = 0
+
+        self._inbound = bytearray()
+        self._assembler = lanes.Assembler()
+
+    def _seal(self, data: bytes) -> bytes:
+        return b"\0" + util.aes_encrypt(self._key, self._iv, data)
+
+    def _open(self, data: bytes) -> bytes:
+        return util.aes_decrypt(self._key, self._iv, data[1:])
+
+    def send(self, lane: int, command: bytes):
+        self.socket.sendall(b"".join(lanes.frames(lane, self._seal(command))))
+
+    def send_message(self, receiver: bytes, message: bytes):
+        self.send(
+            lanes.INTERACTIVE,
+            util.pack_command(Commands.send_message, (receiver, 1), (message, 2)),
+        )
+
+    def receive_all(self, peers: list[bytes]):
+        self.send(
+            lanes.INTERACTIVE,
+            util.pack_command(Commands.receive_all, *((peer, 1) for peer in peers)),
+        )
+
+    def pump(self):
+        """Handle everything server sent so far"""
+        try:
+            while data := self.socket.recv(65536):
+                self._inbound += data
+        except BlockingIOError:
+            pass
+
+        for frame in util.take_frames(self._inbound):
+            if self.online:
+                self._reply(frame)
+            else:
+                self._step(frame)
+
+    def _step(self, frame: bytes):
+        """Handshake in the order Client.start does it"""
+        self._handshake += 1
+
+        if self._handshake == 1:
+            server_pub = util.x25519_public_key_from_bytes(frame)
+            self._key, self._iv = util.derive_symmetric_keys(
+                self._private.exchange(server_pub)
+            )
+            return
+
+        if self._handshake == 4:
+            code = Codes.decode(util.aes_decrypt(self._key, self._iv, frame))
+        else:
+            code = Codes.decode(frame)
+
+        if code != Codes.ok:
+            raise ValueError(f"Handshake failed with code {code}")
+
+        if self._handshake == 2:
+            self.socket.sendall(
+                util.frame(util.x25519_public_key_to_bytes(self._private.public_key()))
+            )
+        elif self._handshake == 3:
+            self.socket.sendall(
+                util.frame(util.aes_encrypt(self._key, self._iv, self.name))
+            )
+        else:
+            self.online = True
+            self._private = None
+
+    def _reply(self, frame: bytes):
+        lane, opaque, payload = self._assembler.feed(frame)
+
+        if payload is None:
+            return
+
+        if opaque:
+            header, body = lanes.split_opaque(payload)
+            self.replies.append((self._open(header), body))
+        else:
+            self.replies.append(self._open(payload))
+
+
+class Simulation:
+    """
+    Host and simulated clients in one process. Host gets no listening
+    socket, connections are handed to it directly
+    """
+
+    def __init__(self, capacity: int = 256 * 1024, **options):
+        """
+        :param capacity: Unread bytes every connection end holds at most
+        :param options: Host options, besides address and port
+        """
+        self.clock = VirtualClock()
+        self.capacity = capacity
+        self.host = Host("", None, selector=MemorySelector(self.clock), **options)
+        self.host.clock = self.clock
+
+        # Client ends are watched separately, to pump only peers with replies
+        self._peers = MemorySelector(self.clock)
+        self._fds = itertools.count(3)
+        self._addresses = itertools.count()
+
+    def connect(self, name: bytes) -> Peer:
+        server_end, client_end = pair(self._fds, self.capacity)
+
+        peer = Peer(name, client_end)
+        self._peers.register(client_end, selectors.EVENT_READ, peer)
+
+        self.host.connect(server_end, ("memory", next(self._addresses)))
+        return peer
+
+    def run(self, until: float | None = None):
+        """
+        Let host and peers exchange frames until nothing is left to do,
+        or, with until, also let virtual time pass up to it
+        """
+        while True:
+            busy = self.host.poll(0)
+
+            ready = self._peers.ready()
+            for key, _ in ready:
+                key.data.pump()
+
+                # Host closed connection and everything it sent was read
+                if key.fileobj.peer.closed and not key.fileobj.buffer:
+                    self._peers.unregister(key.fileobj)
+
+            if busy or ready:
+                continue
+
+            if until is None or self.clock() >= until:
+                return
+
+            # Idle - host waits as usual, which lets virtual time pass,
+            # but never past until
+            self.host.poll(min(until - self.clock(), POLL_INTERVAL))
@@ -0,0 +1,91 @@
+import typing
+
+Item = typing.TypeVar("Item")
+
+
+class TimingWheel(typing.Generic[Item]):
+    """
+    Hierarchical timing wheel: items scheduled for a deadline come back
+    from ``advance`` once clock passes it, rounded up to a tick.
+
+    Level 0 has a slot per tick, every next level a slot per whole turn of
+    the level below. Item waits on the lowest level whose current turn its
+    deadline falls into and moves down when that slot comes up, so both
+    scheduling and expiry cost amortised O(1) per item.
+
+    Wheel starts at time 0 and skips ahead while it is empty, so it should
+    be advanced to current time before scheduling into an empty wheel.
+    """
+
+    __slots__ = ("tick", "_size", "_levels", "_wheels", "_overflow", "_now", "_count")
+
+    def __init__(self, tick: float, size: int = 64, levels: int = 4):
+        self.tick = tick
+        self._size = size
+        self._levels = levels
+        self._wheels: list[list[list[tuple[int, Item]]]] = [
+            [[] for _ in range(size)] for _ in range(levels)
+        ]
+        # Deadlines beyond the turn of the top level
+        self._overflow: list[tuple[int, Item]] = []
+        # Current tick
+        self._now = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def schedule(self, deadline: float, item: Item):
+        self._insert(max(-int(-deadline // self.tick), self._now + 1), item)
+        self._count += 1
+
+    def _insert(self, tick: int, item: Item):
+        for level in range(self._levels):
+            span = self._size ** (level + 1)
+
+            if tick // span == self._now // span:
+                slot = tick // self._size**level % self._size
+                self._wheels[level][slot].append((tick, item))
+                return
+
+        self._overflow.append((tick, item))
+
+    def advance(self, now: float) -> list[Item]:
+        """Items whose deadline passed by now, in batches of a tick"""
+        target = int(now // self.tick)
+        expired = []
+
+        # Nothing to move around - skip straight to target tick
+        if not self._count:
+            self._now = max(self._now, target)
+            return expired
+
+        while self._now < target and self._count:
+            self._now += 1
+
+            if self._now % self._size**self._levels == 0:
+                overflow, self._overflow = self._overflow, []
+                for tick, item in overflow:
+                    self._insert(tick, item)
+
+            # Upper levels first, so items can move down several levels at once
+            for level in range(self._levels - 1, 0, -1):
+                if self._now % self._size**level:
+                    continue
+
+                slots = self._wheels[level]
+                slot = self._now // self._size**level % self._size
+                entries, slots[slot] = slots[slot], []
+
+                for tick, item in entries:
+                    self._insert(tick, item)
+
+            slots = self._wheels[0]
+            slot = self._now % self._size
+            entries, slots[slot] = slots[slot], []
+
+            expired.extend(item for _, item in entries)
+            self._count -= len(entries)
+
+        self._now = max(self._now, target)
+        return expired
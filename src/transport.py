@@ -0,0 +1,53 @@
+import socket
+import os
+
+
+UNIX_PREFIX = "unix:"
+
+
+def is_unix_address(address: str) -> bool:
+    return address.startswith(UNIX_PREFIX)
+
+
+def unix_path(address: str) -> str:
+    return address[len(UNIX_PREFIX) :]
+
+
+def tcp_listener(address: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((address, port))
+    return sock
+
+
+def unix_listener(path: str) -> socket.socket:
+    # Stale socket file left by a previous run prevents bind
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    return sock
+
+
+def tcp_connection(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect((host, port))
+    return sock
+
+
+def unix_connection(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+
+def connection(host: str, port: int) -> socket.socket:
+    """
+    Connect to the server using transport derived from host:
+    ``unix:/path/to.sock`` connects to unix domain socket, anything else - TCP
+    """
+    if is_unix_address(host):
+        return unix_connection(unix_path(host))
+
+    return tcp_connection(host, port)
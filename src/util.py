@@ -1,35 +1,72 @@
-import threading
-import time
+import functools
+import types
 from socket import socket
-import contextlib
 import typing
 import os
 
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.backends import default_backend
+if typing.TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import (
+        X25519PrivateKey,
+        X25519PublicKey,
+    )
+
+
+@functools.cache
+def _crypto() -> types.SimpleNamespace:
+    """
+    cryptography is imported on first use - it takes longer to import than
+    the rest of server, and interface processes may never encrypt anything
+    """
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.asymmetric import x25519
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives import hashes, serialization
+
+    return types.SimpleNamespace(
+        Cipher=Cipher,
+        AES=algorithms.AES,
+        CFB=modes.CFB,
+        X25519PrivateKey=x25519.X25519PrivateKey,
+        X25519PublicKey=x25519.X25519PublicKey,
+        HKDF=HKDF,
+        SHA256=hashes.SHA256,
+        serialization=serialization,
+    )
 
 
-def x25519_private_key() -> X25519PrivateKey:
-    return X25519PrivateKey.generate()
+def x25519_private_key() -> "X25519PrivateKey":
+    return _crypto().X25519PrivateKey.generate()
 
 
-def x25519_public_key_to_bytes(key: X25519PublicKey) -> bytes:
+def x25519_public_key_to_bytes(key: "X25519PublicKey") -> bytes:
+    serialization = _crypto().serialization
     return key.public_bytes(
         encoding=serialization.Encoding.Raw,
         format=serialization.PublicFormat.Raw,
     )
 
 
-def x25519_public_key_from_bytes(data: bytes) -> X25519PublicKey:
-    return X25519PublicKey.from_public_bytes(data)
+def x25519_public_key_from_bytes(data: bytes) -> "X25519PublicKey":
+    return _crypto().X25519PublicKey.from_public_bytes(data)
+
+
+def x25519_private_key_to_bytes(key: "X25519PrivateKey") -> bytes:
+    serialization = _crypto().serialization
+    return key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def x25519_private_key_from_bytes(data: bytes) -> "X25519PrivateKey":
+    return _crypto().X25519PrivateKey.from_private_bytes(data)
 
 
 def derive_symmetric_keys(shared_secret: bytes) -> tuple[bytes, bytes]:
-    material = HKDF(
-        algorithm=hashes.SHA256(),
+    crypto = _crypto()
+    material = crypto.HKDF(
+        algorithm=crypto.SHA256(),
         length=48,
         salt=None,
         info=b"kmessenger",
@@ -46,9 +83,8 @@ def symmetric_iv() -> bytes:
 
 
 def aes_encrypt(key: bytes, iv: bytes, message: bytes) -> bytes:
-    cipher = Cipher(
-        algorithms.AES(key), modes.CFB(iv), backend=default_backend()
-    )
+    crypto = _crypto()
+    cipher = crypto.Cipher(crypto.AES(key), crypto.CFB(iv))
 
     encryptor = cipher.encryptor()
 
@@ -56,78 +92,86 @@ def aes_encrypt(key: bytes, iv: bytes, message: bytes) -> bytes:
 
 
 def aes_decrypt(key: bytes, iv: bytes, message: bytes) -> bytes:
-    cipher = Cipher(
-        algorithms.AES(key), modes.CFB(iv), backend=default_backend()
-    )
+    crypto = _crypto()
+    cipher = crypto.Cipher(crypto.AES(key), crypto.CFB(iv))
     decryptor = cipher.decryptor()
 
     return decryptor.update(message) + decryptor.finalize()
 
 
-@contextlib.contextmanager
-def no_blocking(sock: socket):
-    is_blocking = sock.getblocking()
-    if is_blocking:
-        sock.setblocking(False)
-
-    try:
-        yield
-    finally:
-        if is_blocking:
-            sock.setblocking(True)
-
-
 class Event:
     def __init__(
         self,
         data: bytes | None = None,
-        no_message: bool = False,
         close_connection: bool = False,
     ):
         self.data = data
-        self.no_message = no_message
         self.close_connection = close_connection
 
 
-def read_event(sock: socket) -> Event:
-    try:
-        with no_blocking(sock):
-            length_bytes = sock.recv(4)
+def recv_exactly(sock: socket, size: int) -> bytes:
+    """
+    Receive exactly ``size`` bytes - stream sockets may return less on single recv.
+    Returns fewer bytes only if connection was closed.
+    """
+    data = sock.recv(size)
+
+    if len(data) == size or not data:
+        return data
 
-        if len(length_bytes) != 4:
-            length_bytes += sock.recv(4 - len(length_bytes))
+    buffer = bytearray(data)
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            break
 
-        if len(length_bytes) != 4:
-            return Event(close_connection=True)
+        buffer += chunk
 
-        return Event(sock.recv(int.from_bytes(length_bytes)))
-    except BlockingIOError:
-        return Event(no_message=True)
+    return bytes(buffer)
 
 
 def wait_event(sock: socket) -> Event:
-    length_bytes = sock.recv(4)
+    length_bytes = recv_exactly(sock, 4)
     if len(length_bytes) != 4:
         return Event(close_connection=True)
 
-    return Event(sock.recv(int.from_bytes(length_bytes)))
+    return Event(recv_exactly(sock, int.from_bytes(length_bytes)))
 
 
-def send_message(sock: socket, message: bytes) -> None:
-    length = len(message)
-    length_bytes = length.to_bytes(4, byteorder="big")
+def frame(message: bytes) -> bytes:
+    return len(message).to_bytes(4, byteorder="big") + message
+
 
-    sock.send(length_bytes + message)
+def take_frames(
+    buffer: bytearray, limit: int | None = None, max_size: int | None = None
+) -> list[bytes]:
+    """
+    Remove up to limit complete frames from the start of buffer and return their bodies
+    :param max_size: Longest frame body allowed
+    :raise ValueError: Frame, complete or not, is declared longer than max_size
+    """
+    frames = []
+    offset = 0
 
+    while len(buffer) - offset >= 4 and (limit is None or len(frames) < limit):
+        length = int.from_bytes(buffer[offset : offset + 4], byteorder="big")
 
-def loop(function: typing.Callable, args: tuple):
-    while threading.main_thread().is_alive():
-        try:
-            function(*args)
-            time.sleep(0.01)
-        except StopIteration:
+        if max_size is not None and length > max_size:
+            raise ValueError(f"Frame of {length} bytes is too large")
+
+        if len(buffer) - offset - 4 < length:
             break
 
+        frames.append(bytes(buffer[offset + 4 : offset + 4 + length]))
+        offset += 4 + length
+
+    del buffer[:offset]
+    return frames
+
+
+def send_message(sock: socket, message: bytes) -> None:
+    sock.sendall(frame(message))
+
 
 def parse_part(length_size: int, buffer: bytes) -> tuple[bytes, bytes]:
     length_bytes = buffer[:length_size]
@@ -0,0 +1,42 @@
+"""
+Terminal shared by the whole interface, created on first use.
+
+Creating a blessed Terminal queries capabilities of the real terminal and
+may wait for its replies, so only one is ever made, and only when
+something is drawn - modules importing components just to build or
+serialize messages don't create it at all.
+"""
+
+import typing
+
+if typing.TYPE_CHECKING:
+    from blessed import Terminal
+
+_terminal: "Terminal | None" = None
+
+
+def get() -> "Terminal":
+    global _terminal
+
+    if _terminal is None:
+        from blessed import Terminal
+
+        _terminal = Terminal()
+
+    return _terminal
+
+
+def use(terminal: "Terminal"):
+    """Replace shared terminal, e.g. with one of fixed kind and size"""
+    global _terminal
+    _terminal = terminal
+
+
+class _Shared:
+    """Stands for shared terminal, creating it on first attribute access"""
+
+    def __getattr__(self, name: str):
+        return getattr(get(), name)
+
+
+t: "Terminal" = typing.cast("Terminal", _Shared())
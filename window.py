@@ -1,13 +1,25 @@
+import collections
+import contextlib
 import itertools
 import threading
 import atexit
+import signal
 import time
 
-from blessed import Terminal
-
+from components import Component, Text
+from scrollback import Scrollback
+from editor import GapBuffer
+from terminal import t
 import util
 
-t = Terminal()
+REGIONS = frozenset({"title", "messages", "prompt"})
+
+# Minimal delay between frames - burst of changes is drawn as one frame
+FRAME_INTERVAL = 0.01
+# How often idle draw thread wakes up to check terminal size and shutdown
+IDLE_INTERVAL = 0.5
+# Wrapped messages kept for history paging, enough for a few screens
+WRAP_CACHE_SIZE = 256
 
 
 def fill_message(message: str, width: int = None, fill: str = " "):
@@ -32,23 +44,159 @@ def fill_message(message: str, width: int = None, fill: str = " "):
     return message
 
 
+class Conversation:
+    """
+    Chat with a single peer: its history, online status and unread counter
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.online = False
+        self.unread = 0
+        self.messages = Scrollback()
+
+
 class Window:
-    def __init__(self, sender: str, receiver: str, receiver_online: bool):
+    def __init__(self, sender: str):
         self.sender = sender
-        self.receiver = receiver
-        self.receiver_online = receiver_online
 
-        self.messages: list = []
-
-        self._input = ""
-        self._cursor = 0
+        self.conversations: dict[str, Conversation] = {}
+        # Conversation selected by user
+        self.active: Conversation | None = None
+        # Conversation which lines are wrapped and shown, owned by draw thread
+        self._shown: Conversation | None = None
+
+        # Wrapped and background-filled lines of the newest messages.
+        # Only lines that fit into messages box are kept
+        self._lines: collections.deque[str] = collections.deque()
+        # Number of messages already wrapped into self._lines
+        self._wrapped = 0
+        self._size = (0, 0)
+
+        # Wrapped lines by message index, used for history paging
+        self._wrap_cache: collections.OrderedDict[int, list[str]] = (
+            collections.OrderedDict()
+        )
+        # (message index, line of message) shown at the top of messages box
+        # while history is paged, None when following newest messages
+        self._scroll: tuple[int, int] | None = None
+        # Pages requested by input thread, applied by draw thread
+        self._scroll_pages = 0
+
+        self._input = GapBuffer()
+        # Keys read from terminal but not handled yet (rest of a paste after enter)
+        self._pending_keys: collections.deque = collections.deque()
+        # Input is edited by main thread and rendered by draw thread
+        self._input_lock = threading.Lock()
+        # Terminal stays in cbreak mode for the whole session
+        self._cbreak = contextlib.ExitStack()
+        self._in_cbreak = False
 
         self._alive = True
         self._last_title = ""
-        self._last_messages_box = ""
         self._last_prompt = ""
+        # Rows of messages box as they are currently shown on terminal
+        self._screen: list[str] = []
+
+        # Regions that changed since last frame, draw thread waits on _redraw.
+        # Condition lock is reentrant, so resize handler may run while main
+        # thread holds it
+        self._dirty: set[str] = set(REGIONS)
+        self._redraw = threading.Condition()
+        self._drawn_size = (0, 0)
+
+        if (
+            hasattr(signal, "SIGWINCH")
+            and threading.current_thread() is threading.main_thread()
+        ):
+            signal.signal(signal.SIGWINCH, lambda *_: self.invalidate(*REGIONS))
 
         atexit.register(lambda: util.print(t.normal_cursor, end=""))
+        atexit.register(self._cbreak.close)
+
+    def open_conversation(self, name: str) -> Conversation:
+        conversation = self.conversations.get(name)
+
+        if conversation is None:
+            conversation = self.conversations[name] = Conversation(name)
+
+            if self.active is None:
+                self.active = conversation
+
+            self.invalidate("title", "messages")
+
+        return conversation
+
+    def close_conversation(self, name: str):
+        conversation = self.conversations.pop(name, None)
+
+        if conversation is None:
+            return
+
+        if conversation is self.active:
+            self.active = next(iter(self.conversations.values()), None)
+
+        conversation.messages.close()
+        self.invalidate(*REGIONS)
+
+    def switch_conversation(self, name: str):
+        conversation = self.conversations.get(name)
+
+        if conversation is None or conversation is self.active:
+            return
+
+        conversation.unread = 0
+        self.active = conversation
+        self.invalidate("title", "messages")
+
+    def next_conversation(self, step: int = 1):
+        conversations = list(self.conversations)
+
+        if self.active is None or not conversations:
+            return
+
+        index = conversations.index(self.active.name)
+        self.switch_conversation(conversations[(index + step) % len(conversations)])
+
+    def set_online(self, name: str, online: bool):
+        conversation = self.conversations.get(name)
+
+        if conversation is not None and conversation.online != online:
+            conversation.online = online
+            self.invalidate("title")
+
+    def invalidate(self, *regions: str):
+        """
+        Mark regions as changed and wake up draw thread
+        :param regions: Any of "title", "messages" and "prompt"
+        """
+        with self._redraw:
+            self._dirty.update(regions)
+            self._redraw.notify()
+
+    def add_message(self, message: Component | str, conversation: str | None = None):
+        """
+        Add message to conversation, opening it if needed
+        :param conversation: Conversation name, active conversation by default
+        """
+        if isinstance(message, str):
+            message = Text(message)
+
+        if conversation is None:
+            target = self.active
+        else:
+            target = self.open_conversation(conversation)
+
+        if target is None:
+            return
+
+        target.messages.append(message)
+
+        if target is self.active:
+            self.invalidate("messages")
+        else:
+            target.unread += 1
+            self.invalidate("title")
 
     def on_input(self, input: str):
         """
@@ -56,182 +204,463 @@ class Window:
         :param input: User input
         """
 
-    def cleanup_messages(self):
-        # Subtract two lines reserved for title and prompt
+    def wrap_message(self, message: Component | str) -> list[str]:
+        if isinstance(message, str):
+            message = Text(message)
+
+        bg = str(t.on_gray10) + str(t.snow)
+        normal = str(t.normal)
+        lines = []
+
+        rendered = message.render()
+
+        # Component knows its printable length - single line messages
+        # need neither wrapping nor measuring
+        if message.length <= t.width and "\n" not in rendered:
+            raw_parts = [(rendered, message.length)]
+        else:
+            raw_parts = [
+                (part, t.length(part))
+                for part in itertools.chain(
+                    *map(lambda p: t.wrap(p, width=t.width), rendered.split("\n"))
+                )
+            ] or [("", 0)]
+
+        for part, part_len in raw_parts:
+            padding = " " * max(0, t.width - part_len)
+            # Re-inject bg after every reset within the content
+            content = (bg + part).replace(normal, normal + bg)
+            # Padding is explicitly wrapped in on_gray10 to guarantee background
+            lines.append(content + t.on_gray10(padding))
+
+        return lines
+
+    def message_lines(self, index: int) -> list[str]:
+        lines = self._wrap_cache.get(index)
+
+        if lines is None:
+            lines = self.wrap_message(self._shown.messages[index])
+            self._wrap_cache[index] = lines
+
+            if len(self._wrap_cache) > WRAP_CACHE_SIZE:
+                self._wrap_cache.popitem(last=False)
+        else:
+            self._wrap_cache.move_to_end(index)
+
+        return lines
+
+    def update_lines(self):
+        """
+        Wrap messages appended since last call. Newest messages are
+        re-wrapped only when terminal size changes
+        """
+        size = (t.width, t.height)
+        active = self.active
+
+        if size != self._size or active is not self._shown:
+            if active is not self._shown:
+                self._shown = active
+                self._scroll = None
+                self._scroll_pages = 0
+
+            self._size = size
+            self._wrap_cache.clear()
+
+            max_height = max(t.height - 2, 0)
+            self._lines = collections.deque(maxlen=max_height)
+
+            if active is None:
+                self._wrapped = 0
+                return
+
+            # Only messages that fill the box are wrapped again
+            index = self._wrapped = len(active.messages)
+            wrapped = []
+            while index > 0 and sum(map(len, wrapped)) < max_height:
+                index -= 1
+                wrapped.append(self.message_lines(index))
+
+            for lines in reversed(wrapped):
+                self._lines.extend(lines)
+
+            if self._scroll is not None:
+                self._scroll = (self._scroll[0], 0)
+
+        if active is None:
+            return
+
+        for index in range(self._wrapped, len(active.messages)):
+            self._lines.extend(self.message_lines(index))
+            self._wrapped = index + 1
+
+    def move_position(self, position: tuple[int, int], lines: int) -> tuple[int, int]:
+        """
+        Move (message index, line of message) position by lines,
+        clamped to history start and end
+        """
+        index, line = position
+        line += lines
+
+        while line < 0:
+            if index == 0:
+                return 0, 0
+
+            index -= 1
+            line += len(self.message_lines(index))
+
+        while index < self._wrapped and line >= len(self.message_lines(index)):
+            line -= len(self.message_lines(index))
+            index += 1
+
+        if index >= self._wrapped:
+            return self._wrapped, 0
+
+        return index, line
+
+    def scroll_up(self):
+        with self._redraw:
+            self._scroll_pages -= 1
+        self.invalidate("title", "messages")
+
+    def scroll_down(self):
+        with self._redraw:
+            self._scroll_pages += 1
+        self.invalidate("title", "messages")
+
+    def apply_scroll(self):
+        """
+        Move history view by pages requested with scroll_up and scroll_down.
+        Runs in draw thread, which owns wrapped lines
+        """
+        with self._redraw:
+            pages, self._scroll_pages = self._scroll_pages, 0
+
+        if not pages:
+            return
+
+        self.update_lines()
+
         max_height = t.height - 2
+        # Keep one line of previous page visible
+        page = max(max_height - 1, 1)
+        end = (self._wrapped, 0)
 
-        total_lines = 0
-        remove_before = 0
-        for index, message in enumerate(self.messages[::-1]):
-            message_lines = t.length(fill_message(str(message))) / t.width
-            total_lines += message_lines
+        top = self._scroll
+        if top is None:
+            if pages > 0:
+                return
+            top = self.move_position(end, -max_height)
 
-            if total_lines >= max_height:
-                remove_before = -index
-                break
+        top = self.move_position(top, pages * page)
 
-        self.messages = self.messages[remove_before:]
+        # Back to following newest messages once history end is visible
+        if self.move_position(top, max_height) == end:
+            self._scroll = None
+        else:
+            self._scroll = top
 
     def render_title(self) -> str:
-        receiver_status = (
-            self.receiver
-            + "["
-            + (t.green("ONLINE") if self.receiver_online else t.red("OFFLINE"))
-            + "]"
-        )
+        tabs = ""
+
+        for conversation in list(self.conversations.values()):
+            label = conversation.name
+
+            if conversation.unread:
+                label += f"({conversation.unread})"
+
+            if conversation is self.active:
+                label = t.reverse(label)
+
+            status = t.green("●") if conversation.online else t.red("●")
+            tabs += " " + status + label
+
+        tabs = t.truncate(tabs, max(t.width - t.length(self.sender), 0))
+
+        title = "KMessenger" if self._scroll is None else "KMessenger [history]"
 
         return t.on_gray15(
             self.sender
             + t.gold(
-                t.center("KMessenger")[
-                    t.length(self.sender) : t.width - t.length(receiver_status)
+                t.center(title)[
+                    t.length(self.sender) : t.width - t.length(tabs)
                 ]
             )
-            + receiver_status
+            + tabs
         )
 
-    def render_messages_box(self) -> str:
-        self.cleanup_messages()
+    def render_message_rows(self) -> list[str]:
+        self.update_lines()
 
         max_height = t.height - 2
-        bg = str(t.on_gray10) + str(t.snow)
-        normal = str(t.normal)
-        lines = ""
 
-        for message in self.messages:
-            raw_parts = list(
-                itertools.chain(
-                    *map(lambda p: t.wrap(p, width=t.width), str(message).split("\n"))
-                )
-            ) or [""]
+        if self._scroll is None:
+            rows = list(self._lines)
+        else:
+            index, line = self._scroll
+            rows = []
 
-            for part in raw_parts:
-                part_len = t.length(part)
-                padding = " " * max(0, t.width - part_len)
-                # Re-inject bg after every reset within the content
-                content = (bg + part).replace(normal, normal + bg)
-                # Padding is explicitly wrapped in on_gray10 to guarantee background
-                lines += content + t.on_gray10(padding)
+            while len(rows) < max_height and index < self._wrapped:
+                rows.extend(self.message_lines(index)[line:])
+                index, line = index + 1, 0
 
-        lines_count = t.length(lines) // t.width
-        if lines_count < max_height:
-            lines += t.on_gray10(" " * t.width * (max_height - lines_count))
+            del rows[max_height:]
 
-        return lines
+        if len(rows) < max_height:
+            rows += [t.on_gray10(" " * t.width)] * (max_height - len(rows))
+
+        return rows
+
+    def render_messages_box(self) -> str:
+        return "".join(self.render_message_rows())
+
+    def update_rows(self, rows: list[str]) -> str:
+        """
+        Build terminal output that turns messages box currently on screen into rows.
+        Only changed rows are written, history pushed up by new messages
+        is scrolled by terminal itself
+        """
+        screen = self._screen
+        height = len(rows)
+
+        if len(screen) != height:
+            return t.move_xy(0, 1) + "".join(rows)
+
+        update = ""
+        shift = self._scroll_shift(screen, rows)
+
+        if shift:
+            # Scroll region covers messages box only, title and prompt stay
+            update += (
+                t.csr(1, height)
+                + t.move_xy(0, height)
+                + t.ind * shift
+                + t.csr(0, t.height - 1)
+            )
+            screen = screen[shift:] + [None] * shift
+
+        for index, (shown, row) in enumerate(zip(screen, rows)):
+            if shown != row:
+                update += t.move_xy(0, index + 1) + row
+
+        return update
+
+    @staticmethod
+    def _scroll_shift(screen: list[str], rows: list[str]) -> int:
+        """
+        Find by how many lines shown rows should be scrolled up to match new rows
+        :return: 0 when scrolling doesn't help or isn't supported
+        """
+        if not t.csr or not t.ind:
+            return 0
+
+        height = len(rows)
+
+        for shift in range(1, height):
+            # Scrolling must save more than it costs
+            if height - shift < 2:
+                break
+
+            if screen[shift] == rows[0] and screen[shift:] == rows[: height - shift]:
+                return shift
+
+        return 0
 
     def render_prompt(self) -> str:
         prefix = ">>> "
         prompt_start = t.move_xy(0, t.height) + prefix
 
-        if self._input == "":
-            return prompt_start + (
-                t.save + t.gray(t.on_cyan("T") + "ype something...") + t.restore
-            )
+        with self._input_lock:
+            input_len = len(self._input)
+            cursor = self._input.cursor
 
-        available = t.width - len(prefix) - 1
-        input_len = len(self._input)
+            if input_len == 0:
+                return prompt_start + (
+                    t.save + t.gray(t.on_cyan("T") + "ype something...") + t.restore
+                )
 
-        if input_len <= available:
-            view_start, view_end = 0, input_len
-        else:
-            half = available // 2
-            view_start = max(0, self._cursor - half)
-            view_end = view_start + available
-            if view_end > input_len:
-                view_end = input_len
-                view_start = max(0, view_end - available)
-
-        prompt = prompt_start
-        for i in range(view_start, view_end):
-            char = self._input[i]
-            if i == self._cursor:
-                prompt += t.yellow_on_cyan(char)
+            available = t.width - len(prefix) - 1
+
+            if input_len <= available:
+                view_start, view_end = 0, input_len
             else:
-                prompt += t.yellow(char)
+                half = available // 2
+                view_start = max(0, cursor - half)
+                view_end = view_start + available
+                if view_end > input_len:
+                    view_end = input_len
+                    view_start = max(0, view_end - available)
+
+            before = self._input.slice(view_start, cursor)
+            under_cursor = self._input.slice(cursor, min(cursor + 1, view_end))
+            after = self._input.slice(cursor + 1, view_end)
+
+        prompt = prompt_start + t.yellow(before)
 
-        if self._cursor == view_end:
+        if under_cursor:
+            prompt += t.yellow_on_cyan(under_cursor) + t.yellow(after)
+        else:
             prompt += t.on_cyan(" ")
 
         return prompt
 
-    def draw(self):
+    def draw(self, regions: frozenset[str] = REGIONS):
         if self._last_title == "":
             util.print(t.hide_cursor, end="")
 
-        title = self.render_title()
-        messages_box = self.render_messages_box()
-        prompt = self.render_prompt()
+        self.apply_scroll()
+
+        if "title" in regions:
+            title = self.render_title()
 
-        if self._last_title != title:
-            util.print(t.move_xy(0, 0) + title)
-            self._last_title = title
+            if self._last_title != title:
+                util.print(t.move_xy(0, 0) + title)
+                self._last_title = title
 
-        if self._last_messages_box != messages_box:
-            util.print(t.move_xy(0, 1) + messages_box)
-            self._last_messages_box = messages_box
+        if "messages" in regions:
+            rows = self.render_message_rows()
+            update = self.update_rows(rows)
 
-        if self._last_prompt != prompt:
-            util.print(t.move_xy(0, t.height) + t.clear_eol + prompt, end="")
-            self._last_prompt = prompt
+            if update:
+                util.print(update, end="")
+
+            self._screen = rows
+
+        if "prompt" in regions:
+            prompt = self.render_prompt()
+
+            if self._last_prompt != prompt:
+                util.print(t.move_xy(0, t.height) + t.clear_eol + prompt, end="")
+                self._last_prompt = prompt
 
     def infinite_draw(self):
         while threading.main_thread().is_alive() and self._alive:
-            self.draw()
-            time.sleep(0.01)
+            with self._redraw:
+                self._redraw.wait_for(
+                    lambda: self._dirty or not self._alive, IDLE_INTERVAL
+                )
+                regions, self._dirty = frozenset(self._dirty), set()
+
+            # Terminals without SIGWINCH are checked for resize on wake up
+            if self._drawn_size != (t.width, t.height):
+                self._drawn_size = (t.width, t.height)
+                self._screen = []
+                self._last_title = self._last_prompt = ""
+                regions = REGIONS
+
+            if not regions or not self._alive:
+                continue
+
+            self.draw(regions)
+            # Changes made while sleeping are coalesced into the next frame
+            time.sleep(FRAME_INTERVAL)
 
     def non_blocking_draw(self):
         threading.Thread(target=self.infinite_draw).start()
 
     def input(self):
+        if not self._in_cbreak:
+            self._cbreak.enter_context(t.cbreak())
+            self._in_cbreak = True
+
         while True:
-            with t.cbreak():
-                key = t.inkey()
-
-            if key.name is not None:
-                match key.name.lower():
-                    case "key_up" | "key_home":
-                        self._cursor = 0
-
-                    case "key_down" | "key_end":
-                        self._cursor = len(self._input)
-
-                    case "key_right" | "key_pgdown":
-                        self._cursor = min(self._cursor + 1, len(self._input))
-
-                    case "key_left" | "key_pgup":
-                        self._cursor = max(self._cursor - 1, 0)
-
-                    case "key_enter":
-                        input = self._input
-                        self.on_input(input)
-                        self._input = ""
-                        self._cursor = 0
-                        return input
-
-                    case "key_backspace":
-                        if self._cursor == 0:
-                            continue
-
-                        self._input = (
-                            self._input[: self._cursor - 1]
-                            + self._input[self._cursor :]
-                        )
-                        self._cursor -= 1
-                    case "key_delete":
-                        self._input = (
-                            self._input[: self._cursor]
-                            + self._input[self._cursor + 1 :]
-                        )
-                    case "key_escape":
-                        raise KeyboardInterrupt()
+            if not self._pending_keys:
+                # Wait for a key, then drain everything already typed or
+                # pasted so the whole batch is one edit and one redraw
+                self._pending_keys.append(t.inkey())
+
+                while key := t.inkey(timeout=0):
+                    self._pending_keys.append(key)
+
+            with self._input_lock:
+                line = self.handle_keys()
+
+            self.invalidate("prompt")
+
+            if line is not None:
+                return line
+
+    def handle_keys(self) -> str | None:
+        """
+        Apply pending key presses to input line, stops after enter
+        :return: Entered line if enter was pressed, None otherwise
+        """
+        text = []
+
+        while self._pending_keys:
+            key = self._pending_keys[0]
+
+            if key.name is None:
+                text.append(str(key))
+                self._pending_keys.popleft()
                 continue
 
-            self._input = (
-                self._input[: self._cursor]
-                + str(key)
-                + self._input[self._cursor :]
-            )
-            self._cursor += 1
+            # Consecutive printable keys are inserted at once
+            if text:
+                self._input.insert("".join(text))
+                text.clear()
+
+            self._pending_keys.popleft()
+            line = self.handle_key(key)
+
+            if line is not None:
+                return line
+
+        if text:
+            self._input.insert("".join(text))
+
+        return None
+
+    def handle_key(self, key) -> str | None:
+        """
+        Apply key press to input line
+        :return: Entered line if key is enter, None otherwise
+        """
+        if key.name is None:
+            self._input.insert(str(key))
+            return None
+
+        match key.name.lower():
+            case "key_up" | "key_home":
+                self._input.move(0)
+
+            case "key_down" | "key_end":
+                self._input.move(len(self._input))
+
+            case "key_right":
+                self._input.move(self._input.cursor + 1)
+
+            case "key_left":
+                self._input.move(self._input.cursor - 1)
+
+            case "key_tab":
+                self.next_conversation()
+
+            case "key_btab":
+                self.next_conversation(-1)
+
+            case "key_pgup":
+                self.scroll_up()
+
+            case "key_pgdown":
+                self.scroll_down()
+
+            case "key_enter":
+                input = str(self._input)
+                self.on_input(input)
+                self._input.clear()
+                return input
+
+            case "key_backspace":
+                self._input.delete_before()
+
+            case "key_delete":
+                self._input.delete_after()
+
+            case "key_escape":
+                self._pending_keys.clear()
+                raise KeyboardInterrupt()
+
+        return None
 
     def infinite_input(self):
         while threading.main_thread().is_alive() and self._alive:
@@ -239,6 +668,9 @@ class Window:
 
     def stop(self):
         self._alive = False
+        self._cbreak.close()
+        self._in_cbreak = False
+        self.invalidate()
 
     def __del__(self):
         self._alive = False